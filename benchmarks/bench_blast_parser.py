@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+"""Measure the throughput of the BLAST parsers, in lines per second.
+
+By default, the BLAST files in the datasets directory are repeated to
+make a larger input.  Other BLAST files may be given as arguments.
+The same hits are also written in the XML format, to time the XML
+parser, which is given in tabular lines per second for comparison.
+The peak memory use of the process is reported after each parser.
+"""
+import glob
+import optparse
+import os
+import resource
+import shutil
+import tempfile
+import time
+from xml.sax.saxutils import escape
+
+from brocclib.parse import (
+    iter_blast, iter_blast_queries, iter_blast_xml,
+    )
+
+DATASETS_DIR = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "..", "datasets")
+
+
+def write_input(out_fp, blast_fps, repeat):
+    num_lines = 0
+    with open(out_fp, "w") as out:
+        for _ in range(repeat):
+            for fp in blast_fps:
+                with open(fp) as f:
+                    for line in f:
+                        out.write(line)
+                        num_lines += 1
+    return num_lines
+
+
+def write_xml_input(out_fp, blast_fp):
+    with open(blast_fp) as f, open(out_fp, "w") as out:
+        out.write("<?xml version=\"1.0\"?>\n<BlastOutput>\n")
+        out.write("<BlastOutput_iterations>\n")
+        for n, (query_id, hits) in enumerate(iter_blast_queries(f)):
+            out.write(
+                "<Iteration>\n<Iteration_query-ID>Query_%d"
+                "</Iteration_query-ID>\n<Iteration_query-def>%s"
+                "</Iteration_query-def>\n<Iteration_query-len>%d"
+                "</Iteration_query-len>\n<Iteration_hits>\n" % (
+                    n + 1, escape(query_id), max(hits.lengths or [0])))
+            for hit in hits:
+                out.write(
+                    "<Hit>\n<Hit_id>gi|%s|</Hit_id>\n<Hit_hsps>\n<Hsp>\n"
+                    "<Hsp_identity>%d</Hsp_identity>\n"
+                    "<Hsp_align-len>%d</Hsp_align-len>\n"
+                    "</Hsp>\n</Hit_hsps>\n</Hit>\n" % (
+                        hit.gi, round(hit.pct_id * hit.length / 100),
+                        hit.length))
+            out.write("</Iteration_hits>\n</Iteration>\n")
+        out.write("</BlastOutput_iterations>\n</BlastOutput>\n")
+
+
+def peak_memory():
+    # Peak resident set size in MB (ru_maxrss is in kB on Linux)
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def time_parser(label, parse_fcn, blast_fp, num_lines):
+    start = time.time()
+    num_hits = 0
+    with open(blast_fp) as f:
+        for _ in parse_fcn(f):
+            num_hits += 1
+    elapsed = time.time() - start
+    print "%-20s %8.2f s %12.0f lines/s %10.1f MB" % (
+        label, elapsed, num_lines / elapsed, peak_memory())
+
+
+def iter_lines(f):
+    # Reading the lines alone, for comparison
+    return f
+
+
+def main(argv=None):
+    p = optparse.OptionParser(usage="%prog [options] [blast_fp ...]")
+    p.add_option("--repeat", type="int", default=20, help=(
+        "Number of times to repeat the input [default: %default]"))
+    opts, args = p.parse_args(argv)
+
+    blast_fps = args
+    if not blast_fps:
+        # The test_blast dataset is not valid tabular output
+        blast_fps = [
+            fp for fp in sorted(glob.glob(
+                os.path.join(DATASETS_DIR, "*_blast*")))
+            if not fp.endswith("test_blast")]
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        input_fp = os.path.join(tmp_dir, "blast.txt")
+        num_lines = write_input(input_fp, blast_fps, opts.repeat)
+        print "%d lines" % num_lines
+        time_parser("read lines", iter_lines, input_fp, num_lines)
+        time_parser("iter_blast", iter_blast, input_fp, num_lines)
+        time_parser(
+            "iter_blast_queries", iter_blast_queries, input_fp, num_lines)
+        xml_fp = os.path.join(tmp_dir, "blast.xml")
+        write_xml_input(xml_fp, input_fp)
+        print "XML input: %.1f MB" % (os.path.getsize(xml_fp) / 1e6)
+        time_parser("iter_blast_xml", iter_blast_xml, xml_fp, num_lines)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == "__main__":
+    main()
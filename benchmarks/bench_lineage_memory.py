@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+"""Measure the memory used by lineages, with and without shared names.
+
+Every BLAST hit in the datasets directory is resolved to a lineage, as
+in a brocc.py run, using a synthetic local taxonomy for the GI numbers
+in the datasets.  Two structures are measured, each kept in memory for
+the whole run: the lineage dicts held by NcbiEutils, and the Lineage
+objects held in a GI lineage dict (see --gi_lineages_fp).
+
+Each measurement is made in a separate process, as the growth in
+resident memory while the structure is built.  Taxon names and lineage
+tuples are normally shared through brocclib.taxonomy.intern_taxon; for
+comparison, the same is done with sharing turned off.
+"""
+import optparse
+import os
+import shutil
+import sys
+import tempfile
+
+from brocclib import get_xml, taxonomy
+from brocclib.assign import Assigner
+from brocclib.command import CONSENSUS_THRESHOLDS
+from brocclib.get_xml import NcbiEutils
+from brocclib.parse import iter_blast
+from brocclib.taxonomy_db import NcbiTaxonomyDb
+
+from bench_pipeline import DATASETS_DIR, dataset_pairs, make_taxonomy, \
+    run_in_child
+
+
+def current_rss():
+    # Resident set size in MB
+    with open("/proc/self/statm") as f:
+        pages = int(f.read().split()[1])
+    return pages * os.sysconf("SC_PAGE_SIZE") / 1e6
+
+
+def read_hit_gis(blast_fps, repeat):
+    gis = []
+    for _ in xrange(repeat):
+        for fp in blast_fps:
+            with open(fp) as f:
+                gis.extend(hit.gi for _, hit in iter_blast(f))
+    return gis
+
+
+def no_sharing():
+    identity = lambda value: value
+    taxonomy.intern_taxon = identity
+    get_xml.intern_taxon = identity
+
+
+def build_lineage_dicts(db_fp, gis):
+    # Values are stored as they would be after retrieval from NCBI
+    db = NcbiTaxonomyDb(db_fp)
+    eutils = NcbiEutils()
+    for gi in gis:
+        if gi in eutils.taxon_ids:
+            continue
+        taxon_id = db.get_taxon_id(gi)
+        eutils._add_to_cache("taxon_ids", {gi: taxon_id})
+        if (taxon_id is not None) and (taxon_id not in eutils.lineages):
+            eutils._add_to_cache(
+                "lineages", {taxon_id: db.get_lineage(taxon_id)})
+    return eutils
+
+
+def build_lineages(db_fp, gis, lineage_cache_size):
+    assigner = Assigner(
+        80.0, 95.2, 83.05, 80.0, [t for _, t in CONSENSUS_THRESHOLDS],
+        0.7, NcbiTaxonomyDb(db_fp), lineage_cache_size, gi_lineages={})
+    for gi in gis:
+        assigner._retrieve_lineage(gi)
+    return assigner
+
+
+def measure(build_fcn, shared, *args):
+    if not shared:
+        no_sharing()
+    start = current_rss()
+    x = build_fcn(*args)
+    return {"rss_mb": current_rss() - start}
+
+
+def main(argv=None):
+    p = optparse.OptionParser()
+    p.add_option("--datasets_dir", default=DATASETS_DIR, help=(
+        "directory of FASTA and BLAST file pairs [default: %default]"))
+    p.add_option("--repeat", type="int", default=1, help=(
+        "number of times to repeat the hits in the datasets "
+        "[default: %default]"))
+    p.add_option("--num_taxa", type="int", default=5000, help=(
+        "number of taxa in the synthetic taxonomy [default: %default]"))
+    p.add_option("--lineage_cache_size", type="int", default=10000, help=(
+        "size of the lineage cache, as in brocc.py [default: %default]"))
+    opts, args = p.parse_args(argv)
+
+    blast_fps = [b for _, _, b in dataset_pairs(opts.datasets_dir)]
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        taxonomy_args = make_taxonomy(blast_fps, tmp_dir, "db", opts.num_taxa)
+        db_fp = taxonomy_args[1]
+        gis = read_hit_gis(blast_fps, opts.repeat)
+        print "%d hits, %d distinct subjects" % (len(gis), len(set(gis)))
+        print "%-15s %12s %12s %10s" % ("", "shared (MB)", "copies (MB)", "saved")
+        for label, build_fcn, build_args in [
+                ("lineage dicts", build_lineage_dicts, (db_fp, gis)),
+                ("Lineage", build_lineages,
+                 (db_fp, gis, opts.lineage_cache_size)),
+                ]:
+            res = {}
+            for shared in [True, False]:
+                res[shared], _, _ = run_in_child(
+                    measure, build_fcn, shared, *build_args)
+            shared_mb = res[True]["rss_mb"]
+            copies_mb = res[False]["rss_mb"]
+            print "%-15s %12.1f %12.1f %9.0f%%" % (
+                label, shared_mb, copies_mb,
+                100.0 * (copies_mb - shared_mb) / copies_mb)
+            sys.stdout.flush()
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == "__main__":
+    main()
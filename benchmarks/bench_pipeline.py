@@ -0,0 +1,321 @@
+#!/usr/bin/env python
+"""Benchmark the full brocc pipeline, and each of its stages.
+
+Runs brocc.py on each pair of FASTA and BLAST files in the datasets
+directory, and on larger inputs made by repeating all of the pairs
+(with the query IDs made unique for each copy).  Taxonomy comes from
+a synthetic local database covering every GI number in the inputs, so
+no network requests are made.
+
+For each input, the full program is run in a separate process, and
+its wall time and peak memory use are recorded.  The stages are then
+timed one by one in another process: reading the FASTA and BLAST
+files, retrieving lineages, assigning each query, and writing the
+output.  Per-query assignment times are summarized as percentiles.
+
+Results are written as JSON, for comparison across versions.
+"""
+import glob
+import json
+import optparse
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+from StringIO import StringIO
+
+from brocclib.command import (
+    main as brocc_main, parse_args, make_assigner, write_assignments,
+    _format_assignment,
+    )
+from brocclib.parse import iter_fasta, iter_blast_queries, merge_blast_queries
+from brocclib.taxonomy_db import (
+    bulk_load, read_gi_numbers, taxonomy_rows, NcbiTaxonomyDb,
+    )
+from brocclib.taxonomy_index import compile_index, TaxonomyIndex
+
+from bench_taxonomy_index import synthetic_dumps
+
+DATASETS_DIR = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "..", "datasets")
+
+# BLAST files in the datasets directory that are not valid tabular
+# output
+BROKEN_BLAST_FILES = ["test_blast"]
+
+PERCENTILES = [50, 90, 99]
+
+
+def dataset_pairs(datasets_dir):
+    """Find the (name, fasta_fp, blast_fp) triples in a directory.
+
+    Pairs are named after the FASTA file.  Pairs with a BLAST file in
+    BROKEN_BLAST_FILES are left out.
+    """
+    pairs = []
+    for fasta_fp in sorted(glob.glob(os.path.join(datasets_dir, "*fasta*"))):
+        name = os.path.basename(fasta_fp)
+        blast_name = name.replace("fasta", "blast")
+        blast_fp = os.path.join(datasets_dir, blast_name)
+        if os.path.exists(blast_fp) and \
+                blast_name not in BROKEN_BLAST_FILES:
+            pairs.append((name, fasta_fp, blast_fp))
+    return pairs
+
+
+def _prefix_lines(in_fp, out, prefix, fasta):
+    # Make query IDs unique by adding a prefix where they appear
+    with open(in_fp) as f:
+        for line in f:
+            if fasta:
+                if line.startswith(">"):
+                    line = ">" + prefix + line[1:]
+            elif line.startswith("# Query:"):
+                line = "# Query: " + prefix + line[8:].lstrip()
+            elif not line.startswith("#"):
+                line = prefix + line
+            out.write(line)
+
+
+def write_scaled_input(pairs, scale, fasta_fp, blast_fp):
+    """Write all of the dataset pairs, repeated scale times."""
+    with open(fasta_fp, "w") as fasta_out, open(blast_fp, "w") as blast_out:
+        for n in xrange(scale):
+            for name, pair_fasta_fp, pair_blast_fp in pairs:
+                prefix = "%s_%d_" % (name, n)
+                _prefix_lines(pair_fasta_fp, fasta_out, prefix, True)
+                _prefix_lines(pair_blast_fp, blast_out, prefix, False)
+
+
+def make_taxonomy(blast_fps, tmp_dir, backend, num_taxa):
+    """Build a synthetic taxonomy for the GI numbers in the BLAST files.
+
+    Returns the brocc.py options to use it.
+    """
+    gi_nums = sorted(read_gi_numbers(blast_fps), key=int)
+    gi_taxid, nodes, names, _ = synthetic_dumps(
+        num_taxa, len(gi_nums), gi_nums=gi_nums)
+    tables = taxonomy_rows(
+        StringIO(gi_taxid), StringIO(nodes), StringIO(names))
+    if backend == "index":
+        index_fp = os.path.join(tmp_dir, "taxonomy.idx")
+        compile_index(index_fp, tables)
+        return ["--taxonomy_index_fp", index_fp]
+    db_fp = os.path.join(tmp_dir, "taxonomy.db")
+    bulk_load(db_fp, tables)
+    return ["--taxonomy_db_fp", db_fp]
+
+
+def run_in_child(fcn, *args):
+    """Run a function in a forked process.
+
+    Returns the result, which must be JSON-serializable, along with
+    the wall time in seconds and the peak resident set size in MB.
+    """
+    read_fd, write_fd = os.pipe()
+    start = time.time()
+    pid = os.fork()
+    if pid == 0:
+        # The child must not return to the caller, even on SystemExit
+        status = 1
+        try:
+            os.close(read_fd)
+            try:
+                res = fcn(*args)
+                status = 0
+            except BaseException:
+                res = {"error": traceback.format_exc()}
+            with os.fdopen(write_fd, "w") as f:
+                json.dump(res, f)
+        finally:
+            os._exit(status)
+    os.close(write_fd)
+    with os.fdopen(read_fd) as f:
+        res = json.loads(f.read() or "null")
+    _, status, rusage = os.wait4(pid, 0)
+    elapsed = time.time() - start
+    if status != 0:
+        raise RuntimeError((res or {}).get("error", "Exit status %d" % status))
+    # ru_maxrss is given in kB on Linux
+    return res, elapsed, rusage.ru_maxrss / 1024.0
+
+
+def percentiles(values, ps=PERCENTILES):
+    """Return nearest-rank percentiles of a list of values."""
+    values = sorted(values)
+    if not values:
+        return dict(("p%d" % p, None) for p in ps)
+    res = {}
+    for p in ps:
+        idx = max(0, int(round(p / 100.0 * len(values))) - 1)
+        res["p%d" % p] = values[idx]
+    res["max"] = values[-1]
+    res["mean"] = sum(values) / len(values)
+    return res
+
+
+def run_main(fasta_fp, blast_fp, output_dir, taxonomy_args):
+    brocc_main([
+        "-i", fasta_fp, "-b", blast_fp, "-o", output_dir, "-a", "ITS",
+        ] + taxonomy_args)
+
+
+def run_stages(fasta_fp, blast_fp, output_dir, taxonomy_args):
+    opts = parse_args(["-a", "ITS"] + taxonomy_args)
+    if opts.taxonomy_index_fp:
+        open_taxa_db = lambda: TaxonomyIndex(opts.taxonomy_index_fp)
+    else:
+        open_taxa_db = lambda: NcbiTaxonomyDb(opts.taxonomy_db_fp)
+    times = {}
+
+    start = time.time()
+    with open(fasta_fp) as f:
+        seqs = list(iter_fasta(f, lengths_only=True))
+    times["read_fasta"] = time.time() - start
+
+    start = time.time()
+    with open(blast_fp) as f:
+        blast_hits = dict(merge_blast_queries(iter_blast_queries(f)))
+    times["read_blast"] = time.time() - start
+
+    # Lineages for every subject, straight from the taxonomy backend
+    taxa_db = open_taxa_db()
+    gis = set(gi for hits in blast_hits.itervalues() for gi in hits.gis)
+    start = time.time()
+    for gi in gis:
+        taxon_id = taxa_db.get_taxon_id(gi)
+        if taxon_id is not None:
+            taxa_db.get_lineage(taxon_id)
+    times["lineages"] = time.time() - start
+
+    # Assignment, starting with an empty lineage cache
+    assigner = make_assigner(opts, open_taxa_db())
+    assignments = []
+    latencies = []
+    for name, seq in seqs:
+        query_start = time.time()
+        assignments.append(assigner.assign(name, seq, blast_hits.get(name, [])))
+        latencies.append(time.time() - query_start)
+    times["assign"] = sum(latencies)
+
+    start = time.time()
+    write_assignments(
+        (_format_assignment(a) for a in assignments), output_dir)
+    times["write"] = time.time() - start
+
+    return {
+        "queries": len(seqs),
+        "hits": sum(len(hits) for hits in blast_hits.itervalues()),
+        "subjects": len(gis),
+        "stages": times,
+        "assign_latency_ms": dict(
+            (k, v * 1e3) for k, v in percentiles(latencies).items()),
+        }
+
+
+def benchmark_input(name, scale, fasta_fp, blast_fp, tmp_dir, taxonomy_args):
+    res = {"input": name, "scale": scale}
+    output_dir = os.path.join(tmp_dir, "output")
+    try:
+        _, elapsed, peak_rss = run_in_child(
+            run_main, fasta_fp, blast_fp, output_dir, taxonomy_args)
+        res["main"] = {"wall_s": elapsed, "peak_rss_mb": peak_rss}
+        stages, elapsed, peak_rss = run_in_child(
+            run_stages, fasta_fp, blast_fp, output_dir, taxonomy_args)
+        res.update(stages)
+        res["stages_peak_rss_mb"] = peak_rss
+    except RuntimeError as e:
+        res["error"] = str(e)
+    finally:
+        shutil.rmtree(output_dir, ignore_errors=True)
+    return res
+
+
+def report(res):
+    if "error" in res:
+        sys.stderr.write("%s x%d: %s\n" % (
+            res["input"], res["scale"], res["error"]))
+    else:
+        sys.stderr.write("%-30s x%-5d %8d queries %8.2f s %8.1f MB\n" % (
+            res["input"], res["scale"], res["queries"],
+            res["main"]["wall_s"], res["main"]["peak_rss_mb"]))
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], stderr=open(os.devnull, "w"),
+            cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+    p = optparse.OptionParser()
+    p.add_option("--datasets_dir", default=DATASETS_DIR, help=(
+        "directory of FASTA and BLAST file pairs [default: %default]"))
+    p.add_option("--scales", default="10", help=(
+        "comma-separated numbers of times to repeat all of the datasets, "
+        "e.g. 10,100,1000. Use 0 for none [default: %default]"))
+    p.add_option("--skip_datasets", action="store_true", help=(
+        "only run the scaled-up inputs"))
+    p.add_option("--backend", choices=["db", "index"], default="db", help=(
+        "local taxonomy backend, a SQLite database (db) or a taxonomy "
+        "index (index) [default: %default]"))
+    p.add_option("--num_taxa", type="int", default=5000, help=(
+        "number of taxa in the synthetic taxonomy [default: %default]"))
+    p.add_option("-o", "--output_fp", help=(
+        "file to write the JSON results [default: standard output]"))
+    opts, args = p.parse_args(argv)
+    scales = [int(s) for s in opts.scales.split(",") if int(s) > 0]
+
+    pairs = dataset_pairs(opts.datasets_dir)
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        start = time.time()
+        taxonomy_args = make_taxonomy(
+            [b for _, _, b in pairs], tmp_dir, opts.backend, opts.num_taxa)
+        sys.stderr.write("Built taxonomy in %.1f s\n" % (time.time() - start))
+
+        runs = []
+        if not opts.skip_datasets:
+            for name, fasta_fp, blast_fp in pairs:
+                runs.append(benchmark_input(
+                    name, 1, fasta_fp, blast_fp, tmp_dir, taxonomy_args))
+                report(runs[-1])
+        # Scaled-up inputs are written one at a time, as they are large
+        fasta_fp = os.path.join(tmp_dir, "scaled.fasta")
+        blast_fp = os.path.join(tmp_dir, "scaled_blast.txt")
+        for scale in scales:
+            write_scaled_input(pairs, scale, fasta_fp, blast_fp)
+            runs.append(benchmark_input(
+                "all_datasets", scale, fasta_fp, blast_fp, tmp_dir,
+                taxonomy_args))
+            report(runs[-1])
+            os.remove(fasta_fp)
+            os.remove(blast_fp)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    results = {
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "backend": opts.backend,
+        "num_taxa": opts.num_taxa,
+        "runs": runs,
+        }
+    if opts.output_fp:
+        with open(opts.output_fp, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    else:
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write("\n")
+
+
+if __name__ == "__main__":
+    main()
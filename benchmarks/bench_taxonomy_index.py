@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+"""Compare taxonomy lookups in a taxonomy index and a SQLite database.
+
+Builds a synthetic taxonomy and GI mapping, loads it into a SQLite
+database (with and without precomputed lineages) and a taxonomy index,
+then times opening each one, looking up taxon IDs for random GI
+numbers, and retrieving lineages for random taxa.
+"""
+import optparse
+import os
+import random
+import shutil
+import tempfile
+import time
+from StringIO import StringIO
+
+from brocclib.taxonomy_db import (
+    bulk_load, insert_lineages, taxonomy_rows, NcbiTaxonomyDb,
+    )
+from brocclib.taxonomy_index import compile_index, TaxonomyIndex
+
+RANKS = [
+    "superkingdom", "kingdom", "phylum", "class", "order", "family",
+    "genus", "species"]
+MAX_DEPTH = 35
+
+
+def synthetic_dumps(num_taxa, num_gis, seed=0, gi_nums=None):
+    """Return gi_taxid, nodes.dmp, and names.dmp files for a random tree.
+
+    GI numbers are drawn at random, unless a sorted list is given.
+    """
+    rand = random.Random(seed)
+    nodes = ["1\t|\t1\t|\tno rank\t|\n"]
+    names = ["1\t|\troot\t|\t\t|\tscientific name\t|\n"]
+    depths = {1: 0}
+    # Parents are drawn from recent taxa above the maximum depth, giving
+    # a tree about as deep as the NCBI taxonomy.
+    parents = [1]
+    for tax_id in xrange(2, num_taxa + 1):
+        parent_id = rand.choice(parents[-1000:])
+        depth = depths[parent_id] + 1
+        depths[tax_id] = depth
+        if depth < MAX_DEPTH:
+            parents.append(tax_id)
+        # Ranks are assigned on the way down, with unranked taxa between
+        rank = RANKS[depth // 4] if depth // 4 < len(RANKS) else "no rank"
+        if depth % 4:
+            rank = "no rank"
+        nodes.append("%d\t|\t%d\t|\t%s\t|\n" % (tax_id, parent_id, rank))
+        names.append("%d\t|\tTaxon %d\t|\t\t|\tscientific name\t|\n" % (
+            tax_id, tax_id))
+    if gi_nums is None:
+        gi_nums = sorted(rand.sample(xrange(1, 50 * num_gis), num_gis))
+    gi_taxid = "".join(
+        "%s\t%d\n" % (gi, rand.randint(2, num_taxa)) for gi in gi_nums)
+    return gi_taxid, "".join(nodes), "".join(names), gi_nums
+
+
+def time_backend(label, open_fcn, gi_queries, taxon_queries):
+    start = time.time()
+    db = open_fcn()
+    open_time = time.time() - start
+
+    start = time.time()
+    for gi in gi_queries:
+        db.get_taxon_id(gi)
+    taxon_id_time = time.time() - start
+
+    start = time.time()
+    for taxon_id in taxon_queries:
+        db.get_lineage(taxon_id)
+    lineage_time = time.time() - start
+
+    print "%-20s %10.2f %14.1f %14.1f" % (
+        label, open_time * 1e3,
+        1e6 * taxon_id_time / len(gi_queries),
+        1e6 * lineage_time / len(taxon_queries))
+
+
+def main(argv=None):
+    p = optparse.OptionParser()
+    p.add_option("--num_taxa", type="int", default=100000)
+    p.add_option("--num_gis", type="int", default=1000000)
+    p.add_option("--num_lookups", type="int", default=20000)
+    opts, args = p.parse_args(argv)
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        gi_taxid, nodes, names, gi_nums = synthetic_dumps(
+            opts.num_taxa, opts.num_gis)
+
+        def tables():
+            return taxonomy_rows(
+                StringIO(gi_taxid), StringIO(nodes), StringIO(names))
+
+        db_fp = os.path.join(tmp_dir, "taxonomy.db")
+        lineages_db_fp = os.path.join(tmp_dir, "lineages.db")
+        index_fp = os.path.join(tmp_dir, "taxonomy.idx")
+
+        start = time.time()
+        bulk_load(db_fp, tables())
+        print "Built SQLite database in %.1f s, %.1f MB" % (
+            time.time() - start, os.path.getsize(db_fp) / 1e6)
+        shutil.copy(db_fp, lineages_db_fp)
+        insert_lineages(lineages_db_fp)
+        start = time.time()
+        compile_index(index_fp, tables())
+        print "Built taxonomy index in %.1f s, %.1f MB" % (
+            time.time() - start, os.path.getsize(index_fp) / 1e6)
+
+        rand = random.Random(1)
+        gi_queries = [
+            str(rand.choice(gi_nums)) for _ in xrange(opts.num_lookups)]
+        taxon_queries = [
+            rand.randint(2, opts.num_taxa) for _ in xrange(opts.num_lookups)]
+
+        print
+        print "%-20s %10s %14s %14s" % (
+            "", "open (ms)", "taxon ID (us)", "lineage (us)")
+        time_backend(
+            "SQLite", lambda: NcbiTaxonomyDb(db_fp),
+            gi_queries, taxon_queries)
+        time_backend(
+            "SQLite + lineages", lambda: NcbiTaxonomyDb(lineages_db_fp),
+            gi_queries, taxon_queries)
+        time_backend(
+            "Taxonomy index", lambda: TaxonomyIndex(index_fp),
+            gi_queries, taxon_queries)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,7 @@
 from __future__ import division
 
-from brocclib.taxonomy import Lineage, NoLineage
+from brocclib.parse import BlastHits
+from brocclib.taxonomy import Lineage, NoLineage, LineageCache
 
 '''
 Created on Aug 29, 2011
@@ -14,7 +15,7 @@ class AssignmentCandidate(object):
         self.rank = rank
 
         is_high_rank = rank in ["phylum", "kingdom", "domain"]
-        is_descended_from_missing_taxon = any("(" in h for h in self.all_taxa)
+        is_descended_from_missing_taxon = lineage.has_paren_taxon(rank)
         if is_high_rank and not is_descended_from_missing_taxon:
             self.legit = True
         else:
@@ -71,7 +72,9 @@ class Assigner(object):
         ]
 
     def __init__(self, min_cover, species_min_id, genus_min_id, min_id,
-                 consensus_thresholds, max_generic, taxa_db):
+                 consensus_thresholds, max_generic, taxa_db,
+                 lineage_cache_size=10000, gi_lineages=None,
+                 generic_taxa=None):
         self.min_cover = min_cover
         self.rank_min_ids = [
             species_min_id, genus_min_id, min_id, min_id,
@@ -81,24 +84,31 @@ class Assigner(object):
         self.consensus_thresholds = consensus_thresholds
         self.max_generic = max_generic
         self.taxa_db = taxa_db
+        self.lineage_cache = LineageCache(lineage_cache_size)
+        # Optional dict of lineages by GI number, filled in as we go
+        self.gi_lineages = gi_lineages
+        self.generic_taxa = generic_taxa
 
     def _quality_filter(self, seq, hits):
-        hits_to_keep = []
+        idxs_to_keep = []
         num_low_coverage = 0
-        for hit in hits:
-            identity_is_ok = (hit.pct_id >= self.min_id)
-            coverage_is_ok = (hit.coverage(seq) >= self.min_cover)
+        query_len = len(seq)
+        for i in xrange(len(hits)):
+            identity_is_ok = (hits.pct_ids[i] >= self.min_id)
+            coverage_is_ok = (hits.lengths[i] / query_len >= self.min_cover)
 
             if identity_is_ok and coverage_is_ok:
-                hits_to_keep.append(hit)
+                idxs_to_keep.append(i)
 
             elif identity_is_ok and not coverage_is_ok:
                 num_low_coverage += 1
 
         frac_low_coverage = num_low_coverage / len(hits)
-        return hits_to_keep, frac_low_coverage
+        return hits.take(idxs_to_keep), frac_low_coverage
 
     def assign(self, name, seq, hits):
+        if not isinstance(hits, BlastHits):
+            hits = BlastHits.from_hits(hits)
         if not hits:
             return NoAssignment(name, "No hits found in database")
         hits_to_keep, frac_low_coverage = self._quality_filter(seq, hits)
@@ -108,21 +118,39 @@ class Assigner(object):
             return NoAssignment(name, "All BLAST hits were filtered for low quality.")
         return self.vote(name, seq, hits_to_keep)
 
-    def _retrieve_lineage(self, hit):
-        taxid = self.taxa_db.get_taxon_id(hit.gi)
+    def _retrieve_lineage(self, gi):
+        if self.gi_lineages is None:
+            return self._lookup_lineage(gi)
+        lineage = self.gi_lineages.get(gi)
+        if lineage is None:
+            lineage = self._lookup_lineage(gi)
+            self.gi_lineages[gi] = lineage
+        return lineage
+
+    def _lookup_lineage(self, gi):
+        taxid = self.taxa_db.get_taxon_id(gi)
         if taxid is None:
             return NoLineage()
-        raw_lineage = self.taxa_db.get_lineage(taxid)
-        if raw_lineage is None:
-            return NoLineage()
-        return Lineage(raw_lineage)
+        lineage = self.lineage_cache.get(taxid)
+        if lineage is None:
+            raw_lineage = self.taxa_db.get_lineage(taxid)
+            if raw_lineage is None:
+                lineage = NoLineage()
+            else:
+                lineage = Lineage(raw_lineage, self.generic_taxa)
+            self.lineage_cache.put(taxid, lineage)
+        return lineage
 
     def vote(self, name, seq, hits):
         # Sort hits by percent ID.  This affects the way that ties are broken.
-        hits.sort(reverse=True, key=lambda x: x.pct_id)
-        hits_lineage = [(hit, self._retrieve_lineage(hit)) for hit in hits]
-        for rank in self.ranks:
-            a = self.vote_at_rank(name, rank, hits_lineage)
+        idxs = sorted(
+            xrange(len(hits)), reverse=True, key=hits.pct_ids.__getitem__)
+        hits_lineage = [
+            (hits.pct_ids[i], self._retrieve_lineage(hits.gis[i]))
+            for i in idxs]
+        tallies = self._tally(hits_lineage)
+        for rank_idx, (candidates, num_generic) in enumerate(tallies):
+            a = self._decide(name, rank_idx, candidates, num_generic)
             if a is not None:
                 return a
         return NoAssignment(
@@ -131,29 +159,47 @@ class Assigner(object):
     def vote_at_rank(self, query_id, rank, db_hits):
         '''Votes at a given rank of the taxonomy.'''
         rank_idx = self.ranks.index(rank)
-        min_pct_id = self.rank_min_ids[rank_idx]
-        consensus_threshold = self.consensus_thresholds[rank_idx]
-
-        # Cast votes and count generic taxa
-        candidates = dict()
-        num_generic = 0
-        for hit, lineage in db_hits:
-            if hit.pct_id <= min_pct_id:
-                continue
-            taxon = lineage.get_taxon(rank)
-            if taxon is None:
-                continue
-            if taxon not in candidates:
-                candidates[taxon] = AssignmentCandidate(lineage, rank)
-            candidates[taxon].votes += 1
-
-            if lineage.classified is False:
-                num_generic += 1
-
+        candidates, num_generic = self._tally(db_hits)[rank_idx]
+        return self._decide(query_id, rank_idx, candidates, num_generic)
+
+    def _tally(self, db_hits):
+        """Cast votes and count generic taxa at all ranks.
+
+        Makes a single pass over the hits, which are given as
+        (pct_id, lineage) pairs.  Returns a (candidates, num_generic)
+        pair for each rank, where the candidates are a dict of
+        [votes, lineage] lists by taxon.  The lineage is taken from
+        the first hit to vote for the taxon.
+        """
+        rank_idxs = range(len(self.ranks))
+        all_candidates = [dict() for _ in rank_idxs]
+        all_num_generic = [0 for _ in rank_idxs]
+        for pct_id, lineage in db_hits:
+            taxa = lineage.taxa
+            for i in rank_idxs:
+                if pct_id <= self.rank_min_ids[i]:
+                    continue
+                taxon = taxa[i]
+                if taxon is None:
+                    continue
+                candidate = all_candidates[i].get(taxon)
+                if candidate is None:
+                    all_candidates[i][taxon] = [1, lineage]
+                else:
+                    candidate[0] += 1
+
+                if lineage.classified is False:
+                    all_num_generic[i] += 1
+        return zip(all_candidates, all_num_generic)
+
+    def _decide(self, query_id, rank_idx, candidates, num_generic):
+        """Pick the winning candidate at a rank, if there is consensus."""
         if len(candidates) == 0:
             return None
 
-        total_votes = sum(c.votes for c in candidates.values())
+        rank = self.ranks[rank_idx]
+        consensus_threshold = self.consensus_thresholds[rank_idx]
+        total_votes = sum(votes for votes, _ in candidates.values())
 
         # Do not count the votes for generic candidates in the total,
         # when the proportion of generic votes is allowable.  There
@@ -163,14 +209,15 @@ class Assigner(object):
             total_votes = total_votes - num_generic
 
         sorted_candidates = candidates.values()
-        sorted_candidates.sort(reverse=True, key=lambda c: c.votes)
-        winning_candidate = sorted_candidates.pop(0)
+        sorted_candidates.sort(reverse=True, key=lambda c: c[0])
+        winning_candidate = self._make_candidate(sorted_candidates.pop(0), rank)
 
         # If the winner is a bad classification, consider the runner up.
         if not winning_candidate.legit:
             if not sorted_candidates:
                 return None
-            winning_candidate = sorted_candidates.pop(0)
+            winning_candidate = self._make_candidate(
+                sorted_candidates.pop(0), rank)
             # If the runner up is also a bad classification, give up.
             if not winning_candidate.legit:
                 return None
@@ -179,3 +226,10 @@ class Assigner(object):
             return Assignment(query_id, winning_candidate, total_votes, num_generic)
         else:
             return None
+
+    @staticmethod
+    def _make_candidate(tally, rank):
+        votes, lineage = tally
+        candidate = AssignmentCandidate(lineage, rank)
+        candidate.votes = votes
+        return candidate
@@ -1,12 +1,27 @@
 from __future__ import division
 
+from collections import deque
 import logging
+import multiprocessing
 import optparse
 import os
+import re
+import time
 
 from brocclib.assign import Assigner
-from brocclib.get_xml import NcbiEutils
-from brocclib.parse import iter_fasta, read_blast
+from brocclib.get_xml import NcbiEutils, EutilsClient, RateLimiter, ncbi_rate
+from brocclib.gi_lineages import load_gi_lineages, save_gi_lineages
+from brocclib.taxonomy_db import NcbiTaxonomyDb
+from brocclib.taxonomy import GenericTaxa
+from brocclib.taxonomy_index import TaxonomyIndex
+from brocclib.taxonomy_server import TaxonomyClient
+from brocclib.parse import (
+    iter_fasta, iter_blast, iter_blast_queries, iter_query_hits,
+    BlastHits, UnsortedBlastError, open_input, BlastColumns,
+    merge_blast_queries, iter_blast_query_lengths, blast_format,
+    iter_blast_xml, iter_blast_xml_queries, has_query_lengths,
+    )
+from brocclib.stats import RunStats, ProfiledAssigner, TimedTaxonomy
 
 
 '''
@@ -26,6 +41,9 @@ CONSENSUS_THRESHOLDS = [
     ("domain", 0.9),
     ]
 
+# Number of queries sent to a worker process at a time
+CHUNK_SIZE = 200
+
 
 def parse_args(argv=None):
     parser = optparse.OptionParser(description=(
@@ -48,13 +66,66 @@ def parse_args(argv=None):
         "before query cannot be classified [default: %default]"))
     parser.add_option("--cache_fp", help=(
         "Filepath for retaining data retrieved from NCBI between runs.  "
-        "Can help to reduce execution time if BROCC is run several times."))
+        "Can help to reduce execution time if BROCC is run several times.  "
+        "The file may be shared by several runs at once.  Cache files in "
+        "the JSON format of previous versions are converted on first use."))
+    parser.add_option("--ncbi_batch_size", type="int", default=100, help=(
+        "number of IDs to look up in each request to NCBI "
+        "[default: %default]"))
+    parser.add_option("--ncbi_workers", type="int", default=1, help=(
+        "number of concurrent requests to NCBI.  The overall request "
+        "rate is limited to that allowed by NCBI [default: %default]"))
+    parser.add_option("--ncbi_api_key", help=(
+        "NCBI API key, which allows for a higher rate of requests"))
+    parser.add_option("--taxonomy_db_fp", help=(
+        "SQLite database of the NCBI taxonomy, created with "
+        "create_ncbi_taxonomy_db.py.  If provided, taxonomic information "
+        "is looked up in the database rather than retrieved from NCBI."))
+    parser.add_option("--taxonomy_index_fp", help=(
+        "Binary index of the NCBI taxonomy, created with "
+        "create_taxonomy_index.py.  Like --taxonomy_db_fp, but faster "
+        "to open and to search."))
+    parser.add_option("--taxonomy_server", help=(
+        "address of a taxonomy server started with "
+        "brocc_taxonomy_server.py, either the path of a Unix socket or "
+        "host:port.  If provided, taxonomic information is looked up in "
+        "the server, which may be shared by many jobs at once."))
+    parser.add_option("--gi_lineages_fp", help=(
+        "File of lineages by GI number, kept between runs.  If the file "
+        "exists, lineages are read from it rather than looked up.  "
+        "Lineages for new GI numbers are added to the file after the "
+        "run, if only one process is used.  The file is only valid for "
+        "the taxonomy source and generic taxa it was made with."))
+    parser.add_option("--generic_taxa_fp", help=(
+        "file of generic species names, such as 'uncultured fungus', one "
+        "per line, to use in place of the built-in list.  Lines starting "
+        "with 'regex:' hold a regular expression that must match the "
+        "whole name, e.g. 'regex:uncultured .*'"))
+    parser.add_option("--lineage_cache_size", type="int", default=10000, help=(
+        "maximum number of taxa to keep in memory while classifying "
+        "[default: %default]"))
+    parser.add_option("-p", "--processes", type="int", default=1, help=(
+        "number of processes used to classify queries.  Works best with "
+        "a local taxonomy database or a cache file [default: %default]"))
+    parser.add_option("--profile", "--stats_json", action="store_true",
+        dest="profile", help=(
+        "record the time spent in each stage of the run, with counts of "
+        "queries, hits, and lookups, and write them to brocc_stats.json "
+        "in the output directory.  Per-query times are only recorded "
+        "with one process"))
     parser.add_option("-v", "--verbose", action="store_true",
         help="output message after every query sequence is classified")
     parser.add_option("-i", "--input_fasta_file", dest="fasta_file",
-        help="input fasta file of query sequences [REQUIRED]")
+        help=("input fasta file of query sequences.  Not needed for BLAST "
+              "XML output, or if the tabular BLAST output has a query "
+              "length (qlen) column"))
     parser.add_option("-b", "--input_blast_file", dest="blast_file",
-        help="input blast file [REQUIRED]")
+        help=("input blast file, in tabular (6 or 7) or XML (5) format, "
+              "which is detected automatically [REQUIRED]"))
+    parser.add_option("--blast_columns", help=(
+        "columns of a tabular BLAST file without a '# Fields:' line, as "
+        "given to blastn -outfmt, e.g. '6 qseqid sseqid pident length "
+        "qlen'. [default: the standard tabular columns]"))
     parser.add_option("-o", "--output_directory",
         help="output directory [REQUIRED]")
     parser.add_option("-a", "--amplicon", help=(
@@ -75,9 +146,77 @@ def parse_args(argv=None):
         if not (opts.min_species_id and opts.min_genus_id):
             parser.error("Must specify --amplicon, or provide both --min_species_id and --min_genus_id.")
 
+    try:
+        opts.blast_columns = BlastColumns.from_outfmt(opts.blast_columns or "")
+    except ValueError as e:
+        parser.error(str(e))
+
+    opts.blast_format = None
+    if opts.blast_file:
+        opts.blast_format = blast_format(opts.blast_file)
+        # Without the sequences, query lengths come from the BLAST file
+        if (not opts.fasta_file) and (opts.blast_format == "tabular"):
+            with open_input(opts.blast_file) as f:
+                if not has_query_lengths(f, opts.blast_columns):
+                    parser.error(
+                        "No query length (qlen) column in the BLAST file.  "
+                        "Please provide the query sequences with -i, or "
+                        "add a qlen column to the BLAST output.")
+
+    opts.generic_taxa = None
+    if opts.generic_taxa_fp:
+        try:
+            with open(opts.generic_taxa_fp) as f:
+                opts.generic_taxa = GenericTaxa.parse(f)
+        except (IOError, re.error) as e:
+            parser.error("Could not read generic taxa from %s: %s" % (
+                opts.generic_taxa_fp, e))
+
     return opts
 
 
+def make_taxa_db(opts, rate_limiter=None):
+    if opts.taxonomy_server:
+        return TaxonomyClient(opts.taxonomy_server)
+    return open_taxa_db(opts, rate_limiter)
+
+
+def open_taxa_db(opts, rate_limiter=None):
+    """Open a local taxonomy source, or the NCBI web service.
+
+    Requests to NCBI are limited by the rate limiter, if one is given.
+    """
+    if opts.taxonomy_index_fp:
+        return TaxonomyIndex(opts.taxonomy_index_fp)
+    if opts.taxonomy_db_fp:
+        return NcbiTaxonomyDb(opts.taxonomy_db_fp)
+    client = EutilsClient(api_key=opts.ncbi_api_key, rate_limiter=rate_limiter)
+    taxa_db = NcbiEutils(
+        opts.cache_fp, client, opts.ncbi_batch_size, opts.ncbi_workers)
+    taxa_db.load_cache()
+    return taxa_db
+
+
+def read_gi_lineages(opts):
+    """Load the GI lineage file, if one is given."""
+    if not opts.gi_lineages_fp:
+        return None
+    if not os.path.exists(opts.gi_lineages_fp):
+        return {}
+    return load_gi_lineages(opts.gi_lineages_fp)
+
+
+def make_assigner(opts, taxa_db, stats=None, gi_lineages=None):
+    consensus_thresholds = [t for _, t in CONSENSUS_THRESHOLDS]
+    args = (
+        opts.min_cover, opts.min_species_id, opts.min_genus_id, opts.min_id,
+        consensus_thresholds, opts.max_generic, taxa_db,
+        opts.lineage_cache_size, gi_lineages, opts.generic_taxa)
+    if stats is not None:
+        return ProfiledAssigner(*args, stats=stats)
+    return Assigner(*args)
+
+
 def main(argv=None):
     opts = parse_args(argv)
 
@@ -88,50 +227,225 @@ def main(argv=None):
     else:
         logging.basicConfig(level=logging.WARNING)
     
-    taxa_db = NcbiEutils(opts.cache_fp)
-    taxa_db.load_cache()
+    stats = None
+    if opts.profile:
+        stats = RunStats()
 
-    consensus_thresholds = [t for _, t in CONSENSUS_THRESHOLDS]
-    assigner = Assigner(
-        opts.min_cover, opts.min_species_id, opts.min_genus_id, opts.min_id,
-        consensus_thresholds, opts.max_generic, taxa_db)
-
-    # Read input files
-    
-    with open(opts.fasta_file) as f:
-        sequences = list(iter_fasta(f))
+    gi_lineages = read_gi_lineages(opts)
+    num_gi_lineages = len(gi_lineages or ())
 
-    with open(opts.blast_file) as f:
-        blast_hits = read_blast(f)
+    rate_limiter = None
+    if opts.processes > 1:
+        # One limit on the rate of requests to NCBI, for all processes
+        rate_limiter = RateLimiter(ncbi_rate(opts.ncbi_api_key), shared=True)
+    taxa_db = make_taxa_db(opts, rate_limiter)
+    if isinstance(taxa_db, (NcbiEutils, TaxonomyClient)):
+        start = time.time()
+        with open_input(opts.blast_file) as f:
+            taxa_db.prefetch(
+                hit.gi for _, hit in iter_blast_hits(opts, f)
+                if (hit.pct_id >= opts.min_id) and
+                not (gi_lineages and hit.gi in gi_lineages))
+        if stats is not None:
+            stats.add_time("prefetch", time.time() - start)
 
-    # Open output files
+    if stats is not None:
+        assigner = make_assigner(
+            opts, TimedTaxonomy(taxa_db, stats), stats, gi_lineages)
+    else:
+        assigner = make_assigner(opts, taxa_db, gi_lineages=gi_lineages)
 
     if not os.path.exists(opts.output_directory):
         os.mkdir(opts.output_directory)
-    output_file = open(
-        os.path.join(opts.output_directory, "Full_Taxonomy.txt"), 'w')
-    standard_taxa_file = open(
-        os.path.join(opts.output_directory, "Standard_Taxonomy.txt"), "w")
-    log_file = open(os.path.join(opts.output_directory, "brocc.log"), "w")
-    log_file.write(
-        "Sequence\tWinner_Votes\tVotes_Cast\tGenerics_Pruned\tLevel\t"
-        "Classification\n")
 
     # Do the work
 
-    for name, seq in sequences:
-        seq_hits = blast_hits[name]
+    def classify(queries):
+        if stats is not None:
+            stats.start_pass()
+            queries = stats.iter_queries(queries)
+        if opts.processes > 1:
+            results = iter_parallel_assignments(opts, taxa_db, queries)
+        else:
+            results = iter_assignments(assigner, queries)
+        if stats is None:
+            write_assignments(results, opts.output_directory)
+        else:
+            start = time.time()
+            write_assignments(
+                stats.iter_timed("results", results), opts.output_directory)
+            stats.add_time("classify", time.time() - start)
+
+    if opts.fasta_file:
+        classify_fasta_queries(opts, classify)
+    else:
+        classify_blast_queries(opts, classify)
+
+    if opts.processes == 1:
+        logging.info("Lineage cache: %s hits, %s misses" % (
+            assigner.lineage_cache.hits, assigner.lineage_cache.misses))
+
+    if isinstance(taxa_db, NcbiEutils):
+        taxa_db.save_cache()
+    elif isinstance(taxa_db, TaxonomyClient):
+        taxa_db.close()
+
+    if (gi_lineages is not None) and (len(gi_lineages) > num_gi_lineages):
+        save_gi_lineages(opts.gi_lineages_fp, gi_lineages)
+
+    if stats is not None:
+        stats_fp = os.path.join(opts.output_directory, "brocc_stats.json")
+        if opts.processes == 1:
+            stats.write(stats_fp, assigner, assigner.taxa_db)
+        else:
+            stats.write(stats_fp, taxa_db=taxa_db)
+
+
+def iter_blast_hits(opts, blast_f):
+    if opts.blast_format == "xml":
+        return iter_blast_xml(blast_f)
+    return iter_blast(blast_f, opts.blast_columns)
+
+
+def iter_blast_file_queries(opts, blast_f):
+    if opts.blast_format == "xml":
+        return iter_blast_xml_queries(blast_f)
+    return iter_blast_queries(blast_f, opts.blast_columns)
+
+
+def classify_fasta_queries(opts, classify):
+    # Only the length of each query sequence is needed
+    with open_input(opts.fasta_file) as fasta_f, \
+            open_input(opts.blast_file) as blast_f:
+        # BLAST results for queries not in the FASTA file are skipped
+        query_names = set(
+            name for name, _ in iter_fasta(fasta_f, lengths_only=True))
+        fasta_f.seek(0)
+        try:
+            classify(iter_query_hits(
+                iter_fasta(fasta_f, lengths_only=True),
+                iter_blast_file_queries(opts, blast_f), query_names))
+        except UnsortedBlastError as e:
+            # Start over, reading all the BLAST hits into memory
+            logging.warning("%s, re-reading all BLAST results" % e)
+            fasta_f.seek(0)
+            blast_f.seek(0)
+            blast_hits = dict(merge_blast_queries(
+                iter_blast_file_queries(opts, blast_f)))
+            classify(
+                (name, seq, blast_hits.get(name, []))
+                for name, seq in iter_fasta(fasta_f, lengths_only=True))
+
+
+def classify_blast_queries(opts, classify):
+    # Query lengths are taken from the BLAST file
+    with open_input(opts.blast_file) as blast_f:
+        try:
+            classify(iter_blast_query_lengths(
+                iter_blast_file_queries(opts, blast_f)))
+        except UnsortedBlastError as e:
+            logging.warning("%s, re-reading all BLAST results" % e)
+            blast_f.seek(0)
+            classify(iter_blast_query_lengths(merge_blast_queries(
+                iter_blast_file_queries(opts, blast_f))))
+
+
+def _format_assignment(a):
+    return (
+        a.format_for_full_taxonomy(), a.format_for_standard_taxonomy(),
+        a.format_for_log())
+
+
+def iter_assignments(assigner, queries):
+    """Assign each query, yield the formatted results."""
+    for name, seq, seq_hits in queries:
         # This is where the magic happens
         a = assigner.assign(name, seq, seq_hits)
+        yield _format_assignment(a)
+
+
+# Assigner for each worker process
+_worker_assigner = None
+
+
+def _init_worker(opts, taxon_ids, lineages, rate_limiter):
+    global _worker_assigner
+    taxa_db = make_taxa_db(opts, rate_limiter)
+    if isinstance(taxa_db, (NcbiEutils, TaxonomyClient)):
+        # Start with the data retrieved by the main process.
+        taxa_db.taxon_ids.update(taxon_ids)
+        taxa_db.lineages.update(lineages)
+    _worker_assigner = make_assigner(
+        opts, taxa_db, gi_lineages=read_gi_lineages(opts))
+
+
+def _assign_chunk(chunk):
+    return list(iter_assignments(_worker_assigner, chunk))
+
+
+def _iter_chunks(queries, chunk_size):
+    chunk = []
+    for name, seq, seq_hits in queries:
+        if not isinstance(seq_hits, BlastHits):
+            seq_hits = BlastHits.from_hits(seq_hits)
+        chunk.append((name, seq, seq_hits))
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def iter_parallel_assignments(opts, taxa_db, queries, chunk_size=None):
+    """Assign queries in a pool of worker processes.
 
-        output_file.write(a.format_for_full_taxonomy())
-        standard_taxa_file.write(a.format_for_standard_taxonomy())
-        log_file.write(a.format_for_log())
+    Queries are sent to the workers in chunks, and the formatted
+    results are yielded in the same order as the queries.  Only a few
+    chunks are in progress at a time, so that memory use is bounded.
+    """
+    if chunk_size is None:
+        chunk_size = CHUNK_SIZE
+    taxon_ids = {}
+    lineages = {}
+    rate_limiter = None
+    if isinstance(taxa_db, (NcbiEutils, TaxonomyClient)):
+        taxon_ids = taxa_db.taxon_ids
+        lineages = taxa_db.lineages
+    if isinstance(taxa_db, NcbiEutils):
+        # Workers inherit the limit on requests to NCBI
+        rate_limiter = taxa_db.client.rate_limiter
+    pool = multiprocessing.Pool(
+        opts.processes, _init_worker,
+        (opts, taxon_ids, lineages, rate_limiter))
+    try:
+        pending = deque()
+        for chunk in _iter_chunks(queries, chunk_size):
+            pending.append(pool.apply_async(_assign_chunk, (chunk,)))
+            if len(pending) > 2 * opts.processes:
+                for result in pending.popleft().get():
+                    yield result
+        while pending:
+            for result in pending.popleft().get():
+                yield result
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
 
-    # Close output files, write cache
 
-    output_file.close()
-    standard_taxa_file.close()
-    log_file.close()
+def write_assignments(results, output_dir):
+    """Write formatted results as soon as they are ready."""
+    full_taxa_fp = os.path.join(output_dir, "Full_Taxonomy.txt")
+    standard_taxa_fp = os.path.join(output_dir, "Standard_Taxonomy.txt")
+    log_fp = os.path.join(output_dir, "brocc.log")
+    with open(full_taxa_fp, "w") as output_file, \
+            open(standard_taxa_fp, "w") as standard_taxa_file, \
+            open(log_fp, "w") as log_file:
+        log_file.write(
+            "Sequence\tWinner_Votes\tVotes_Cast\tGenerics_Pruned\tLevel\t"
+            "Classification\n")
 
-    taxa_db.save_cache()
+        for full_taxa, standard_taxa, log in results:
+            output_file.write(full_taxa)
+            standard_taxa_file.write(standard_taxa)
+            log_file.write(log)
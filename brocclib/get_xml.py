@@ -1,86 +1,387 @@
+import fcntl
 import json
 import urllib2, os, StringIO
 from xml.etree import ElementTree as ET
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 import logging
+import sqlite3
+import threading
+import time
+
+from brocclib.taxonomy import intern_taxon, intern_lineage_dict
+
+
+EUTILS_URL = "http://eutils.ncbi.nlm.nih.gov/entrez/eutils/"
+
+# Requests per second allowed by NCBI, without and with an API key
+NCBI_RATE = 3
+NCBI_API_KEY_RATE = 10
+
+
+def ncbi_rate(api_key=None):
+    """Return the number of requests per second allowed by NCBI."""
+    return NCBI_API_KEY_RATE if api_key else NCBI_RATE
+
+
+class RateLimiter(object):
+    """Token bucket limiting the rate of requests across threads.
+
+    If shared, the bucket is kept in shared memory, and also limits
+    the rate across processes started after the limiter is made.
+    """
+    def __init__(self, rate, burst=1, shared=False):
+        self.rate = float(rate)
+        self.burst = burst
+        # Tokens, and the time they were last updated
+        if shared:
+            self.lock = multiprocessing.Lock()
+            self.state = multiprocessing.Array(
+                "d", [burst, time.time()], lock=False)
+        else:
+            self.lock = threading.Lock()
+            self.state = [burst, time.time()]
+
+    def wait(self):
+        """Block until a request may be made."""
+        while True:
+            with self.lock:
+                tokens, last_update = self.state
+                now = time.time()
+                tokens = min(
+                    self.burst, tokens + (now - last_update) * self.rate)
+                if tokens >= 1:
+                    self.state[:] = [tokens - 1, now]
+                    return
+                self.state[:] = [tokens, now]
+                delay = (1 - tokens) / self.rate
+            time.sleep(delay)
+
+
+class EutilsClient(object):
+    """Open E-utilities URLs, retrying failed requests with backoff.
+
+    The request rate is limited to NCBI's allowance, which is higher
+    with an API key.  A client may be shared between threads, and
+    clients in several processes may share one rate limiter.  The
+    numbers of requests, retries, and failed URLs are counted.
+    """
+    def __init__(self, base_url=EUTILS_URL, api_key=None, rate=None,
+                 max_tries=5, backoff=1.0, rate_limiter=None):
+        self.base_url = base_url
+        self.api_key = api_key
+        if rate_limiter is None:
+            if rate is None:
+                rate = ncbi_rate(api_key)
+            rate_limiter = RateLimiter(rate)
+        self.rate_limiter = rate_limiter
+        self.max_tries = max_tries
+        self.backoff = backoff
+        self.requests = 0
+        self.retries = 0
+        self.failures = 0
+        self._count_lock = threading.Lock()
+
+    def _count(self, attr):
+        with self._count_lock:
+            setattr(self, attr, getattr(self, attr) + 1)
+
+    def url(self, utility, params):
+        url = "%s%s?%s" % (self.base_url, utility, params)
+        if self.api_key:
+            url += "&api_key=%s" % self.api_key
+        return url
+
+    def open(self, utility, params):
+        """Open a URL for an E-utility, such as efetch.fcgi.
+
+        Requests are retried on connection errors, server errors, and
+        when NCBI reports too many requests.  Other HTTP errors are
+        raised immediately.
+        """
+        url = self.url(utility, params)
+        for n in xrange(self.max_tries):
+            if n > 0:
+                time.sleep(self.backoff * (2 ** (n - 1)))
+                logging.debug("Retrying URL %s (attempt %s)" % (url, n + 1))
+                self._count("retries")
+            self.rate_limiter.wait()
+            self._count("requests")
+            try:
+                return urllib2.urlopen(url)
+            except urllib2.HTTPError as e:
+                # Don't keep trying if you gave a bad request
+                if (e.code != 429) and (e.code < 500):
+                    self._count("failures")
+                    raise e
+                logging.info("URL %s: %s" % (url, e))
+            except urllib2.URLError as e:
+                logging.info("URL %s: %s" % (url, e))
+        self._count("failures")
+        raise urllib2.URLError(
+            "Could not open URL %s (%s attempts)" % (url, self.max_tries))
+
+
+_default_client = EutilsClient()
+
+
+class EutilsCache(object):
+    """Cache of data retrieved from NCBI, kept in a SQLite database.
+
+    The database is opened on first use.  Values are looked up one
+    key at a time and written as soon as they are added, so that the
+    cache can be shared by several processes at once.
+    """
+    tables = ["taxon_ids", "lineages"]
+
+    def __init__(self, cache_fp):
+        self.cache_fp = cache_fp
+        self._conn = None
+
+    @property
+    def conn(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.cache_fp, timeout=60)
+            self._conn.executescript("".join(
+                "CREATE TABLE IF NOT EXISTS %s "
+                "(key TEXT NOT NULL PRIMARY KEY, value TEXT);\n" % t
+                for t in self.tables))
+        return self._conn
+
+    def get(self, table, key):
+        """Return a cached value, or raise KeyError if not found."""
+        row = self.conn.execute(
+            "SELECT value FROM %s WHERE key = ?" % table, (key,)).fetchone()
+        if row is None:
+            raise KeyError(key)
+        return json.loads(row[0])
+
+    def update(self, table, items):
+        """Add values from a dict to the cache."""
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO %s VALUES (?, ?)" % table,
+                ((k, json.dumps(v)) for k, v in items.items()))
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+
+def _is_json_file(fp):
+    with open(fp) as f:
+        return f.read(64).lstrip().startswith("{")
+
+
+def migrate_json_cache(cache_fp):
+    """Convert a JSON cache file from previous versions, in place.
+
+    Returns True if the file was converted.
+    """
+    if not (os.path.exists(cache_fp) and _is_json_file(cache_fp)):
+        return False
+    with open(cache_fp) as f:
+        # Other processes may be converting the same file.
+        fcntl.flock(f, fcntl.LOCK_EX)
+        if not _is_json_file(cache_fp):
+            return False
+        data = json.load(f)
+        temp_fp = "%s.%s.tmp" % (cache_fp, os.getpid())
+        cache = EutilsCache(temp_fp)
+        cache.update("taxon_ids", dict(data["taxon_ids"]))
+        cache.update(
+            "lineages", dict((x, dict(y)) for x, y in data["lineages"]))
+        cache.close()
+        os.rename(temp_fp, cache_fp)
+    return True
 
 
 class NcbiEutils(object):
-    def __init__(self, cache_fp=None):
+    def __init__(self, cache_fp=None, client=None, batch_size=100,
+                 num_workers=1):
         self.cache_fp = cache_fp
+        self.cache = None
+        if cache_fp is not None:
+            self.cache = EutilsCache(cache_fp)
+        if client is None:
+            client = _default_client
+        self.client = client
+        self.batch_size = batch_size
+        self.num_workers = num_workers
         self.lineages = {}
         self.taxon_ids = {}
-        self._fresh = True
+        self.cache_hits = 0
+        self.cache_misses = 0
 
     def get_lineage(self, taxon_id):
-        if taxon_id not in self.lineages:
-            self._fresh = False
-            self.lineages[taxon_id] = get_lineage(taxon_id)
+        if not self._is_cached("lineages", taxon_id):
+            lineage = get_lineage(taxon_id, self.client)
+            self._add_to_cache("lineages", {taxon_id: lineage})
         return self.lineages[taxon_id]
 
     def get_taxon_id(self, gi_num):
-        if gi_num not in self.taxon_ids:
-            self._fresh = False
-            self.taxon_ids[gi_num] = get_taxid(gi_num)
+        if not self._is_cached("taxon_ids", gi_num):
+            taxon_id = get_taxid(gi_num, self.client)
+            self._add_to_cache("taxon_ids", {gi_num: taxon_id})
         return self.taxon_ids[gi_num]
 
+    def _is_cached(self, table, key):
+        # Values from the cache file are kept in memory once found.
+        memory = getattr(self, table)
+        if key in memory:
+            self.cache_hits += 1
+            return True
+        if self.cache is not None:
+            try:
+                memory[key] = _intern_value(table, self.cache.get(table, key))
+                self.cache_hits += 1
+                return True
+            except KeyError:
+                pass
+        self.cache_misses += 1
+        return False
+
+    def _add_to_cache(self, table, items):
+        getattr(self, table).update(
+            (k, _intern_value(table, v)) for k, v in items.iteritems())
+        if self.cache is not None:
+            self.cache.update(table, items)
+
+    def prefetch(self, gi_nums):
+        """Retrieve taxon IDs and lineages for many GI numbers at once.
+
+        Requests are made in batches, for any GI numbers and taxon IDs
+        not already in the cache.  Batches are retrieved concurrently
+        if more than one worker is used.  If a batch request fails, its
+        IDs are left to be retrieved one at a time later on.
+        """
+        gi_nums = set(gi for gi in gi_nums if gi is not None)
+
+        new_gi_nums = sorted(
+            gi for gi in gi_nums if not self._is_cached("taxon_ids", gi))
+        for batch, taxon_ids in self._map_batches(get_taxids, new_gi_nums):
+            self._add_to_cache("taxon_ids", dict(
+                (gi_num, taxon_ids.get(gi_num)) for gi_num in batch))
+
+        taxon_ids = set(self.taxon_ids.get(gi) for gi in gi_nums)
+        new_taxon_ids = sorted(
+            t for t in taxon_ids
+            if (t is not None) and not self._is_cached("lineages", t))
+        for batch, lineages in self._map_batches(get_lineages, new_taxon_ids):
+            self._add_to_cache("lineages", dict(
+                (taxon_id, lineages.get(taxon_id)) for taxon_id in batch))
+
+    def _map_batches(self, fcn, ids):
+        """Apply a batch lookup function, return successful results."""
+        def lookup(batch):
+            try:
+                return batch, fcn(batch, self.client)
+            except Exception as e:
+                logging.info("Batch of %s IDs: %s" % (len(batch), e))
+                return batch, None
+
+        batches = list(_batches(ids, self.batch_size))
+        if (self.num_workers > 1) and (len(batches) > 1):
+            pool = ThreadPool(min(self.num_workers, len(batches)))
+            try:
+                results = pool.map(lookup, batches)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = [lookup(b) for b in batches]
+        return [(b, r) for b, r in results if r is not None]
+
     def load_cache(self):
+        """Prepare the cache file, converting it from JSON if needed.
+
+        Cached values are read from the file as they are needed.
+        """
         # Do nothing if there is no cache file
         if self.cache_fp is None:
             return None
-        if os.path.exists(self.cache_fp):
-            with open(self.cache_fp) as f:
-                data = json.load(f)
-                self.lineages = dict(
-                    (x, dict(y)) for x, y in data["lineages"])
-                self.taxon_ids = dict(data["taxon_ids"])
+        if migrate_json_cache(self.cache_fp):
+            logging.info("Converted JSON cache file %s" % self.cache_fp)
 
     def save_cache(self):
-        # Do nothing if there is no cache file
-        if self.cache_fp is None:
-            return None
-        # Do nothing if no lookups have been performed.
-        if self._fresh:
-            return None
+        """Close the cache file.
 
-        lineages = list(
-            (x, list(sorted(y.items()))) for x, y in self.lineages.items())
-        lineages.sort()
+        Values are saved to the file as soon as they are retrieved.
+        """
+        if self.cache is not None:
+            self.cache.close()
 
-        taxon_ids = list(self.taxon_ids.items())
-        taxon_ids.sort()
 
-        data = {
-            "lineages": lineages,
-            "taxon_ids": taxon_ids,
-            }
-        with open(self.cache_fp, "w") as f:
-            json.dump(data, f, indent=2, separators=(',', ': '))
+def _intern_value(table, value):
+    # Taxon IDs and names are shared, as many GI numbers have the same
+    # taxon, and many taxa have the same ancestors.
+    if table == "lineages":
+        return intern_lineage_dict(value)
+    return intern_taxon(value)
 
 
-def get_taxon_from_xml(xml_string):
-    taxon_dict = {}
+def _batches(xs, batch_size):
+    for i in xrange(0, len(xs), batch_size):
+        yield xs[i:i + batch_size]
+
+
+def _parse_xml(xml_string):
     xml_string_new = "".join(
         [s for s in xml_string.splitlines(True) if s.strip("\r\n")])
-    tree = ET.XML(xml_string_new)
-    lineage_elem = tree.find('Taxon/LineageEx')
+    return ET.XML(xml_string_new)
+
+
+def _get_taxon_from_elem(taxon_elem):
+    taxon_dict = {}
+    lineage_elem = taxon_elem.find('LineageEx')
     if lineage_elem is None:
-        raise ValueError("No lineage info found in XML:\n" + xml_string)
+        raise ValueError(
+            "No lineage info found in XML:\n" + ET.tostring(taxon_elem))
     for elem in list(lineage_elem):
         rank = elem.find('Rank').text
         name = elem.find('ScientificName').text
         taxon_dict[rank] = name
 
     # Include lowest rank in lineage
-    rank = tree.find('Taxon/Rank').text
+    rank = taxon_elem.find('Rank').text
     if rank not in taxon_dict:
-        taxon_dict[rank] = tree.find('Taxon/ScientificName').text
+        taxon_dict[rank] = taxon_elem.find('ScientificName').text
 
     # Also include the lineage as a string
-    taxon_dict['Lineage'] = tree.find('Taxon/Lineage').text
+    taxon_dict['Lineage'] = taxon_elem.find('Lineage').text
 
     return taxon_dict
 
 
+def get_taxon_from_xml(xml_string):
+    tree = _parse_xml(xml_string)
+    taxon_elem = tree.find('Taxon')
+    if (taxon_elem is None) or (taxon_elem.find('LineageEx') is None):
+        raise ValueError("No lineage info found in XML:\n" + xml_string)
+    return _get_taxon_from_elem(taxon_elem)
+
+
+def get_taxa_from_xml(xml_string):
+    """Parse all taxa in an XML response, return a dict by taxon ID.
+
+    Taxa are also listed under any previous IDs that were merged into
+    the current ID.
+    """
+    taxa = {}
+    tree = _parse_xml(xml_string)
+    for taxon_elem in tree.findall('Taxon'):
+        try:
+            taxon_dict = _get_taxon_from_elem(taxon_elem)
+        except ValueError as e:
+            logging.info(str(e))
+            continue
+        taxa[taxon_elem.find('TaxId').text] = taxon_dict
+        for elem in taxon_elem.findall('AkaTaxIds/TaxId'):
+            taxa[elem.text] = taxon_dict
+    return taxa
+
+
 def _get_xml_from_html(html_response):
     if not html_response.strip():
         raise ValueError("Empty HTML response")
@@ -99,54 +400,40 @@ def _get_xml_from_html(html_response):
         return s
 
 
-def get_lineage(taxid):
-    num_tries = 0 #numter of times db connection was attempted
-    while num_tries < 5:
-        try:        #watch out for db connection time out
-            url = 'http://eutils.ncbi.nlm.nih.gov/entrez/eutils/efetch.fcgi?db=taxonomy&id=' + taxid + '&rettype=xml'
-            xml = urllib2.urlopen(url)
-            xml_str = xml.read()
-            xml_string_from_html = _get_xml_from_html(xml_str)
-            taxon_dict = get_taxon_from_xml(xml_string_from_html)
-            return taxon_dict
-        except urllib2.HTTPError as e:
-            logging.info(str(e))
-            if e.code == 400:
-                return None
-            else:
-                num_tries += 1
-        except urllib2.URLError as e:
-            num_tries += 1
-            print e
-            print "Database connectiom timed out for taxon", taxid, "Will retry"
-        except Exception as e:
-            num_tries += 1
-            print e, "Will retry"
-    if num_tries == 5:
-        print "could not connect to db for taxon" + str(taxid)
-        print str(taxid) + " will not be considered"
+def get_lineage(taxid, client=None):
+    if client is None:
+        client = _default_client
+    try:
+        response = client.open(
+            'efetch.fcgi', 'db=taxonomy&id=%s&rettype=xml' % taxid)
+        xml_string_from_html = _get_xml_from_html(response.read())
+        return get_taxon_from_xml(xml_string_from_html)
+    except Exception as e:
+        logging.warning("Taxon %s will not be considered: %s" % (taxid, e))
         return None
 
 
-def url_open(url, max_tries=5):
-    for n in xrange(max_tries):
-        try:
-            return urllib2.urlopen(url)
-        except urllib2.HTTPError as e:
-            # Don't keep trying if you gave a bad request
-            if e.code == 400:
-                raise e
-            logging.debug("Retrying URL %s (attempt %s)" % (url, n))
-        except urllib2.URLError:
-            logging.debug("Retrying URL %s (attempt %s)" % (url, n))
-    raise urllib2.URLError("Could not open URL %s (%s attempts)" % (url, n))
-
-
-def get_taxid(gi_num):
-    url = 'http://eutils.ncbi.nlm.nih.gov/entrez/eutils/elink.fcgi?dbfrom=nucleotide&db=taxonomy&id=%s' % gi_num
+def get_lineages(taxids, client=None):
+    """Retrieve lineages for several taxon IDs in one request.
+
+    Returns a dict of lineages by taxon ID.  Taxon IDs not found in
+    the response are left out.
+    """
+    if client is None:
+        client = _default_client
+    response = client.open(
+        'efetch.fcgi', 'db=taxonomy&id=%s&rettype=xml' % ','.join(taxids))
+    xml_string_from_html = _get_xml_from_html(response.read())
+    return get_taxa_from_xml(xml_string_from_html)
+
+
+def get_taxid(gi_num, client=None):
+    if client is None:
+        client = _default_client
     xpath = ".//Link/Id"
     try:
-        response = url_open(url)
+        response = client.open(
+            'elink.fcgi', 'dbfrom=nucleotide&db=taxonomy&id=%s' % gi_num)
         xml = ET.parse(response)
         elem = xml.find(xpath)
         if elem is None:
@@ -157,3 +444,33 @@ def get_taxid(gi_num):
         logging.info("GI %s: %s" % (gi_num, e))
         return None
 
+
+def get_taxids(gi_nums, client=None):
+    """Retrieve taxon IDs for several GI numbers in one request.
+
+    Returns a dict of taxon IDs by GI number.  GI numbers without a
+    link to the taxonomy database are left out.  Accessions may be
+    given in place of GI numbers.
+    """
+    if client is None:
+        client = _default_client
+    gi_nums = list(gi_nums)
+    # Each ID is given as a separate parameter, so that the links are
+    # reported separately for each GI number.
+    response = client.open('elink.fcgi', 'dbfrom=nucleotide&db=taxonomy&%s' % (
+        '&'.join('id=%s' % gi_num for gi_num in gi_nums)))
+    xml = ET.parse(response)
+    linksets = xml.findall('LinkSet')
+    # For accessions, NCBI reports the GI number in the IdList.  The
+    # link sets are given in request order, so when there is one per
+    # ID, we use the IDs as requested.
+    request_ids = [None] * len(linksets)
+    if len(linksets) == len(gi_nums):
+        request_ids = gi_nums
+    taxids = {}
+    for request_id, linkset in zip(request_ids, linksets):
+        gi_elem = linkset.find('IdList/Id')
+        taxid_elem = linkset.find('LinkSetDb/Link/Id')
+        if (gi_elem is not None) and (taxid_elem is not None):
+            taxids[request_id or gi_elem.text] = taxid_elem.text
+    return taxids
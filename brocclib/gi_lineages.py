@@ -0,0 +1,63 @@
+"""Lineages by GI number, saved to a file between runs.
+
+Normally, each BLAST hit is resolved in two steps, from GI number to
+taxon ID and from taxon ID to lineage, and the lineage is built from
+the taxonomy source.  A GI lineage file skips both steps: it maps each
+GI number straight to a lineage record, with the taxa at each rank, the
+classified flag, and the full lineage.
+
+Records are stored once, along with the GI numbers that share them,
+and the file is written with marshal, which loads much faster than
+JSON.  When loaded, GI numbers with the same record share one Lineage
+object, so each hit needs a single dictionary lookup.
+
+The file is only valid for the taxonomy source and generic taxa it was
+made with.
+"""
+import marshal
+import os
+
+from brocclib.taxonomy import Lineage, NoLineage
+
+MAGIC = "BROCCGIL"
+VERSION = 1
+
+
+def load_gi_lineages(fp):
+    """Read a GI lineage file, return a dict of lineages by GI number."""
+    with open(fp, "rb") as f:
+        try:
+            magic, version, records, gi_groups = marshal.load(f)
+        except (EOFError, ValueError, TypeError):
+            raise ValueError("Not a GI lineage file: %s" % fp)
+    if magic != MAGIC:
+        raise ValueError("Not a GI lineage file: %s" % fp)
+    if version != VERSION:
+        raise ValueError(
+            "GI lineage file %s has version %s, expected %s" % (
+                fp, version, VERSION))
+    gi_lineages = {}
+    for record, gi_nums in zip(records, gi_groups):
+        if record is None:
+            lineage = NoLineage()
+        else:
+            lineage = Lineage.from_record(record)
+        gi_lineages.update(dict.fromkeys(gi_nums, lineage))
+    return gi_lineages
+
+
+def save_gi_lineages(fp, gi_lineages):
+    """Write a dict of lineages by GI number to a file.
+
+    The file is replaced in one step, so that other processes never
+    see a partly written file.
+    """
+    gi_groups = {}
+    for gi_num, lineage in gi_lineages.iteritems():
+        gi_groups.setdefault(lineage.to_record(), []).append(gi_num)
+    records = list(gi_groups)
+    data = (MAGIC, VERSION, records, [gi_groups[r] for r in records])
+    temp_fp = "%s.%s.tmp" % (fp, os.getpid())
+    with open(temp_fp, "wb") as f:
+        marshal.dump(data, f, 2)
+    os.rename(temp_fp, fp)
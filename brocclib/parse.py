@@ -1,68 +1,568 @@
+from array import array
 from collections import defaultdict
+import bz2
+import gzip
+import io
+import re
+from xml.etree.cElementTree import iterparse
 
 '''
 Created on Aug 29, 2011
 @authors: Serena, Kyle
 '''
 
-def iter_fasta(fasta_lines):
-    """Yield sequences as (name, value) pairs from a FASTA file."""
-    seq = ""
+def open_input(fp):
+    """Open an input file, which may be compressed with gzip or bzip2.
+
+    The compression format is recognized from the start of the file.
+    """
+    with open(fp, "rb") as f:
+        magic = f.read(3)
+    if magic[:2] == "\x1f\x8b":
+        return io.BufferedReader(gzip.GzipFile(fp))
+    if magic == "BZh":
+        return bz2.BZ2File(fp)
+    return open(fp)
+
+
+class SequenceLength(object):
+    """Stands in for a sequence when only its length is needed."""
+    __slots__ = ["length"]
+
+    def __init__(self, length):
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+
+def iter_fasta(fasta_lines, lengths_only=False):
+    """Yield sequences as (name, value) pairs from a FASTA file.
+
+    If lengths_only is True, each sequence is given as a
+    SequenceLength, and the sequence itself is not kept.
+    """
+    seq_lines = []
+    seq_len = 0
     seq_name = None
     for line in fasta_lines:
         line = line.strip()
         if line.startswith(">"):
             if seq_name is not None:
-                yield (seq_name, seq)
+                yield (seq_name, _fasta_value(seq_lines, seq_len, lengths_only))
             seq_name = line[1:]
-            seq = ""
+            seq_lines = []
+            seq_len = 0
+        elif lengths_only:
+            seq_len += len(line)
         else:
-            seq += line
-    yield (seq_name, seq)
+            seq_lines.append(line)
+    yield (seq_name, _fasta_value(seq_lines, seq_len, lengths_only))
+
+
+def _fasta_value(seq_lines, seq_len, lengths_only):
+    if lengths_only:
+        return SequenceLength(seq_len)
+    return "".join(seq_lines)
 
 
 class BlastHit(object):
-    def __init__(self, gi, pct_id, length):
+    __slots__ = ["gi", "pct_id", "length", "query_length"]
+
+    def __init__(self, gi, pct_id, length, query_length=None):
         self.gi = gi
         self.pct_id = pct_id
         self.length = length
+        self.query_length = query_length
 
     def coverage(self, query_seq):
         return self.length / len(query_seq)
 
 
-def iter_blast(blast_lines):
+class BlastHits(object):
+    """Compact storage for the hits of one query.
+
+    Hits are kept in parallel arrays of GI numbers, percent identities,
+    and alignment lengths, rather than as BlastHit objects.  GI numbers
+    are interned, so repeated GIs are stored once.  For subjects without
+    a GI number, the accession is stored in its place.  If the BLAST
+    output has a query length column, the length is kept in
+    query_length.
+    """
+    def __init__(self):
+        self.gis = []
+        self.pct_ids = array('d')
+        self.lengths = array('d')
+        self.query_length = None
+
+    @classmethod
+    def from_hits(cls, hits):
+        res = cls()
+        for hit in hits:
+            res.append(hit.gi, hit.pct_id, hit.length)
+            if hit.query_length is not None:
+                res.query_length = hit.query_length
+        return res
+
+    def append(self, gi, pct_id, length):
+        if gi is not None:
+            gi = intern(gi)
+        self.gis.append(gi)
+        self.pct_ids.append(pct_id)
+        self.lengths.append(length)
+
+    def extend(self, other):
+        """Add the hits from another BlastHits object."""
+        self.gis.extend(other.gis)
+        self.pct_ids.extend(other.pct_ids)
+        self.lengths.extend(other.lengths)
+        if self.query_length is None:
+            self.query_length = other.query_length
+
+    def take(self, idxs):
+        """Return a new set of hits, selected by index."""
+        res = BlastHits()
+        res.gis = [self.gis[i] for i in idxs]
+        res.pct_ids = array('d', (self.pct_ids[i] for i in idxs))
+        res.lengths = array('d', (self.lengths[i] for i in idxs))
+        res.query_length = self.query_length
+        return res
+
+    def __len__(self):
+        return len(self.gis)
+
+    def __getitem__(self, i):
+        return BlastHit(
+            self.gis[i], self.pct_ids[i], self.lengths[i], self.query_length)
+
+    def __iter__(self):
+        for i in xrange(len(self.gis)):
+            yield self[i]
+
+
+# Column names used in BLAST output, as given in the "# Fields:" line
+# of output format 7 and as format specifiers for -outfmt "6 ...".
+BLAST_FIELDS = {
+    "query id": "query",
+    "qseqid": "query",
+    "query acc.": "query",
+    "qacc": "query",
+    "query acc.ver": "query",
+    "qaccver": "query",
+    "subject id": "subject",
+    "sseqid": "subject",
+    "subject acc.": "subject",
+    "sacc": "subject",
+    "subject acc.ver": "subject",
+    "saccver": "subject",
+    "subject gi": "subject",
+    "sgi": "subject",
+    "% identity": "pct_id",
+    "pident": "pct_id",
+    "alignment length": "length",
+    "length": "length",
+    "query length": "query_length",
+    "qlen": "query_length",
+    }
+
+
+class BlastColumns(object):
+    """Positions of the columns needed from tabular BLAST output.
+
+    The default is the standard column order of output formats 6 and
+    7.  The query length column is optional.
+    """
+    def __init__(self, query=0, subject=1, pct_id=2, length=3,
+                 query_length=None):
+        self.query = query
+        self.subject = subject
+        self.pct_id = pct_id
+        self.length = length
+        self.query_length = query_length
+        # Number of splits needed to reach the last column we use
+        self.maxsplit = max(
+            c for c in (query, subject, pct_id, length, query_length)
+            if c is not None) + 1
+
+    @classmethod
+    def from_fields(cls, fields):
+        """Find the columns in a list of field names or specifiers.
+
+        Raises ValueError if a required column is missing.
+        """
+        positions = {}
+        for i, field in enumerate(fields):
+            role = BLAST_FIELDS.get(field.strip().lower())
+            if (role is not None) and (role not in positions):
+                positions[role] = i
+        for role in ["query", "subject", "pct_id", "length"]:
+            if role not in positions:
+                raise ValueError(
+                    "No %s column in BLAST fields: %s" % (
+                        role, ", ".join(fields)))
+        return cls(**positions)
+
+    @classmethod
+    def from_fields_line(cls, line):
+        """Find the columns from the "# Fields:" line of a BLAST file."""
+        return cls.from_fields(line[9:].split(","))
+
+    @classmethod
+    def from_outfmt(cls, outfmt):
+        """Find the columns from an -outfmt "6 ..." specifier string.
+
+        The leading format number is optional.
+        """
+        specifiers = outfmt.split()
+        if specifiers and specifiers[0].isdigit():
+            specifiers = specifiers[1:]
+        if not specifiers:
+            return cls()
+        return cls.from_fields(specifiers)
+
+
+# Number of parsed subject IDs kept while reading a BLAST file.
+SUBJECT_CACHE_SIZE = 100000
+
+
+def _parse_subject_id(subject_id, subject_ids):
+    # Parse a subject ID not found in the subject_ids dict, and add it.
+    if len(subject_ids) >= SUBJECT_CACHE_SIZE:
+        subject_ids.clear()
+    # Need to extract the GI number from the NCBI formatted
+    # reference ID.
+    gi_num = parse_subject_id(subject_id.strip())
+    if gi_num is not None:
+        gi_num = intern(gi_num)
+    subject_ids[subject_id] = gi_num
+    return gi_num
+
+
+def iter_blast(blast_lines, columns=None):
+    """Yield (query_id, hit) pairs for each line of tabular BLAST output.
+
+    Columns are found from the "# Fields:" line of a commented BLAST
+    file (output format 7).  Otherwise, the columns given by a
+    BlastColumns object are used, by default the standard ones.
+    """
+    if columns is None:
+        columns = BlastColumns()
+    fields_line = None
     full_query_id = None
+    subject_ids = {}
+    # Column positions are kept in local variables, and resolved again
+    # only when the "# Fields:" line changes.
+    q_col, s_col, p_col, l_col, ql_col, maxsplit = (
+        columns.query, columns.subject, columns.pct_id, columns.length,
+        columns.query_length, columns.maxsplit)
     for line in blast_lines:
-        if line.startswith('# Query:'):
-            full_query_id = line[8:].strip()
-        if not line.startswith("#"):
-            vals = [x.strip() for x in line.split('\t')]
-            # If this is a commented BLAST file, we'd like to use the
-            # complete query ID as a convenience.  If not available,
-            # we use the first word in the query ID, which is found
-            # in the first column of each output row.
-            if full_query_id is None:
-                query_id = vals[0]
+        if line.startswith("#"):
+            if line.startswith('# Query:'):
+                full_query_id = line[8:].strip()
+            elif line.startswith('# Fields:') and (line != fields_line):
+                fields_line = line
+                columns = BlastColumns.from_fields_line(line)
+                q_col, s_col, p_col, l_col, ql_col, maxsplit = (
+                    columns.query, columns.subject, columns.pct_id,
+                    columns.length, columns.query_length, columns.maxsplit)
+            continue
+        # Parsing is inlined here, as in iter_blast_queries(), to keep
+        # the per-line cost down.
+        vals = line.split('\t', maxsplit)
+        try:
+            gi_num = subject_ids[vals[s_col]]
+        except KeyError:
+            gi_num = _parse_subject_id(vals[s_col], subject_ids)
+        hit = BlastHit(gi_num, float(vals[p_col]), float(vals[l_col]))
+        if ql_col is not None:
+            hit.query_length = int(vals[ql_col])
+        # If this is a commented BLAST file, we'd like to use the
+        # complete query ID as a convenience.  If not available,
+        # we use the first word in the query ID, which is found
+        # in the query column of each output row.
+        if full_query_id is not None:
+            yield full_query_id, hit
+        else:
+            yield vals[q_col].strip(), hit
+
+
+def iter_blast_queries(blast_lines, columns=None):
+    """Yield (query_id, hits) pairs, one per query, in file order.
+
+    Hits are grouped as they appear in the file, so only one query's
+    hits are held in memory at a time.  The hits for each query are
+    given as a BlastHits object.  In a commented BLAST file
+    (output format 7), queries with no hits are reported with an
+    empty list of hits.  If the file is not ordered by query, the
+    same query ID may be yielded more than once.  Columns are found
+    as in iter_blast().
+    """
+    if columns is None:
+        columns = BlastColumns()
+    fields_line = None
+    query_id = None
+    hits = BlastHits()
+    commented = False
+    subject_ids = {}
+    q_col, s_col, p_col, l_col, ql_col, maxsplit = (
+        columns.query, columns.subject, columns.pct_id, columns.length,
+        columns.query_length, columns.maxsplit)
+    for line in blast_lines:
+        if line.startswith("#"):
+            if line.startswith('# Query:'):
+                if query_id is not None:
+                    yield query_id, hits
+                query_id = line[8:].strip()
+                hits = BlastHits()
+                commented = True
+            elif line.startswith('# Fields:') and (line != fields_line):
+                fields_line = line
+                columns = BlastColumns.from_fields_line(line)
+                q_col, s_col, p_col, l_col, ql_col, maxsplit = (
+                    columns.query, columns.subject, columns.pct_id,
+                    columns.length, columns.query_length, columns.maxsplit)
+            continue
+        # Only the columns up to the last one we use are split
+        vals = line.split('\t', maxsplit)
+        try:
+            gi_num = subject_ids[vals[s_col]]
+        except KeyError:
+            gi_num = _parse_subject_id(vals[s_col], subject_ids)
+        if (query_id is None) or (
+                (not commented) and (vals[q_col].strip() != query_id)):
+            row_query_id = vals[q_col].strip()
+            if query_id is not None:
+                yield query_id, hits
+            query_id = row_query_id
+            hits = BlastHits()
+            commented = False
+        if (ql_col is not None) and (hits.query_length is None):
+            hits.query_length = int(vals[ql_col])
+        # GI numbers are interned by _parse_subject_id()
+        hits.gis.append(gi_num)
+        hits.pct_ids.append(float(vals[p_col]))
+        hits.lengths.append(float(vals[l_col]))
+    if query_id is not None:
+        yield query_id, hits
+
+
+def blast_format(fp):
+    """Return "xml" for BLAST XML output (format 5), or "tabular".
+
+    The format is recognized from the start of the file, which may be
+    compressed.
+    """
+    with open_input(fp) as f:
+        start = f.read(256).lstrip()
+    if start.startswith("<?xml") or start.startswith("<BlastOutput"):
+        return "xml"
+    return "tabular"
+
+
+def _xml_query_id(query_id, query_def):
+    # Unless the deflines are parsed, BLAST+ numbers the queries
+    # (Query_1, Query_2, ...) and gives the full defline in query-def.
+    if (query_def is None) or (query_def == "No definition line"):
+        return query_id
+    if (query_id is None) or query_id.startswith("Query_") or \
+            query_id.startswith("lcl|Query_"):
+        return query_def
+    return "%s %s" % (query_id, query_def)
+
+
+def iter_blast_xml_queries(xml_file):
+    """Yield (query_id, hits) pairs from BLAST XML output (format 5).
+
+    Works like iter_blast_queries().  The query ID is the full
+    defline, as in a commented tabular file, and the query length
+    is recorded in the hits.  Queries with no hits are reported with
+    an empty set of hits.  Elements are cleared once they are read,
+    so memory use does not grow with the size of the file.
+    """
+    query_id = query_def = None
+    hits = BlastHits()
+    subject_ids = {}
+    gi_num = identity = None
+    hit_id = ""
+    iterations = None
+    # Values are picked up as each element ends, in document order,
+    # rather than searched for in the finished Hit or Iteration.
+    for event, elem in iterparse(xml_file, events=("start", "end")):
+        if event == "start":
+            if elem.tag == "BlastOutput_iterations":
+                iterations = elem
+            continue
+        tag = elem.tag
+        if tag == "Hsp_identity":
+            identity = float(elem.text)
+        elif tag == "Hsp_align-len":
+            align_len = float(elem.text)
+            # Percent identity is rounded as in tabular output
+            hits.append(
+                gi_num, round(100 * identity / align_len, 2), align_len)
+        elif tag == "Hit_id":
+            hit_id = elem.text or ""
+            try:
+                gi_num = subject_ids[hit_id]
+            except KeyError:
+                gi_num = _parse_subject_id(hit_id, subject_ids)
+        elif tag == "Hit_def":
+            # Databases built without -parse_seqids number the subjects
+            # (gnl|BL_ORD_ID|N), and give the original ID as the first
+            # word of the definition line.  The number is not an ID.
+            if hit_id.startswith("gnl|BL_ORD_ID|"):
+                words = (elem.text or "").split(None, 1)
+                gi_num = None
+                if words:
+                    gi_num = _parse_subject_id(words[0], subject_ids)
+        elif tag == "Hit":
+            elem.clear()
+            gi_num = None
+            hit_id = ""
+        elif tag == "Iteration_query-ID":
+            query_id = elem.text
+        elif tag == "Iteration_query-def":
+            query_def = elem.text
+        elif tag == "Iteration_query-len":
+            hits.query_length = int(elem.text)
+        elif tag == "Iteration":
+            yield _xml_query_id(query_id, query_def), hits
+            query_id = query_def = None
+            hits = BlastHits()
+            if iterations is not None:
+                iterations.clear()
             else:
-                query_id = full_query_id
-            # Need to extract the GI number from the NCBI formatted
-            # reference ID.
-            gi_num = parse_gi_number(vals[1])
-            pct_id = float(vals[2])
-            length = float(vals[3])
-            hit = BlastHit(gi_num, pct_id, length)
+                elem.clear()
+
+
+def iter_blast_xml(xml_file):
+    """Yield (query_id, hit) pairs from BLAST XML output (format 5).
+
+    Works like iter_blast(), with the query length given in each hit.
+    """
+    for query_id, hits in iter_blast_xml_queries(xml_file):
+        for hit in hits:
             yield query_id, hit
 
 
-def read_blast(blast_lines):
+class UnsortedBlastError(ValueError):
+    """BLAST results are not ordered to match the query sequences."""
+    pass
+
+
+def iter_query_hits(sequences, blast_queries, query_names=None):
+    """Pair query sequences with BLAST results, yielding (name, seq, hits).
+
+    The sequences and BLAST results are walked in step, as produced
+    by iter_fasta() and iter_blast_queries(), so only one query's hits
+    are held in memory at a time.  Raises UnsortedBlastError if hits
+    for a query turn up after the query has been yielded, in which
+    case the BLAST file must be read with read_blast() instead.
+
+    If a set of query names is given, BLAST results for any other
+    queries are skipped.  Otherwise, such results hold back the results
+    after them, and UnsortedBlastError is raised at the end.
+    """
+    blast_queries = iter(blast_queries)
+    if query_names is not None:
+        blast_queries = (q for q in blast_queries if q[0] in query_names)
+    pending = None
+    seen = set()
+    for name, seq in sequences:
+        if pending is None:
+            pending = next(blast_queries, None)
+            if (pending is not None) and (pending[0] in seen):
+                raise UnsortedBlastError(
+                    "Hits for query %s found out of order" % pending[0])
+        if (pending is not None) and (pending[0] == name):
+            hits = pending[1]
+            pending = None
+        else:
+            hits = []
+        seen.add(name)
+        yield name, seq, hits
+    # Leftover results are allowed only for queries not in the
+    # sequence file.
+    for query_id, _ in blast_queries:
+        if query_id in seen:
+            raise UnsortedBlastError(
+                "Hits for query %s found out of order" % query_id)
+
+
+def read_blast(blast_lines, columns=None):
     """Read a BLAST output file, return a dict() of hits."""
     res = defaultdict(list)
-    for query_id, hit in iter_blast(blast_lines):
+    for query_id, hit in iter_blast(blast_lines, columns):
         res[query_id].append(hit)
     return res
 
 
+def merge_blast_queries(blast_queries):
+    """Merge the hits for queries that appear more than once.
+
+    Takes (query_id, hits) pairs from iter_blast_queries(), and returns
+    a list of (query_id, hits) pairs in order of first appearance.
+    All hits are held in memory.
+    """
+    merged = {}
+    res = []
+    for query_id, hits in blast_queries:
+        if query_id in merged:
+            merged[query_id].extend(hits)
+        else:
+            merged[query_id] = hits
+            res.append((query_id, hits))
+    return res
+
+
+def iter_blast_query_lengths(blast_queries):
+    """Yield (name, seq, hits) for queries, without the query sequences.
+
+    Takes (query_id, hits) pairs from iter_blast_queries(), for BLAST
+    output with a query length column.  In place of each sequence, a
+    SequenceLength is given.  Queries listed with no hits, as in output
+    format 7, are reported with a length of 0; queries missing from the
+    BLAST output are not reported.  Raises ValueError if a query has
+    hits but no query length; check the output first with
+    has_query_lengths().  Raises UnsortedBlastError if a query turns up
+    more than once, in which case the pairs must be passed through
+    merge_blast_queries() first.
+    """
+    seen = set()
+    for query_id, hits in blast_queries:
+        if query_id in seen:
+            raise UnsortedBlastError(
+                "Hits for query %s found out of order" % query_id)
+        seen.add(query_id)
+        if hits and (hits.query_length is None):
+            raise ValueError(
+                "No query length in BLAST output for query %s. Add a "
+                "qlen column to the BLAST output, or provide the query "
+                "sequences." % query_id)
+        yield query_id, SequenceLength(hits.query_length or 0), hits
+
+
+def has_query_lengths(blast_lines, columns=None):
+    """Check whether tabular BLAST output has a query length column.
+
+    Columns are found as in iter_blast(), from the first "# Fields:"
+    line, or else from the given BlastColumns.  Only the lines up to
+    the first hit are read.  Output with no hits needs no query
+    lengths, so it passes.
+    """
+    if columns is None:
+        columns = BlastColumns()
+    for line in blast_lines:
+        if line.startswith("# Fields:"):
+            columns = BlastColumns.from_fields_line(line)
+            break
+        if not line.startswith("#"):
+            break
+    else:
+        return True
+    return columns.query_length is not None
+
+
 def parse_gi_number(id_string):
         """Recover a GI number from a formatted id string in the nt database."""
         tokens = id_string.split('|')
@@ -71,3 +571,48 @@ def parse_gi_number(id_string):
                 return t2
         return None
 
+
+# Sequence databases whose formatted IDs give an accession.version,
+# as in gb|AB123456.1| or ref|NR_123456.1|.
+ACCESSION_DBS = frozenset(["gb", "emb", "dbj", "ref", "tpg", "tpe", "tpd"])
+
+# Accession.version: letters, with an underscore for RefSeq and WGS
+# prefixes, then digits and a version number, as in NZ_ABCD01000001.1
+_accession_version_re = re.compile(r"[A-Z]+(?:_[A-Z]*)?[0-9]+\.[0-9]+\Z")
+
+
+def parse_accession(id_string):
+    """Recover an accession.version from a subject id string.
+
+    Works for NCBI formatted id strings, and for plain accessions as
+    reported by databases built without GI numbers.  Returns None if
+    the accession is not in accession.version format.
+    """
+    tokens = id_string.split('|')
+    if len(tokens) == 1:
+        accession = id_string
+    else:
+        accession = None
+        for t1, t2 in zip(tokens, tokens[1:]):
+            if t1 in ACCESSION_DBS:
+                accession = t2
+                break
+    if accession and is_accession(accession):
+        return accession
+    return None
+
+
+def parse_subject_id(id_string):
+    """Return the GI number of a subject, or its accession if no GI.
+
+    Returns None if the subject ID gives neither.
+    """
+    gi_num = parse_gi_number(id_string)
+    if (gi_num is None) or (not gi_num.isdigit()):
+        return parse_accession(id_string)
+    return gi_num
+
+
+def is_accession(subject_id):
+    """True if a subject ID is in accession.version format."""
+    return _accession_version_re.match(subject_id) is not None
@@ -0,0 +1,228 @@
+"""Timing and counts for profiling a brocc run.
+
+Profiling is opt-in.  When it is off, none of these classes are used,
+and the assignment code runs as usual.
+"""
+from __future__ import division
+
+from array import array
+from bisect import bisect_left
+from collections import defaultdict
+import json
+import time
+
+from brocclib.assign import Assigner
+
+# Upper bounds of the latency histogram bins, in milliseconds
+LATENCY_BINS_MS = [
+    0.1, 0.2, 0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000]
+
+PERCENTILES = [50, 90, 99]
+
+
+class LatencyHistogram(object):
+    """Histogram of latencies in milliseconds, with percentiles."""
+    def __init__(self, bins=LATENCY_BINS_MS):
+        self.bins = bins
+        self.counts = [0] * (len(bins) + 1)
+        self.values = array('d')
+
+    def add(self, ms):
+        self.counts[bisect_left(self.bins, ms)] += 1
+        self.values.append(ms)
+
+    def percentile(self, p):
+        """Nearest-rank percentile, or None if there are no values."""
+        if not self.values:
+            return None
+        values = sorted(self.values)
+        idx = max(0, int(round(p / 100 * len(values))) - 1)
+        return values[idx]
+
+    def report(self):
+        # The last count is for values above the last bin
+        res = {
+            "count": len(self.values),
+            "bin_upper_bounds_ms": self.bins,
+            "bin_counts": self.counts,
+            }
+        for p in PERCENTILES:
+            res["p%d_ms" % p] = self.percentile(p)
+        if self.values:
+            res["max_ms"] = max(self.values)
+            res["mean_ms"] = sum(self.values) / len(self.values)
+        return res
+
+
+class RunStats(object):
+    """Cumulative wall time per stage, counts, and query latencies.
+
+    Stage names are nested with dots: the time for "assign.vote" is
+    included in the time for "assign".
+    """
+    # Stages recorded before the queries are read, kept across passes
+    setup_stages = ["prefetch"]
+
+    def __init__(self):
+        self.stage_times = defaultdict(float)
+        self.counts = defaultdict(int)
+        self.query_latency = LatencyHistogram()
+        self.subject_ids = set()
+        self.start_time = time.time()
+        self.pass_start = None
+
+    def start_pass(self):
+        """Start a pass over the queries, discarding any earlier pass.
+
+        Unsorted BLAST output is read a second time, after the first
+        pass is abandoned.  Only the last pass is counted; the time
+        spent in earlier passes is recorded as "abandoned_pass".
+        """
+        now = time.time()
+        if self.pass_start is not None:
+            stage_times = defaultdict(float, (
+                (stage, t) for stage, t in self.stage_times.iteritems()
+                if stage in self.setup_stages or stage == "abandoned_pass"))
+            stage_times["abandoned_pass"] += now - self.pass_start
+            self.stage_times = stage_times
+            self.counts = defaultdict(int)
+            self.query_latency = LatencyHistogram()
+            self.subject_ids = set()
+        self.pass_start = now
+
+    def add_time(self, stage, seconds):
+        self.stage_times[stage] += seconds
+
+    def iter_timed(self, stage, iterable):
+        """Yield from an iterable, adding the time for each item to a stage.
+        """
+        it = iter(iterable)
+        while True:
+            start = time.time()
+            try:
+                x = next(it)
+            except StopIteration:
+                self.stage_times[stage] += time.time() - start
+                return
+            self.stage_times[stage] += time.time() - start
+            yield x
+
+    def iter_queries(self, queries):
+        """Time the reading of (name, seq, hits), and count the hits."""
+        for name, seq, hits in self.iter_timed("read_input", queries):
+            self.counts["queries"] += 1
+            self.counts["hits"] += len(hits)
+            if hasattr(hits, "gis"):
+                self.subject_ids.update(hits.gis)
+            else:
+                self.subject_ids.update(h.gi for h in hits)
+            yield name, seq, hits
+
+    def report(self, assigner=None, taxa_db=None):
+        """Return the statistics as a dict, ready for JSON."""
+        stage_times = dict(self.stage_times)
+        # Time spent taking results, while writing the output, covers
+        # reading the input and assigning the queries.
+        results_time = stage_times.pop("results", 0.0)
+        if "classify" in stage_times:
+            stage_times["write_output"] = (
+                stage_times.pop("classify") - results_time)
+            if "assign" not in stage_times:
+                # Assigned in worker processes: only the wait is known
+                stage_times["assign"] = (
+                    results_time - stage_times.get("read_input", 0.0))
+        stage_times["total"] = time.time() - self.start_time
+
+        counts = dict(self.counts)
+        self.subject_ids.discard(None)
+        counts["distinct_subjects"] = len(self.subject_ids)
+        res = {
+            "stages": stage_times,
+            "counts": counts,
+            }
+        if self.query_latency.values:
+            res["query_latency"] = self.query_latency.report()
+        if assigner is not None:
+            counts["lineage_cache_hits"] = assigner.lineage_cache.hits
+            counts["lineage_cache_misses"] = assigner.lineage_cache.misses
+        if isinstance(taxa_db, TimedTaxonomy):
+            counts["distinct_taxon_ids"] = len(taxa_db.taxon_ids)
+            taxa_db = taxa_db.taxa_db
+        if hasattr(taxa_db, "cache_hits"):
+            counts["ncbi_cache_hits"] = taxa_db.cache_hits
+            counts["ncbi_cache_misses"] = taxa_db.cache_misses
+        client = getattr(taxa_db, "client", None)
+        if client is not None:
+            counts["ncbi_requests"] = client.requests
+            counts["ncbi_retries"] = client.retries
+            counts["ncbi_failures"] = client.failures
+        return res
+
+    def write(self, fp, assigner=None, taxa_db=None):
+        with open(fp, "w") as f:
+            json.dump(
+                self.report(assigner, taxa_db), f, indent=2, sort_keys=True)
+            f.write("\n")
+
+
+class TimedTaxonomy(object):
+    """Taxonomy source that records lookup times and distinct taxa."""
+    def __init__(self, taxa_db, stats):
+        self.taxa_db = taxa_db
+        self.stats = stats
+        self.taxon_ids = set()
+
+    def get_taxon_id(self, gi):
+        start = time.time()
+        taxon_id = self.taxa_db.get_taxon_id(gi)
+        self.stats.add_time(
+            "assign.vote.lineages.taxonomy", time.time() - start)
+        if taxon_id is not None:
+            self.taxon_ids.add(taxon_id)
+        return taxon_id
+
+    def get_lineage(self, taxon_id):
+        start = time.time()
+        lineage = self.taxa_db.get_lineage(taxon_id)
+        self.stats.add_time(
+            "assign.vote.lineages.taxonomy", time.time() - start)
+        return lineage
+
+
+class ProfiledAssigner(Assigner):
+    """Assigner that records the time spent in each step.
+
+    The per-query latency is recorded in the stats, along with the
+    time for quality filtering, voting, and lineage retrieval.  Time
+    spent in the taxonomy source is recorded if it is wrapped in a
+    TimedTaxonomy.
+    """
+    def __init__(self, *args, **kwargs):
+        self.stats = kwargs.pop("stats")
+        super(ProfiledAssigner, self).__init__(*args, **kwargs)
+
+    def assign(self, name, seq, hits):
+        start = time.time()
+        a = super(ProfiledAssigner, self).assign(name, seq, hits)
+        elapsed = time.time() - start
+        self.stats.add_time("assign", elapsed)
+        self.stats.query_latency.add(elapsed * 1e3)
+        return a
+
+    def _quality_filter(self, seq, hits):
+        start = time.time()
+        res = super(ProfiledAssigner, self)._quality_filter(seq, hits)
+        self.stats.add_time("assign.quality_filter", time.time() - start)
+        return res
+
+    def _retrieve_lineage(self, gi):
+        start = time.time()
+        res = super(ProfiledAssigner, self)._retrieve_lineage(gi)
+        self.stats.add_time("assign.vote.lineages", time.time() - start)
+        return res
+
+    def vote(self, name, seq, hits):
+        start = time.time()
+        res = super(ProfiledAssigner, self).vote(name, seq, hits)
+        self.stats.add_time("assign.vote", time.time() - start)
+        return res
@@ -1,3 +1,7 @@
+from collections import OrderedDict
+import re
+import sys
+
 '''
 Created on Aug 29, 2011
 @author: Serena
@@ -60,63 +64,242 @@ GENERIC_FLAGS = [
     ]
 
 
+class GenericTaxa(object):
+    """Names and patterns of generic taxa, such as "uncultured fungus".
+
+    Names are kept in a frozenset, and patterns are compiled into one
+    regular expression, which must match the whole name.
+    """
+    pattern_prefix = "regex:"
+
+    def __init__(self, names=(), patterns=()):
+        self.names = frozenset(names)
+        self.patterns = list(patterns)
+        self._regex = None
+        if self.patterns:
+            self._regex = re.compile("(?:%s)\\Z" % "|".join(
+                "(?:%s)" % p for p in self.patterns))
+
+    @classmethod
+    def parse(cls, lines):
+        """Read names and patterns, one per line.
+
+        Lines starting with "regex:" hold a regular expression.  Blank
+        lines, and lines starting with "#", are skipped.
+        """
+        names = []
+        patterns = []
+        for line in lines:
+            line = line.strip()
+            if (not line) or line.startswith("#"):
+                continue
+            if line.startswith(cls.pattern_prefix):
+                patterns.append(line[len(cls.pattern_prefix):].strip())
+            else:
+                names.append(line)
+        return cls(names, patterns)
+
+    def __contains__(self, name):
+        if name in self.names:
+            return True
+        if (self._regex is None) or (name is None):
+            return False
+        return self._regex.match(name) is not None
+
+
+class Interner(object):
+    """Table of shared values, such as taxon names.
+
+    Equal values are replaced by the first one seen.  Unlike the
+    built-in intern(), this works for unicode strings and tuples.
+
+    Strings and tuples cannot be weakly referenced, so the table is
+    swept instead: each time it doubles in size, values used only by
+    the table are dropped.  Values stay in the table only while they
+    are held elsewhere, for example by a cached lineage.
+    """
+    min_sweep_size = 1000
+
+    def __init__(self):
+        self._values = {}
+        self._sweep_size = self.min_sweep_size
+
+    def __call__(self, value):
+        value = self._values.setdefault(value, value)
+        if len(self._values) >= self._sweep_size:
+            self.sweep()
+        return value
+
+    def sweep(self):
+        """Drop the values that are used only by the table."""
+        for value in list(self._values):
+            # Referred to by the table as key and value, by the list,
+            # by the loop variable, and by the argument of getrefcount
+            if sys.getrefcount(value) <= 5:
+                self._values.pop(value, None)
+        self._sweep_size = max(self.min_sweep_size, 2 * len(self._values))
+
+    def __len__(self):
+        return len(self._values)
+
+
+# Taxon names, and tuples of names, shared by all lineages in a run.
+# Lineages dropped from a cache are freed, along with any names and
+# tuples no longer used, when the table is swept.
+intern_taxon = Interner()
+
+
+def intern_taxa(names):
+    """Return a shared tuple of shared taxon names."""
+    return intern_taxon(tuple(intern_taxon(n) for n in names))
+
+
+def intern_lineage_dict(lineage_dict):
+    """Return a copy of a lineage dict, with shared ranks and names."""
+    if lineage_dict is None:
+        return None
+    return dict(
+        (intern_taxon(rank), intern_taxon(name))
+        for rank, name in lineage_dict.iteritems())
+
+
+class LineageCache(object):
+    """Least-recently-used cache of lineages, with hit and miss counts."""
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._lineages = OrderedDict()
+
+    def get(self, taxon_id):
+        """Return a cached lineage, or None if not found."""
+        lineage = self._lineages.pop(taxon_id, None)
+        if lineage is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._lineages[taxon_id] = lineage
+        return lineage
+
+    def put(self, taxon_id, lineage):
+        self._lineages[taxon_id] = lineage
+        if len(self._lineages) > self.max_size:
+            self._lineages.popitem(last=False)
+
+    def __len__(self):
+        return len(self._lineages)
+
+
 class NoLineage(object):
+    taxa = (None,) * 8
+
     def get_taxon(self, rank):
         return None
 
+    def to_record(self):
+        return None
+
 
 class Lineage(object):
-    generic_taxa = GENERIC_TAXA
-    generic_flags = GENERIC_FLAGS
+    generic_taxa = GenericTaxa(GENERIC_TAXA)
+    generic_flags = GenericTaxa(GENERIC_FLAGS)
     ranks = [
         "species", "genus", "family", "order",
         "class", "phylum", "kingdom", "domain",
         ]
 
-    def __init__(self, dictionary):
-        self.store = dictionary
+    def __init__(self, dictionary, generic_taxa=None):
+        store = dictionary
+        if generic_taxa is None:
+            generic_taxa = self.generic_taxa
 
-        self.species = self.store.get("species")
+        self.species = intern_taxon(store.get("species"))
 
         self.classified = True
-        if self.species in self.generic_taxa:
+        if self.species in generic_taxa:
             self.classified = False
-        if ("no rank" in self.store) and (self.store["no rank"] in self.generic_flags):
+        if ("no rank" in store) and (store["no rank"] in self.generic_flags):
             self.classified = False
 
         ### FIXME: do not store taxa in attributes.
-        self.genus = self.store.get("genus")
+        self.genus = intern_taxon(store.get("genus"))
         if (self.genus is None) and (self.species is not None):
-            self.genus = self.species + " (genus)"
+            self.genus = intern_taxon(self.species + " (genus)")
 
-        self.family = self.store.get("family")
+        self.family = intern_taxon(store.get("family"))
         if (self.family is None) and (self.genus is not None):
-            self.family = self.genus.split(" (")[0] + " (family)"
+            self.family = intern_taxon(
+                self.genus.split(" (")[0] + " (family)")
 
-        self.order = self.store.get("order")
+        self.order = intern_taxon(store.get("order"))
         if (self.order is None) and (self.family is not None):
-            self.order = self.family.split(" (")[0] + " (order)"
+            self.order = intern_taxon(
+                self.family.split(" (")[0] + " (order)")
 
-        self.clas = self.store.get("class")
+        self.clas = intern_taxon(store.get("class"))
         if (self.clas is None) and (self.order is not None):
-            self.clas = self.order.split(" (")[0] + " (class)"
+            self.clas = intern_taxon(self.order.split(" (")[0] + " (class)")
 
-        self.phylum = self.store.get("phylum")
+        self.phylum = intern_taxon(store.get("phylum"))
         if (self.phylum is None) and (self.clas is not None):
-            self.phylum = self.clas.split(" (")[0] + " (phylum)"
+            self.phylum = intern_taxon(
+                self.clas.split(" (")[0] + " (phylum)")
 
-        self.kingdom = self.store.get("kingdom")
+        self.kingdom = intern_taxon(store.get("kingdom"))
         if (self.kingdom is None) and (self.phylum is not None):
-            self.kingdom = self.phylum.split(" (")[0] + " (kingdom)"
+            self.kingdom = intern_taxon(
+                self.phylum.split(" (")[0] + " (kingdom)")
 
-        self.domain = self.store.get("superkingdom")
+        self.domain = intern_taxon(store.get("superkingdom"))
         if (self.domain is None) and (self.kingdom is not None):
             self.domain = "Domain unknown for reference"
         ################## End FIXME
 
-        self.full_lineage = self.store["Lineage"].split("; ")
+        full_lineage = store["Lineage"].split("; ")
         if self.species is not None:
-            self.full_lineage.append(self.species)
+            full_lineage.append(self.species)
+        self.full_lineage = intern_taxa(full_lineage)
+        self.paren_idx = self._find_paren()
+
+        # Taxa at each rank, in order of the ranks
+        self.taxa = intern_taxa(self.get_taxon(r) for r in self.ranks)
+
+    @classmethod
+    def from_record(cls, record):
+        """Make a lineage from a record returned by to_record."""
+        taxa, classified, full_lineage = record
+        taxa = intern_taxa(taxa)
+        lineage = cls.__new__(cls)
+        (lineage.species, lineage.genus, lineage.family, lineage.order,
+         lineage.clas, lineage.phylum, lineage.kingdom,
+         lineage.domain) = taxa
+        lineage.classified = classified
+        lineage.full_lineage = intern_taxa(full_lineage)
+        lineage.paren_idx = lineage._find_paren()
+        lineage.taxa = taxa
+        return lineage
+
+    def to_record(self):
+        """Return the taxa, classified flag, and full lineage as a tuple."""
+        return (self.taxa, self.classified, tuple(self.full_lineage))
+
+    def _find_paren(self):
+        # Index of the first taxon with a parenthesis in its name
+        for i, t in enumerate(self.full_lineage):
+            if "(" in t:
+                return i
+        return None
+
+    def has_paren_taxon(self, rank):
+        """Return True if a name in get_all_taxa(rank) has a parenthesis."""
+        if self.paren_idx is None:
+            return False
+        try:
+            end = self.full_lineage.index(self.get_taxon(rank))
+        except ValueError:
+            # The taxon is not in the full lineage, so all names are used
+            return True
+        return self.paren_idx <= end
 
     def get_standard_taxa(self, rank):
         for r in reversed(self.ranks):
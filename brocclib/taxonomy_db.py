@@ -3,7 +3,19 @@ import sqlite3
 import os.path
 import gzip
 import itertools
+import re
+import StringIO
+import subprocess
+import sys
 import tarfile
+import time
+from collections import deque
+from distutils.spawn import find_executable
+from multiprocessing import Pool
+
+from brocclib.parse import (
+    iter_blast, iter_blast_xml, is_accession, blast_format, open_input,
+    )
 
 # Columns kept in node table: 1, 2, 3
 
@@ -22,6 +34,76 @@ CREATE TABLE names (
   name TEXT);
 """
 
+# Ranks kept in the lineages table, as column names.  Lineages keep
+# only the ranks used by the classifier, plus the lowest unranked
+# ancestor, which is checked for generic taxa.
+LINEAGE_RANKS = [
+    ("species", "species"),
+    ("genus", "genus"),
+    ("family", "family"),
+    ("order", '"order"'),
+    ("class", "class"),
+    ("phylum", "phylum"),
+    ("kingdom", "kingdom"),
+    ("superkingdom", "superkingdom"),
+    ("no rank", "no_rank"),
+    ]
+
+LINEAGES_SCHEMA = """\
+CREATE TABLE lineages (
+  tax_id INT NOT NULL PRIMARY KEY,
+  %s,
+  lineage TEXT);
+""" % ",\n  ".join("%s TEXT" % c for _, c in LINEAGE_RANKS)
+
+
+# Accessions are stored with integer keys.  Each accession is split
+# into a prefix, such as "AB" or "NZ_ABCD", and a number.  The prefix
+# and the number of digits are stored once in accession_prefixes.
+# Versions are dropped.
+ACCESSION_SCHEMA = """\
+CREATE TABLE IF NOT EXISTS accession_prefixes (
+  prefix_id INTEGER PRIMARY KEY,
+  prefix TEXT NOT NULL,
+  num_digits INT NOT NULL);
+
+CREATE TABLE IF NOT EXISTS accession_taxid (
+  prefix_id INT NOT NULL,
+  number INT NOT NULL,
+  tax_id INT NOT NULL,
+  PRIMARY KEY (prefix_id, number)) WITHOUT ROWID;
+"""
+
+# The bulk loader creates the tables without indexes, and builds the
+# indexes once all rows are loaded.  Rows loaded so far are recorded in
+# the load_progress table, which is dropped when the build is complete.
+BULK_SCHEMA = """\
+CREATE TABLE IF NOT EXISTS gi_taxid(
+       nuc_id INT NOT NULL,
+       tax_id INT NOT NULL);
+
+CREATE TABLE IF NOT EXISTS nodes (
+  tax_id INT NOT NULL,
+  parent_id INT NOT NULL,
+  rank TEXT);
+
+CREATE TABLE IF NOT EXISTS names (
+  tax_id INT NOT NULL,
+  name TEXT);
+
+CREATE TABLE IF NOT EXISTS load_progress (
+  table_name TEXT NOT NULL PRIMARY KEY,
+  num_rows INT NOT NULL,
+  done INT NOT NULL);
+"""
+
+BULK_INDEXES = """\
+CREATE UNIQUE INDEX IF NOT EXISTS gi_taxid_nuc_id ON gi_taxid (nuc_id);
+CREATE UNIQUE INDEX IF NOT EXISTS nodes_tax_id ON nodes (tax_id);
+CREATE UNIQUE INDEX IF NOT EXISTS names_tax_id ON names (tax_id);
+"""
+
+
 def init_db(fp):
     """Create a new SQLite3 database for the NCBI taxonomy.
     """
@@ -31,6 +113,68 @@ def init_db(fp):
     conn.close()
 
 
+def parse_accession2taxid(f):
+    """Parse an NCBI accession2taxid file.
+
+    Yields the accession.version and taxon ID for each row.
+    """
+    for line in f:
+        line = line.rstrip()
+        if line and not line.startswith("accession\t"):
+            vals = line.split("\t")
+            yield [vals[1], vals[2]]
+
+
+_accession_re = re.compile(r"(.*?)(\d*)$")
+
+
+def split_accession(accession):
+    """Split an accession into prefix, number of digits, and number.
+
+    The version, if present, is dropped.
+    """
+    accession = accession.split(".", 1)[0]
+    prefix, digits = _accession_re.match(accession).groups()
+    return prefix, len(digits), int(digits or 0)
+
+
+class AccessionKeys(object):
+    """Convert accessions to the integer keys of the accession_taxid table.
+    """
+    def __init__(self, conn):
+        self.conn = conn
+        self.prefix_ids = dict(
+            ((prefix, num_digits), prefix_id) for prefix_id, prefix, num_digits
+            in conn.execute("SELECT * FROM accession_prefixes"))
+
+    def get(self, accession):
+        """Return the key for an accession, or None if the prefix is new.
+        """
+        prefix, num_digits, number = split_accession(accession)
+        prefix_id = self.prefix_ids.get((prefix, num_digits))
+        if prefix_id is None:
+            return None
+        return prefix_id, number
+
+    def add(self, accession):
+        """Return the key for an accession, adding the prefix if needed.
+        """
+        prefix, num_digits, number = split_accession(accession)
+        prefix_id = self.prefix_ids.get((prefix, num_digits))
+        if prefix_id is None:
+            prefix_id = self.conn.execute(
+                "INSERT INTO accession_prefixes (prefix, num_digits) "
+                "VALUES (?,?)", (prefix, num_digits)).lastrowid
+            self.prefix_ids[(prefix, num_digits)] = prefix_id
+        return prefix_id, number
+
+    def key_rows(self, rows):
+        """Convert (accession, tax_id) rows to rows of accession_taxid."""
+        for accession, tax_id in rows:
+            prefix_id, number = self.add(accession)
+            yield prefix_id, number, tax_id
+
+
 def parse_gi_taxid(f):
     for line in f:
         line = line.rstrip()
@@ -55,49 +199,593 @@ def parse_nodes(f):
     return (r[0:3] for r in rows)
 
 
-def _insert_many(db, input_file, parse_fcn, insert_sql):
-    rows = parse_fcn(input_file)
+# Size in bytes of the blocks of text parsed by each worker, and the
+# number of blocks in flight at one time.
+BLOCK_SIZE = 1024 * 1024
+MAX_PENDING_BLOCKS = 8
+
+
+class DecompressedFile(object):
+    """Read the output of a decompression command through a pipe.
+
+    Decompression runs in a separate process, in parallel with parsing.
+    The process is started on the first read, so that files which are
+    never read are never decompressed.  The command's exit status is
+    checked when the file is closed, unless it was closed before all of
+    the output was read.
+    """
+    def __init__(self, args):
+        self.args = args
+        self.proc = None
+
+    def _stdout(self):
+        if self.proc is None:
+            self.proc = subprocess.Popen(
+                self.args, stdout=subprocess.PIPE, bufsize=BLOCK_SIZE,
+                close_fds=True)
+        return self.proc.stdout
+
+    def read(self, *args):
+        return self._stdout().read(*args)
+
+    def readline(self, *args):
+        return self._stdout().readline(*args)
+
+    def __iter__(self):
+        return iter(self._stdout())
+
+    def close(self):
+        if self.proc is None:
+            return
+        # A command stopped early by the closed pipe fails, as expected.
+        finished = not self.proc.stdout.read(1)
+        self.proc.stdout.close()
+        returncode = self.proc.wait()
+        if finished and (returncode > 0):
+            raise IOError("Command failed with status %d: %s" % (
+                returncode, " ".join(self.args)))
+
+
+def open_gzip(fp):
+    """Open a gzipped file, decompressing with pigz or gzip if found."""
+    for program in ["pigz", "gzip"]:
+        program_fp = find_executable(program)
+        if program_fp is not None:
+            return DecompressedFile([program_fp, "-dc", fp])
+    return gzip.GzipFile(fp)
+
+
+def open_tar_member(fp, member):
+    """Open a file in a gzipped tar archive, extracting with tar if found.
+    """
+    tar_fp = find_executable("tar")
+    if tar_fp is not None:
+        pigz_fp = find_executable("pigz")
+        if pigz_fp is not None:
+            args = [tar_fp, "-I", pigz_fp, "-xOf", fp, member]
+        else:
+            args = [tar_fp, "-xzOf", fp, member]
+        return DecompressedFile(args)
+    return tarfile.open(fp).extractfile(member)
+
+
+def _iter_blocks(f, block_size):
+    # Each block ends at the end of a line.
+    while True:
+        block = f.read(block_size)
+        if not block:
+            return
+        yield block + f.readline()
+
+
+def _parse_block(parse_fcn, block):
+    return list(parse_fcn(block.splitlines()))
+
+
+def iter_parsed(f, parse_fcn, pool=None, block_size=BLOCK_SIZE):
+    """Parse the rows of a file, in blocks across a pool of workers.
+
+    Rows are yielded in file order.  Without a pool, the file is parsed
+    in this process.
+    """
+    if pool is None:
+        return parse_fcn(f)
+    return _iter_parsed_blocks(f, parse_fcn, pool, block_size)
+
+
+def _iter_parsed_blocks(f, parse_fcn, pool, block_size):
+    # Keep a limited number of blocks in flight, so that memory use
+    # does not depend on the size of the file.
+    pending = deque()
+    for block in _iter_blocks(f, block_size):
+        pending.append(pool.apply_async(_parse_block, (parse_fcn, block)))
+        if len(pending) >= MAX_PENDING_BLOCKS:
+            for row in pending.popleft().get():
+                yield row
+    while pending:
+        for row in pending.popleft().get():
+            yield row
+
+
+def _table_rows(conn, table, rows):
+    # Accessions are converted to integer keys as they are loaded, and
+    # their tables are created only if needed.
+    if table == "accession_taxid":
+        conn.executescript(ACCESSION_SCHEMA)
+        rows = AccessionKeys(conn).key_rows(rows)
+    return rows
+
+
+def _insert_sql(conn, table):
+    num_cols = len(conn.execute("PRAGMA table_info(%s)" % table).fetchall())
+    return "INSERT INTO %s VALUES (%s)" % (table, ",".join("?" * num_cols))
+
+
+def insert_rows(db, table, rows):
     conn = sqlite3.connect(db)
-    conn.executemany(insert_sql, rows)
+    rows = _table_rows(conn, table, rows)
+    conn.executemany(_insert_sql(conn, table), rows)
     conn.commit()
     conn.close()
 
 
 def insert_names(db, f):
-    sql = "INSERT INTO names VALUES (?,?)"
-    return _insert_many(db, f, parse_names, sql)
+    return insert_rows(db, "names", parse_names(f))
 
 
 def insert_nodes(db, f):
-    sql = "INSERT INTO nodes VALUES (?,?,?)"
-    return _insert_many(db, f, parse_nodes, sql)
+    return insert_rows(db, "nodes", parse_nodes(f))
 
 
 def insert_taxid(db, f):
-    sql = "INSERT INTO gi_taxid VALUES (?,?)"
-    return _insert_many(db, f, parse_gi_taxid, sql)
+    return insert_rows(db, "gi_taxid", parse_gi_taxid(f))
+
+
+def insert_accessions(db, f):
+    return insert_rows(db, "accession_taxid", parse_accession2taxid(f))
+
+
+def read_gi_numbers(blast_fps=(), gi_list_fps=()):
+    """Collect the set of GI numbers in BLAST output and GI list files.
+
+    BLAST output may be tabular or XML, and GI list files have one GI
+    number per line.  GI numbers are returned as strings, as found in
+    the gi_taxid file.  Accessions are collected for subjects without
+    a GI number, and may also be listed in GI list files.
+    """
+    gi_nums = set()
+    for fp in blast_fps:
+        if blast_format(fp) == "xml":
+            parse_fcn = iter_blast_xml
+        else:
+            parse_fcn = iter_blast
+        with open_input(fp) as f:
+            gi_nums.update(hit.gi for _, hit in parse_fcn(f))
+    for fp in gi_list_fps:
+        with open(fp) as f:
+            gi_nums.update(line.strip() for line in f)
+    gi_nums.discard(None)
+    gi_nums.discard("")
+    return gi_nums
+
+
+def ancestor_closure(nodes, tax_ids):
+    """Return the given taxa together with all of their ancestors."""
+    parents = dict((tax_id, parent_id) for tax_id, parent_id, _ in nodes)
+    closure = set()
+    for tax_id in tax_ids:
+        while (tax_id is not None) and (tax_id not in closure):
+            closure.add(tax_id)
+            tax_id = parents.get(tax_id)
+    return closure
+
+
+def taxonomy_rows(taxid_f, nodes_f, names_f, gi_nums=None, pool=None,
+                  accession_fs=()):
+    """Return (table, rows) pairs for each table, in load order.
+
+    If a set of GI numbers is given, only those GI numbers are kept,
+    along with the taxa they belong to and the ancestors of those taxa.
+    Accessions in the set are kept from the accession2taxid files.  If
+    a pool of worker processes is given, the files are parsed across
+    the pool.
+    """
+    taxid_rows = iter_parsed(taxid_f, parse_gi_taxid, pool)
+    accession_rows = itertools.chain.from_iterable(
+        iter_parsed(f, parse_accession2taxid, pool) for f in accession_fs)
+    node_rows = iter_parsed(nodes_f, parse_nodes, pool)
+    name_rows = iter_parsed(names_f, parse_names, pool)
+    if gi_nums is not None:
+        taxid_rows = [r for r in taxid_rows if r[0] in gi_nums]
+        accessions = set(
+            a.split(".", 1)[0] for a in gi_nums if is_accession(a))
+        accession_rows = [
+            r for r in accession_rows if r[0].split(".", 1)[0] in accessions]
+        tax_ids = set(r[1] for r in taxid_rows)
+        tax_ids.update(r[1] for r in accession_rows)
+        node_rows = list(node_rows)
+        keep = ancestor_closure(node_rows, tax_ids)
+        node_rows = [r for r in node_rows if r[0] in keep]
+        name_rows = (r for r in name_rows if r[0] in keep)
+    tables = [("gi_taxid", taxid_rows)]
+    if accession_fs:
+        tables.append(("accession_taxid", accession_rows))
+    tables.extend([("nodes", node_rows), ("names", name_rows)])
+    return tables
+
+
+def disk_usage(db_fp):
+    """Total size in bytes of a database and its journal files."""
+    total = 0
+    for suffix in ["", "-journal", "-wal", "-shm"]:
+        fp = db_fp + suffix
+        if os.path.exists(fp):
+            total += os.path.getsize(fp)
+    return total
+
+
+def is_partial_load(db_fp):
+    """True if the database is an unfinished build of the bulk loader."""
+    conn = sqlite3.connect(db_fp)
+    try:
+        row = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' "
+            "AND name = 'load_progress'").fetchone()
+    except sqlite3.DatabaseError:
+        row = None
+    conn.close()
+    return row is not None
+
+
+class BulkLoader(object):
+    """Load the taxonomy tables quickly, with the option to resume.
+
+    Journaling is set to WAL and syncing is turned off for the build,
+    so an interrupted build leaves the rows committed so far intact.
+    Rows are committed in chunks, and the number of rows loaded into
+    each table is committed along with them.  Loading a table again
+    skips the rows already present.  Indexes are created by finish().
+    """
+    def __init__(self, db_fp, chunk_size=1000000, progress=None):
+        self.db_fp = db_fp
+        self.chunk_size = chunk_size
+        self.progress = progress
+        self.conn = sqlite3.connect(db_fp)
+        self.conn.text_factory = str
+        self.conn.execute("PRAGMA journal_mode = WAL")
+        self.conn.execute("PRAGMA synchronous = OFF")
+        self.conn.executescript(BULK_SCHEMA)
+        self.peak_disk_usage = disk_usage(db_fp)
+
+    def _update_disk_usage(self):
+        self.peak_disk_usage = max(
+            self.peak_disk_usage, disk_usage(self.db_fp))
+
+    def rows_loaded(self, table):
+        """Return the number of rows loaded and whether the table is done.
+        """
+        row = self.conn.execute(
+            "SELECT num_rows, done FROM load_progress WHERE table_name = ?",
+            (table,)).fetchone()
+        if row is None:
+            return 0, False
+        return row[0], bool(row[1])
+
+    def load(self, table, rows):
+        """Load rows into a table, resuming where a previous load stopped.
+
+        The rows must be given in the same order each time.
+        """
+        num_rows, done = self.rows_loaded(table)
+        if done:
+            return num_rows
+        rows = _table_rows(self.conn, table, rows)
+        sql = _insert_sql(self.conn, table)
+        progress_sql = "INSERT OR REPLACE INTO load_progress VALUES (?,?,?)"
+
+        rows = itertools.islice(rows, num_rows, None)
+        while True:
+            chunk = list(itertools.islice(rows, self.chunk_size))
+            if not chunk:
+                break
+            num_rows += len(chunk)
+            with self.conn:
+                self.conn.executemany(sql, chunk)
+                self.conn.execute(progress_sql, (table, num_rows, 0))
+            self._update_disk_usage()
+            if self.progress is not None:
+                self.progress(table, num_rows)
+        with self.conn:
+            self.conn.execute(progress_sql, (table, num_rows, 1))
+        return num_rows
+
+    def finish(self):
+        """Build the indexes and return the database to normal journaling.
+        """
+        self.conn.executescript(BULK_INDEXES)
+        self._update_disk_usage()
+        self.conn.execute("DROP TABLE load_progress")
+        self.conn.commit()
+        self.conn.execute("PRAGMA journal_mode = DELETE")
+        self.conn.close()
+
+
+def bulk_load(db_fp, tables, **kwargs):
+    """Build the taxonomy database with a BulkLoader.
+
+    Tables are given as (table, rows) pairs, as returned by
+    taxonomy_rows().  Returns the loader, which records the peak disk
+    usage.
+    """
+    loader = BulkLoader(db_fp, **kwargs)
+    for table, rows in tables:
+        loader.load(table, rows)
+    loader.finish()
+    return loader
+
+
+class NcbiTaxonomyDb(object):
+    """Look up taxonomy in a local SQLite database of the NCBI taxonomy.
+
+    Provides the same interface as get_xml.NcbiEutils, so it may be
+    used as the taxonomy database for the Assigner.
+    """
+    def __init__(self, db_fp):
+        self.db_fp = db_fp
+        self.conn = sqlite3.connect(db_fp)
+        # Return names as byte strings, like the NCBI web service
+        self.conn.text_factory = str
+        self.has_lineages = self._has_table("lineages")
+        self.accession_keys = None
+        if self._has_table("accession_prefixes"):
+            self.accession_keys = AccessionKeys(self.conn)
+
+    def _has_table(self, table):
+        return self.conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' "
+            "AND name = ?", (table,)).fetchone() is not None
+
+    def get_taxon_id(self, gi_num):
+        """Return the taxon ID for a GI number or accession."""
+        if gi_num is None:
+            return None
+        if is_accession(gi_num):
+            return self._get_accession_taxon_id(gi_num)
+        row = self.conn.execute(
+            "SELECT tax_id FROM gi_taxid WHERE nuc_id = ?",
+            (gi_num,)).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def _get_accession_taxon_id(self, accession):
+        if self.accession_keys is None:
+            return None
+        key = self.accession_keys.get(accession)
+        if key is None:
+            return None
+        row = self.conn.execute(
+            "SELECT tax_id FROM accession_taxid "
+            "WHERE prefix_id = ? AND number = ?", key).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def _get_node(self, taxon_id):
+        return self.conn.execute(
+            "SELECT nodes.parent_id, nodes.rank, names.name FROM nodes "
+            "LEFT JOIN names ON nodes.tax_id = names.tax_id "
+            "WHERE nodes.tax_id = ?", (taxon_id,)).fetchone()
+
+    def get_lineage(self, taxon_id):
+        """Return the lineage of a taxon as a dict of names by rank.
+
+        The dict has the same form as the one returned by
+        get_xml.get_taxon_from_xml().  If the database has a table of
+        precomputed lineages, only the ranks used by the classifier
+        are included.
+        """
+        if self.has_lineages:
+            row = self.conn.execute(
+                "SELECT * FROM lineages WHERE tax_id = ?",
+                (taxon_id,)).fetchone()
+            if row is not None:
+                taxon_dict = dict(
+                    (r, name) for (r, _), name in zip(LINEAGE_RANKS, row[1:])
+                    if name is not None)
+                taxon_dict["Lineage"] = row[-1]
+                return taxon_dict
+        return self._walk_lineage(taxon_id)
+
+    def _walk_lineage(self, taxon_id):
+        node = self._get_node(taxon_id)
+        if node is None:
+            return None
+        parent_id, rank, name = node
+
+        # Walk up the tree to the root, which is its own parent.
+        ancestors = []
+        current_id = taxon_id
+        while parent_id != current_id:
+            current_id = parent_id
+            node = self._get_node(current_id)
+            if node is None:
+                break
+            parent_id, ancestor_rank, ancestor_name = node
+            if parent_id != current_id:
+                ancestors.append((ancestor_rank, ancestor_name))
+        ancestors.reverse()
+
+        taxon_dict = dict(ancestors)
+        # Include lowest rank in lineage
+        if rank not in taxon_dict:
+            taxon_dict[rank] = name
+        # Also include the lineage as a string
+        taxon_dict["Lineage"] = "; ".join(n for _, n in ancestors)
+        return taxon_dict
+
+
+def iter_lineages(nodes, names):
+    """Compute lineages for all taxa, working down from the root.
+
+    Yields rows for the lineages table.  Taxa that cannot be reached
+    from the root are skipped.
+    """
+    ranks = {}
+    children = {}
+    root_id = None
+    for tax_id, parent_id, rank in nodes:
+        ranks[tax_id] = rank
+        if tax_id == parent_id:
+            root_id = tax_id
+        else:
+            children.setdefault(parent_id, []).append(tax_id)
+    if root_id is None:
+        return
+    lineage_ranks = set(r for r, _ in LINEAGE_RANKS)
+
+    # Each taxon is visited with the ranks and names of its ancestors,
+    # excluding the root.
+    stack = [(root_id, {}, None)]
+    while stack:
+        tax_id, ancestor_ranks, ancestor_names = stack.pop()
+        rank = ranks[tax_id]
+        name = names.get(tax_id)
+
+        taxon_ranks = ancestor_ranks
+        if (rank in lineage_ranks) and (rank not in ancestor_ranks):
+            taxon_ranks = ancestor_ranks.copy()
+            taxon_ranks[rank] = name
+        row = [tax_id]
+        row.extend(taxon_ranks.get(r) for r, _ in LINEAGE_RANKS)
+        row.append(ancestor_names or "")
+        yield row
+
+        if tax_id == root_id:
+            child_ranks = {}
+            child_names = None
+        else:
+            child_ranks = ancestor_ranks
+            if rank in lineage_ranks:
+                child_ranks = ancestor_ranks.copy()
+                child_ranks[rank] = name
+            if ancestor_names is None:
+                child_names = name
+            else:
+                child_names = ancestor_names + "; " + name
+        for child_id in children.pop(tax_id, []):
+            stack.append((child_id, child_ranks, child_names))
+
+
+def insert_lineages(db):
+    """Add a table of precomputed lineages to an existing database.
+
+    Nodes and names must be inserted first.
+    """
+    conn = sqlite3.connect(db)
+    conn.text_factory = str
+    conn.executescript(LINEAGES_SCHEMA)
+    nodes = conn.execute("SELECT tax_id, parent_id, rank FROM nodes").fetchall()
+    names = dict(conn.execute("SELECT tax_id, name FROM names"))
+    sql = "INSERT INTO lineages VALUES (%s)" % ",".join(
+        "?" * (len(LINEAGE_RANKS) + 2))
+    conn.executemany(sql, iter_lineages(nodes, names))
+    conn.commit()
+    conn.close()
 
 
 def main(argv=None):
     p = optparse.OptionParser()
     p.add_option("--taxid_fp", help="Path to gzipped taxid file")
+    p.add_option("--accession_fp", action="append", default=[], help=(
+        "Path to gzipped accession2taxid file, such as "
+        "nucl_gb.accession2taxid.gz.  May be given more than once."))
     p.add_option("--taxdmp_fp", help="Path to tar-gzipped taxdmp file")
     p.add_option("--db_fp", help="Output filepath for sqlite3 database")
+    p.add_option("--lineages", action="store_true", help=(
+        "Precompute the lineage of every taxon, so that each lineage can "
+        "be retrieved in a single lookup.  Makes the database larger."))
+    p.add_option("--bulk", action="store_true", help=(
+        "Load the database in bulk mode: no journal syncing, indexes "
+        "built after loading, and rows committed in chunks.  An "
+        "interrupted bulk load is resumed by running the same command "
+        "again."))
+    p.add_option("--chunk_size", type="int", default=1000000, help=(
+        "Number of rows committed at a time in bulk mode "
+        "[default: %default]"))
+    p.add_option("--blast_fp", action="append", default=[], help=(
+        "Load only the GI numbers found in this BLAST output file, and "
+        "the taxa needed to classify them.  May be given more than "
+        "once."))
+    p.add_option("--gi_list_fp", action="append", default=[], help=(
+        "Load only the GI numbers in this file, one per line, and the "
+        "taxa needed to classify them.  May be given more than once."))
+    p.add_option("-p", "--processes", type="int", default=1, help=(
+        "Number of worker processes used to parse the input files.  "
+        "Files are decompressed in a separate process in any case. "
+        "[default: %default]"))
     opts, args = p.parse_args(argv)
 
-    if os.path.exists(opts.db_fp):
+    resume = opts.bulk and os.path.exists(opts.db_fp) and \
+        is_partial_load(opts.db_fp)
+    if os.path.exists(opts.db_fp) and not resume:
         p.error("Database file already exists.  Please delete first.")
-    if not os.path.exists(opts.taxid_fp):
+    if (opts.taxid_fp is None) and (not opts.accession_fp):
+        p.error("Please provide a taxid file or an accession2taxid file.")
+    if (opts.taxid_fp is not None) and (not os.path.exists(opts.taxid_fp)):
         p.error("Taxid file not found.")
+    for fp in opts.accession_fp:
+        if not os.path.exists(fp):
+            p.error("Accession2taxid file not found: %s" % fp)
     if not os.path.exists(opts.taxdmp_fp):
         p.error("Taxdmp file not found.")
 
-    taxid_f = gzip.GzipFile(opts.taxid_fp)
-    taxdmp_tar = tarfile.open(opts.taxdmp_fp)
-    nodes_f = taxdmp_tar.extractfile("nodes.dmp")
-    names_f = taxdmp_tar.extractfile("names.dmp")
+    start = time.time()
+    gi_nums = None
+    if opts.blast_fp or opts.gi_list_fp:
+        gi_nums = read_gi_numbers(opts.blast_fp, opts.gi_list_fp)
+        sys.stderr.write("Loading %d GI numbers\n" % len(gi_nums))
+
+    # Start the workers first, so they do not inherit the pipes.
+    pool = None
+    if opts.processes > 1:
+        pool = Pool(opts.processes)
+    if opts.taxid_fp is None:
+        taxid_f = StringIO.StringIO()
+    else:
+        taxid_f = open_gzip(opts.taxid_fp)
+    accession_fs = [open_gzip(fp) for fp in opts.accession_fp]
+    nodes_f = open_tar_member(opts.taxdmp_fp, "nodes.dmp")
+    names_f = open_tar_member(opts.taxdmp_fp, "names.dmp")
+    try:
+        tables = taxonomy_rows(
+            taxid_f, nodes_f, names_f, gi_nums, pool, accession_fs)
+        if opts.bulk:
+            if resume:
+                sys.stderr.write("Resuming load of %s\n" % opts.db_fp)
+            loader = bulk_load(
+                opts.db_fp, tables,
+                chunk_size=opts.chunk_size, progress=_report_progress)
+            peak_disk_usage = loader.peak_disk_usage
+        else:
+            init_db(opts.db_fp)
+            for table, rows in tables:
+                insert_rows(opts.db_fp, table, rows)
+            # The default path is measured at the end only.
+            peak_disk_usage = disk_usage(opts.db_fp)
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        for f in [taxid_f, nodes_f, names_f] + accession_fs:
+            f.close()
+    if opts.lineages:
+        insert_lineages(opts.db_fp)
+        peak_disk_usage = max(peak_disk_usage, disk_usage(opts.db_fp))
+    sys.stderr.write(
+        "Built %s in %.1f s, peak disk usage %.1f MB\n" % (
+            opts.db_fp, time.time() - start, peak_disk_usage / 1e6))
+
 
-    init_db(opts.db_fp)
-    insert_taxid(opts.db_fp, taxid_f)
-    insert_nodes(opts.db_fp, nodes_f)
-    insert_names(opts.db_fp, names_f)
+def _report_progress(table, num_rows):
+    sys.stderr.write("Loaded %d rows into %s\n" % (num_rows, table))
@@ -0,0 +1,529 @@
+"""Memory-mapped binary index of the NCBI taxonomy.
+
+The index holds only what is needed to classify BLAST hits: the parent,
+rank, and name of each taxon, and the taxon ID for each GI number or
+accession.  Taxon data is stored in fixed-width arrays indexed by taxon
+ID, and names in a blob of null-terminated strings.  GI numbers and
+accessions are stored in sorted arrays, searched by bisection.
+
+The file is opened with mmap, so opening an index takes the same time
+regardless of its size, and every process on a machine shares the same
+pages.
+
+GI numbers, and the numbers of accessions, are stored as unsigned
+32-bit ints.  Larger numbers cannot be indexed, and stop the build with
+a TaxonomyIndexError; use a SQLite taxonomy database for such files.
+"""
+import mmap
+import optparse
+import os.path
+import struct
+import StringIO
+import sys
+import tempfile
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+from heapq import merge
+from multiprocessing import Pool
+
+from brocclib.parse import is_accession
+from brocclib.taxonomy_db import (
+    taxonomy_rows, split_accession, read_gi_numbers, open_gzip,
+    open_tar_member,
+    )
+
+MAGIC = "BROCCIDX"
+VERSION = 1
+# Written in native byte order, to check the byte order when reading.
+BYTE_ORDER_MARK = 0x01020304
+
+_header = struct.Struct("=8sIII")
+_section = struct.Struct("=16sQQ")
+_int = struct.Struct("=i")
+_uint = struct.Struct("=I")
+
+# Sections in file order, with array type codes.  Blob sections hold
+# null-terminated strings.
+SECTIONS = [
+    ("parents", "i"),
+    ("ranks", "B"),
+    ("name_offsets", "I"),
+    ("names", None),
+    ("rank_names", None),
+    ("gi_keys", "I"),
+    ("gi_taxids", "i"),
+    ("prefix_offsets", "I"),
+    ("prefixes", None),
+    ("prefix_ids", "I"),
+    ("acc_prefix_ids", "I"),
+    ("acc_numbers", "I"),
+    ("acc_taxids", "i"),
+    ]
+
+NO_PARENT = -1
+NO_NAME = 0xFFFFFFFF
+MAX_KEY = 0xFFFFFFFF
+
+# Sorted keys are bisected in the file until this many are left, then
+# read into an array and bisected there.
+SEARCH_BLOCK = 256
+
+# Accessions are sorted in chunks of this many, which are written to
+# temporary files and merged, reading this many rows at a time.
+SORT_CHUNK_SIZE = 1000000
+MERGE_BLOCK_SIZE = 10000
+
+
+def _sorted_order(keys):
+    return sorted(xrange(len(keys)), key=keys.__getitem__)
+
+
+def _take(typecode, values, order):
+    return array(typecode, (values[i] for i in order))
+
+
+def _prefix_key(prefix, num_digits):
+    return "%s\t%d" % (prefix, num_digits)
+
+
+class TaxonomyIndexError(ValueError):
+    pass
+
+
+def _check_key(key, kind, id_string):
+    if key > MAX_KEY:
+        raise TaxonomyIndexError(
+            "Cannot index %s %s: numbers in a taxonomy index must be no "
+            "larger than %d.  Use create_ncbi_taxonomy_db.py for this "
+            "file instead." % (kind, id_string, MAX_KEY))
+    return key
+
+
+def _build_taxa(node_rows, name_rows):
+    tax_ids = array("i")
+    parent_ids = array("i")
+    rank_codes = array("B")
+    rank_names = []
+    rank_index = {}
+    for tax_id, parent_id, rank in node_rows:
+        code = rank_index.get(rank)
+        if code is None:
+            code = rank_index[rank] = len(rank_names)
+            rank_names.append(rank)
+        tax_ids.append(int(tax_id))
+        parent_ids.append(int(parent_id))
+        rank_codes.append(code)
+
+    num_taxa = max(tax_ids) + 1 if tax_ids else 0
+    parents = array("i", [NO_PARENT]) * num_taxa
+    ranks = array("B", [0]) * num_taxa
+    for tax_id, parent_id, code in zip(tax_ids, parent_ids, rank_codes):
+        parents[tax_id] = parent_id
+        ranks[tax_id] = code
+
+    name_offsets = array("I", [NO_NAME]) * num_taxa
+    names = []
+    offset = 0
+    for tax_id, name in name_rows:
+        tax_id = int(tax_id)
+        if tax_id < num_taxa:
+            name_offsets[tax_id] = offset
+            names.append(name)
+            offset += len(name) + 1
+    return {
+        "parents": parents,
+        "ranks": ranks,
+        "name_offsets": name_offsets,
+        "names": "".join(n + "\0" for n in names),
+        "rank_names": "".join(r + "\0" for r in rank_names),
+        }
+
+
+def _build_gis(taxid_rows):
+    keys = array("I")
+    taxids = array("i")
+    is_sorted = True
+    last_key = -1
+    for gi_num, tax_id in taxid_rows:
+        key = _check_key(int(gi_num), "GI number", gi_num)
+        is_sorted = is_sorted and (key > last_key)
+        last_key = key
+        keys.append(key)
+        taxids.append(int(tax_id))
+    # NCBI's files are sorted already.
+    if not is_sorted:
+        order = _sorted_order(keys)
+        keys = _take("I", keys, order)
+        taxids = _take("i", taxids, order)
+    return {"gi_keys": keys, "gi_taxids": taxids}
+
+
+def _sort_chunk(prefix_ids, numbers, taxids):
+    # Write a chunk of accession rows to a temporary file, sorted by
+    # prefix, then by number.
+    keys = [(p << 32) | n for p, n in zip(prefix_ids, numbers)]
+    rows = array("I")
+    for i in _sorted_order(keys):
+        rows.extend((prefix_ids[i], numbers[i], taxids[i]))
+    f = tempfile.TemporaryFile()
+    rows.tofile(f)
+    f.seek(0)
+    return f
+
+
+def _iter_sorted_chunk(f, chunk_num):
+    # The chunk number keeps the order of equal keys from the input.
+    while True:
+        rows = array("I")
+        try:
+            rows.fromfile(f, 3 * MERGE_BLOCK_SIZE)
+        except EOFError:
+            # The rows before the end are still read
+            pass
+        if not rows:
+            return
+        for i in xrange(0, len(rows), 3):
+            yield rows[i], rows[i + 1], chunk_num, rows[i + 2]
+
+
+def _build_accessions(accession_rows):
+    prefix_ids = {}
+    chunk = (array("I"), array("I"), array("I"))
+    chunk_fs = []
+    try:
+        for accession, tax_id in accession_rows:
+            prefix, num_digits, number = split_accession(accession)
+            key = _prefix_key(prefix, num_digits)
+            prefix_id = prefix_ids.get(key)
+            if prefix_id is None:
+                prefix_id = prefix_ids[key] = len(prefix_ids)
+            chunk[0].append(prefix_id)
+            chunk[1].append(_check_key(number, "accession", accession))
+            chunk[2].append(int(tax_id))
+            if len(chunk[0]) >= SORT_CHUNK_SIZE:
+                chunk_fs.append(_sort_chunk(*chunk))
+                chunk = (array("I"), array("I"), array("I"))
+        if chunk[0]:
+            chunk_fs.append(_sort_chunk(*chunk))
+        del chunk
+
+        acc_prefix_ids = array("I")
+        acc_numbers = array("I")
+        acc_taxids = array("i")
+        for prefix_id, number, _, tax_id in merge(*[
+                _iter_sorted_chunk(f, i) for i, f in enumerate(chunk_fs)]):
+            acc_prefix_ids.append(prefix_id)
+            acc_numbers.append(number)
+            acc_taxids.append(tax_id)
+    finally:
+        for f in chunk_fs:
+            f.close()
+
+    prefixes = sorted(prefix_ids)
+    prefix_offsets = array("I")
+    offset = 0
+    for prefix in prefixes:
+        prefix_offsets.append(offset)
+        offset += len(prefix) + 1
+    return {
+        "prefix_offsets": prefix_offsets,
+        "prefixes": "".join(p + "\0" for p in prefixes),
+        "prefix_ids": array("I", (prefix_ids[p] for p in prefixes)),
+        "acc_prefix_ids": acc_prefix_ids,
+        "acc_numbers": acc_numbers,
+        "acc_taxids": acc_taxids,
+        }
+
+
+def compile_index(index_fp, tables):
+    """Write a taxonomy index.
+
+    Tables are given as (table, rows) pairs, as returned by
+    taxonomy_db.taxonomy_rows().
+    """
+    tables = dict(tables)
+    data = _build_gis(tables.get("gi_taxid", []))
+    data.update(_build_accessions(tables.get("accession_taxid", [])))
+    data.update(_build_taxa(tables["nodes"], tables["names"]))
+
+    header_size = _header.size + _section.size * len(SECTIONS)
+    offset = header_size
+    section_headers = []
+    for name, _ in SECTIONS:
+        # Align each section to 8 bytes
+        offset += -offset % 8
+        size = len(data[name])
+        if isinstance(data[name], array):
+            size *= data[name].itemsize
+        section_headers.append(_section.pack(name, offset, size))
+        offset += size
+
+    with open(index_fp, "wb") as f:
+        f.write(_header.pack(MAGIC, VERSION, BYTE_ORDER_MARK, len(SECTIONS)))
+        f.write("".join(section_headers))
+        for name, _ in SECTIONS:
+            f.write("\0" * (-f.tell() % 8))
+            if isinstance(data[name], array):
+                data[name].tofile(f)
+            else:
+                f.write(data[name])
+
+
+class TaxonomyIndex(object):
+    """Look up taxonomy in a memory-mapped taxonomy index.
+
+    Provides the same interface as taxonomy_db.NcbiTaxonomyDb, so it
+    may be used as the taxonomy database for the Assigner.
+    """
+    def __init__(self, index_fp):
+        self.index_fp = index_fp
+        with open(index_fp, "rb") as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, byte_order, num_sections = _header.unpack_from(
+            self.mm, 0)
+        if magic != MAGIC:
+            raise ValueError("Not a taxonomy index: %s" % index_fp)
+        if version != VERSION:
+            raise ValueError(
+                "Taxonomy index version %d not supported" % version)
+        if byte_order != BYTE_ORDER_MARK:
+            raise ValueError(
+                "Taxonomy index was written with a different byte order")
+
+        self.offsets = {}
+        self.counts = {}
+        typecodes = dict(SECTIONS)
+        for i in range(num_sections):
+            name, offset, size = _section.unpack_from(
+                self.mm, _header.size + i * _section.size)
+            name = name.rstrip("\0")
+            self.offsets[name] = offset
+            typecode = typecodes.get(name)
+            if typecode is None:
+                self.counts[name] = size
+            else:
+                self.counts[name] = size // array(typecode).itemsize
+
+        self.num_taxa = self.counts["parents"]
+        self.num_gis = self.counts["gi_keys"]
+        self.num_prefixes = self.counts["prefix_offsets"]
+        self.num_accessions = self.counts["acc_numbers"]
+        rank_names_start = self.offsets["rank_names"]
+        rank_names_end = rank_names_start + self.counts["rank_names"]
+        self.rank_names = self.mm[
+            rank_names_start:rank_names_end].split("\0")[:-1]
+        self._prefix_ids = {}
+        self._parents = self.offsets["parents"]
+        self._ranks = self.offsets["ranks"]
+        self._name_offsets = self.offsets["name_offsets"]
+        self._names = self.offsets["names"]
+
+    def close(self):
+        self.mm.close()
+
+    def get_parent(self, taxon_id):
+        """Return the parent of a taxon, or None if the taxon is missing.
+        """
+        if not 0 <= taxon_id < self.num_taxa:
+            return None
+        parent_id = _int.unpack_from(self.mm, self._parents + 4 * taxon_id)[0]
+        if parent_id == NO_PARENT:
+            return None
+        return parent_id
+
+    def get_rank(self, taxon_id):
+        return self.rank_names[ord(self.mm[self._ranks + taxon_id])]
+
+    def get_name(self, taxon_id):
+        offset = _uint.unpack_from(
+            self.mm, self._name_offsets + 4 * taxon_id)[0]
+        if offset == NO_NAME:
+            return None
+        start = self._names + offset
+        return self.mm[start:self.mm.find("\0", start)]
+
+    def _get_node(self, taxon_id):
+        parent_id = self.get_parent(taxon_id)
+        if parent_id is None:
+            return None
+        return parent_id, self.get_rank(taxon_id), self.get_name(taxon_id)
+
+    def _get_string(self, section, offset):
+        start = self.offsets[section] + offset
+        return self.mm[start:self.mm.find("\0", start)]
+
+    def _get_uint(self, section, i):
+        return _uint.unpack_from(self.mm, self.offsets[section] + 4 * i)[0]
+
+    def _get_int(self, section, i):
+        return _int.unpack_from(self.mm, self.offsets[section] + 4 * i)[0]
+
+    def _bisect(self, section, key, lo, hi, right=False):
+        """Bisect a sorted array of unsigned ints in the index.
+
+        Returns the position where the key would be inserted, to the
+        left or right of any equal keys.
+        """
+        offset = self.offsets[section]
+        while hi - lo > SEARCH_BLOCK:
+            mid = (lo + hi) // 2
+            mid_key = _uint.unpack_from(self.mm, offset + 4 * mid)[0]
+            if (mid_key < key) or (right and mid_key == key):
+                lo = mid + 1
+            else:
+                hi = mid
+        keys = array("I", self.mm[offset + 4 * lo:offset + 4 * hi])
+        if right:
+            return lo + bisect_right(keys, key)
+        return lo + bisect_left(keys, key)
+
+    def _find(self, section, key, lo, hi):
+        # Position of a key in a sorted array, or None if not found
+        i = self._bisect(section, key, lo, hi)
+        if (i < hi) and (self._get_uint(section, i) == key):
+            return i
+        return None
+
+    def get_taxon_id(self, gi_num):
+        """Return the taxon ID for a GI number or accession."""
+        if gi_num is None:
+            return None
+        if is_accession(gi_num):
+            return self._get_accession_taxon_id(gi_num)
+        key = int(gi_num)
+        if key > MAX_KEY:
+            return None
+        i = self._find("gi_keys", key, 0, self.num_gis)
+        if i is None:
+            return None
+        return self._get_int("gi_taxids", i)
+
+    def _get_prefix_id(self, prefix_key):
+        # Prefixes are few, so they are kept once found.
+        if prefix_key not in self._prefix_ids:
+            prefix_id = None
+            lo = 0
+            hi = self.num_prefixes
+            while lo < hi:
+                mid = (lo + hi) // 2
+                mid_key = self._get_string(
+                    "prefixes", self._get_uint("prefix_offsets", mid))
+                if mid_key < prefix_key:
+                    lo = mid + 1
+                elif mid_key > prefix_key:
+                    hi = mid
+                else:
+                    prefix_id = self._get_uint("prefix_ids", mid)
+                    break
+            self._prefix_ids[prefix_key] = prefix_id
+        return self._prefix_ids[prefix_key]
+
+    def _get_accession_taxon_id(self, accession):
+        prefix, num_digits, number = split_accession(accession)
+        prefix_id = self._get_prefix_id(_prefix_key(prefix, num_digits))
+        if (prefix_id is None) or (number > MAX_KEY):
+            return None
+        # Accessions are sorted by prefix, then by number.
+        lo = self._bisect("acc_prefix_ids", prefix_id, 0, self.num_accessions)
+        hi = self._bisect(
+            "acc_prefix_ids", prefix_id, lo, self.num_accessions, right=True)
+        i = self._find("acc_numbers", number, lo, hi)
+        if i is None:
+            return None
+        return self._get_int("acc_taxids", i)
+
+    def get_lineage(self, taxon_id):
+        """Return the lineage of a taxon as a dict of names by rank.
+
+        The dict has the same form as the one returned by
+        taxonomy_db.NcbiTaxonomyDb.get_lineage().
+        """
+        taxon_id = int(taxon_id)
+        node = self._get_node(taxon_id)
+        if node is None:
+            return None
+        parent_id, rank, name = node
+
+        # Walk up the tree to the root, which is its own parent.
+        ancestors = []
+        current_id = taxon_id
+        while parent_id != current_id:
+            current_id = parent_id
+            node = self._get_node(current_id)
+            if node is None:
+                break
+            parent_id, ancestor_rank, ancestor_name = node
+            if parent_id != current_id:
+                ancestors.append((ancestor_rank, ancestor_name))
+        ancestors.reverse()
+
+        taxon_dict = dict(ancestors)
+        # Include lowest rank in lineage
+        if rank not in taxon_dict:
+            taxon_dict[rank] = name
+        # Also include the lineage as a string
+        taxon_dict["Lineage"] = "; ".join(n for _, n in ancestors)
+        return taxon_dict
+
+
+def main(argv=None):
+    p = optparse.OptionParser()
+    p.add_option("--taxid_fp", help="Path to gzipped taxid file")
+    p.add_option("--accession_fp", action="append", default=[], help=(
+        "Path to gzipped accession2taxid file, such as "
+        "nucl_gb.accession2taxid.gz.  May be given more than once."))
+    p.add_option("--taxdmp_fp", help="Path to tar-gzipped taxdmp file")
+    p.add_option("--index_fp", help="Output filepath for taxonomy index")
+    p.add_option("--blast_fp", action="append", default=[], help=(
+        "Include only the GI numbers found in this BLAST output file, "
+        "and the taxa needed to classify them.  May be given more than "
+        "once."))
+    p.add_option("--gi_list_fp", action="append", default=[], help=(
+        "Include only the GI numbers in this file, one per line, and the "
+        "taxa needed to classify them.  May be given more than once."))
+    p.add_option("-p", "--processes", type="int", default=1, help=(
+        "Number of worker processes used to parse the input files "
+        "[default: %default]"))
+    opts, args = p.parse_args(argv)
+
+    if opts.index_fp is None:
+        p.error("Please provide an output filepath for the index.")
+    if os.path.exists(opts.index_fp):
+        p.error("Index file already exists.  Please delete first.")
+    if (opts.taxid_fp is None) and (not opts.accession_fp):
+        p.error("Please provide a taxid file or an accession2taxid file.")
+    for fp in [opts.taxid_fp, opts.taxdmp_fp] + opts.accession_fp:
+        if (fp is not None) and (not os.path.exists(fp)):
+            p.error("File not found: %s" % fp)
+
+    start = time.time()
+    gi_nums = None
+    if opts.blast_fp or opts.gi_list_fp:
+        gi_nums = read_gi_numbers(opts.blast_fp, opts.gi_list_fp)
+
+    pool = None
+    if opts.processes > 1:
+        pool = Pool(opts.processes)
+    if opts.taxid_fp is None:
+        taxid_f = StringIO.StringIO()
+    else:
+        taxid_f = open_gzip(opts.taxid_fp)
+    accession_fs = [open_gzip(fp) for fp in opts.accession_fp]
+    nodes_f = open_tar_member(opts.taxdmp_fp, "nodes.dmp")
+    names_f = open_tar_member(opts.taxdmp_fp, "names.dmp")
+    try:
+        tables = taxonomy_rows(
+            taxid_f, nodes_f, names_f, gi_nums, pool, accession_fs)
+        compile_index(opts.index_fp, tables)
+    except TaxonomyIndexError as e:
+        p.error(str(e))
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        for f in [taxid_f, nodes_f, names_f] + accession_fs:
+            f.close()
+    sys.stderr.write("Built %s in %.1f s, size %.1f MB\n" % (
+        opts.index_fp, time.time() - start,
+        os.path.getsize(opts.index_fp) / 1e6))
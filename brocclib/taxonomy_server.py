@@ -0,0 +1,318 @@
+"""Taxonomy server, shared by many brocc.py jobs on the same machine.
+
+The server opens one taxonomy source, a local database, a taxonomy
+index, or the NCBI web service with its cache file, and keeps the
+lineages it has looked up in memory.  Jobs connect to it over a Unix
+socket, or a TCP port on localhost, with a TaxonomyClient in place of
+their own taxonomy source.  The source is opened once, rather than
+once for each job.
+
+Requests and responses are JSON objects, one per line.  A request
+gives a method, "get_taxon_ids" or "get_lineages", and a list of IDs.
+The response gives a list of results, in the same order as the IDs,
+or an error message:
+
+    {"method": "get_taxon_ids", "ids": ["312434489", "5"]}
+    {"result": ["531911", null]}
+
+Every lookup is made in one thread, which owns the taxonomy source,
+so that SQLite connections are never shared between threads.
+Connections are handled in threads of their own.
+"""
+import json
+import optparse
+import os
+import Queue
+import signal
+import socket
+import SocketServer
+import sys
+import threading
+
+from brocclib.taxonomy import (
+    LineageCache, NoLineage, intern_taxon, intern_lineage_dict,
+    )
+
+# Cached for taxa with no lineage, as the cache gives None for a miss
+_NO_LINEAGE = NoLineage()
+
+
+class TaxonomyServerError(Exception):
+    pass
+
+
+def parse_address(address):
+    """Return a (host, port) pair for host:port, or a Unix socket path."""
+    host, sep, port = address.rpartition(":")
+    if sep and port.isdigit() and ("/" not in address):
+        return (host or "localhost", int(port))
+    return address
+
+
+class TaxonomyService(object):
+    """Answers batches of lookups in a thread that owns the taxonomy.
+
+    The taxonomy source is opened in the thread, by calling
+    open_taxa_db.  If it cannot be opened, the error is raised here.
+    """
+    methods = ["get_taxon_ids", "get_lineages"]
+
+    def __init__(self, open_taxa_db, lineage_cache_size=100000):
+        self.lineage_cache = LineageCache(lineage_cache_size)
+        self._requests = Queue.Queue()
+        started = Queue.Queue(1)
+        self._thread = threading.Thread(
+            target=self._run, args=(open_taxa_db, started))
+        self._thread.daemon = True
+        self._thread.start()
+        error = started.get()
+        if error is not None:
+            raise error
+
+    def _run(self, open_taxa_db, started):
+        try:
+            taxa_db = open_taxa_db()
+        except Exception as e:
+            started.put(e)
+            return
+        started.put(None)
+        while True:
+            request = self._requests.get()
+            if request is None:
+                break
+            method, ids, reply = request
+            try:
+                reply.put((True, getattr(self, "_" + method)(taxa_db, ids)))
+            except Exception as e:
+                reply.put((False, "%s: %s" % (e.__class__.__name__, e)))
+        if hasattr(taxa_db, "save_cache"):
+            taxa_db.save_cache()
+
+    def _get_taxon_ids(self, taxa_db, gi_nums):
+        if hasattr(taxa_db, "prefetch"):
+            taxa_db.prefetch(gi_nums)
+        return [taxa_db.get_taxon_id(gi) for gi in gi_nums]
+
+    def _get_lineages(self, taxa_db, taxon_ids):
+        lineages = []
+        for taxon_id in taxon_ids:
+            lineage = self.lineage_cache.get(taxon_id)
+            if lineage is None:
+                lineage = taxa_db.get_lineage(taxon_id)
+                if lineage is None:
+                    self.lineage_cache.put(taxon_id, _NO_LINEAGE)
+                else:
+                    self.lineage_cache.put(taxon_id, lineage)
+            elif lineage is _NO_LINEAGE:
+                lineage = None
+            lineages.append(lineage)
+        return lineages
+
+    def lookup(self, method, ids):
+        """Return a list of results, one for each ID."""
+        if method not in self.methods:
+            raise TaxonomyServerError("Unknown method: %s" % method)
+        if not isinstance(ids, list):
+            raise TaxonomyServerError("IDs must be given as a list")
+        reply = Queue.Queue(1)
+        self._requests.put((method, ids, reply))
+        ok, result = reply.get()
+        if not ok:
+            raise TaxonomyServerError(result)
+        return result
+
+    def close(self):
+        """Stop the thread, and close the taxonomy source."""
+        self._requests.put(None)
+        self._thread.join()
+
+
+class TaxonomyRequestHandler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                break
+            try:
+                request = json.loads(line)
+                response = {"result": self.server.service.lookup(
+                    request["method"], request["ids"])}
+            except (ValueError, KeyError, TypeError,
+                    TaxonomyServerError) as e:
+                response = {"error": str(e)}
+            self.wfile.write(json.dumps(response) + "\n")
+
+
+class UnixTaxonomyServer(SocketServer.ThreadingMixIn,
+                         SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+
+class TcpTaxonomyServer(SocketServer.ThreadingMixIn,
+                        SocketServer.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def make_server(address, service):
+    """Make a server for a taxonomy service, listening at an address."""
+    address = parse_address(address)
+    if isinstance(address, tuple):
+        server = TcpTaxonomyServer(address, TaxonomyRequestHandler)
+    else:
+        server = UnixTaxonomyServer(address, TaxonomyRequestHandler)
+    server.service = service
+    return server
+
+
+def _to_str(value):
+    # Names are byte strings elsewhere in brocc, as JSON gives unicode
+    if isinstance(value, unicode):
+        return value.encode("utf-8")
+    return value
+
+
+def _taxon_id_value(taxon_id):
+    return intern_taxon(_to_str(taxon_id))
+
+
+def _lineage_value(lineage):
+    if lineage is None:
+        return None
+    return intern_lineage_dict(dict(
+        (_to_str(k), _to_str(v)) for k, v in lineage.iteritems()))
+
+
+class TaxonomyClient(object):
+    """Look up taxonomy in a taxonomy server.
+
+    Provides the same interface as get_xml.NcbiEutils, so it may be
+    used as the taxonomy database for the Assigner.  Results are kept
+    in memory, and prefetch() looks up many GI numbers in a few
+    requests.
+    """
+    def __init__(self, address, batch_size=1000):
+        self.address = address
+        self.batch_size = batch_size
+        self.taxon_ids = {}
+        self.lineages = {}
+        self.requests = 0
+        self._sock = None
+        self._rfile = None
+
+    def _connect(self):
+        address = parse_address(self.address)
+        if isinstance(address, tuple):
+            sock = socket.create_connection(address)
+        else:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.connect(address)
+        self._sock = sock
+        self._rfile = sock.makefile("rb")
+
+    def _call(self, method, ids):
+        if self._sock is None:
+            self._connect()
+        self._sock.sendall(json.dumps({"method": method, "ids": ids}) + "\n")
+        self.requests += 1
+        line = self._rfile.readline()
+        if not line:
+            self.close()
+            raise TaxonomyServerError(
+                "Connection closed by taxonomy server %s" % self.address)
+        response = json.loads(line)
+        if "error" in response:
+            raise TaxonomyServerError(response["error"])
+        return response["result"]
+
+    def _lookup(self, method, memory, ids, convert):
+        new_ids = sorted(set(i for i in ids if i not in memory))
+        for i in xrange(0, len(new_ids), self.batch_size):
+            batch = new_ids[i:i + self.batch_size]
+            for key, value in zip(batch, self._call(method, batch)):
+                memory[key] = convert(value)
+
+    def get_taxon_id(self, gi_num):
+        if gi_num not in self.taxon_ids:
+            self._lookup(
+                "get_taxon_ids", self.taxon_ids, [gi_num], _taxon_id_value)
+        return self.taxon_ids[gi_num]
+
+    def get_lineage(self, taxon_id):
+        if taxon_id not in self.lineages:
+            self._lookup(
+                "get_lineages", self.lineages, [taxon_id], _lineage_value)
+        return self.lineages[taxon_id]
+
+    def prefetch(self, gi_nums):
+        """Look up taxon IDs and lineages for many GI numbers at once."""
+        gi_nums = set(gi for gi in gi_nums if gi is not None)
+        self._lookup(
+            "get_taxon_ids", self.taxon_ids, gi_nums, _taxon_id_value)
+        taxon_ids = set(self.taxon_ids[gi] for gi in gi_nums)
+        taxon_ids.discard(None)
+        self._lookup("get_lineages", self.lineages, taxon_ids, _lineage_value)
+
+    def close(self):
+        if self._sock is not None:
+            self._rfile.close()
+            self._sock.close()
+            self._sock = None
+            self._rfile = None
+
+
+def _exit(signum, frame):
+    sys.exit(0)
+
+
+def main(argv=None):
+    # The command module imports this one
+    from brocclib.command import open_taxa_db
+
+    p = optparse.OptionParser(description=(
+        "Serve taxonomy lookups to brocc.py jobs, which connect with "
+        "the --taxonomy_server option."))
+    p.add_option("--address", help=(
+        "path of a Unix socket to listen on, or host:port for a TCP port, "
+        "e.g. localhost:8123 [REQUIRED]"))
+    p.add_option("--taxonomy_db_fp", help=(
+        "SQLite database of the NCBI taxonomy, created with "
+        "create_ncbi_taxonomy_db.py"))
+    p.add_option("--taxonomy_index_fp", help=(
+        "Binary index of the NCBI taxonomy, created with "
+        "create_taxonomy_index.py"))
+    p.add_option("--cache_fp", help=(
+        "Cache file for data retrieved from NCBI, if neither a database "
+        "nor an index is given"))
+    p.add_option("--ncbi_batch_size", type="int", default=100, help=(
+        "number of IDs to look up in each request to NCBI "
+        "[default: %default]"))
+    p.add_option("--ncbi_workers", type="int", default=1, help=(
+        "number of concurrent requests to NCBI [default: %default]"))
+    p.add_option("--ncbi_api_key", help=(
+        "NCBI API key, which allows for a higher rate of requests"))
+    p.add_option("--lineage_cache_size", type="int", default=100000, help=(
+        "maximum number of lineages to keep in memory "
+        "[default: %default]"))
+    opts, args = p.parse_args(argv)
+
+    if not opts.address:
+        p.error("Please provide an address to listen on.")
+    address = parse_address(opts.address)
+    if (not isinstance(address, tuple)) and os.path.exists(address):
+        p.error("Socket file already exists.  Please delete first.")
+
+    service = TaxonomyService(
+        lambda: open_taxa_db(opts), opts.lineage_cache_size)
+    server = make_server(opts.address, service)
+    signal.signal(signal.SIGTERM, _exit)
+    sys.stderr.write("Taxonomy server listening at %s\n" % opts.address)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+        if not isinstance(address, tuple):
+            os.remove(address)
@@ -0,0 +1,4 @@
+#!/usr/bin/env python
+from brocclib.taxonomy_server import main
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,4 @@
+#!/usr/bin/env python
+from brocclib.taxonomy_index import main
+if __name__ == "__main__":
+    main()
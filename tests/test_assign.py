@@ -0,0 +1,93 @@
+import unittest
+
+from brocclib.assign import Assigner
+from brocclib.parse import BlastHit
+from brocclib.taxonomy import LineageCache
+
+
+class FakeTaxaDb(object):
+    taxon_ids = {"1": "10", "2": "10", "3": "20", "4": "30"}
+    candida = {
+        "genus": "Candida",
+        "order": "Saccharomycetales",
+        "class": "Saccharomycetes",
+        "phylum": "Ascomycota",
+        "kingdom": "Fungi",
+        "superkingdom": "Eukaryota",
+        "Lineage": (
+            "cellular organisms; Eukaryota; Fungi; Ascomycota; "
+            "Saccharomycetes; Saccharomycetales; Candida"),
+        }
+    lineages = {
+        "10": dict(candida, species="Candida albicans"),
+        "20": dict(candida, species="Candida tropicalis"),
+        }
+
+    def __init__(self):
+        self.lineage_requests = []
+
+    def get_taxon_id(self, gi):
+        return self.taxon_ids.get(gi)
+
+    def get_lineage(self, taxon_id):
+        self.lineage_requests.append(taxon_id)
+        return self.lineages.get(taxon_id)
+
+
+def make_assigner(taxa_db, **kwargs):
+    return Assigner(
+        .7, 95.2, 83.05, 80.0, [.6, .6, .6, .9, .9, .9, .9, .9], .7,
+        taxa_db, **kwargs)
+
+
+class AssignerTests(unittest.TestCase):
+    def test_assign(self):
+        a = make_assigner(FakeTaxaDb())
+        hits = [
+            BlastHit("1", 99.0, 10), BlastHit("2", 99.0, 10),
+            BlastHit("3", 98.0, 10)]
+        obs = a.assign("q", "A" * 10, hits)
+        self.assertEqual(
+            obs.format_for_standard_taxonomy(),
+            "q\tEukaryota;Fungi;Ascomycota;Saccharomycetes;"
+            "Saccharomycetales;Candida (family);Candida;Candida albicans\n")
+
+    def test_vote_at_rank(self):
+        db = FakeTaxaDb()
+        a = make_assigner(db)
+        db_hits = [
+            (99.0, a._retrieve_lineage("1")), (99.0, a._retrieve_lineage("3")),
+            (90.0, a._retrieve_lineage("3")), (99.0, a._retrieve_lineage("4"))]
+        self.assertEqual(a.vote_at_rank("q", "species", db_hits), None)
+        obs = a.vote_at_rank("q", "genus", db_hits)
+        self.assertEqual(obs.winning_candidate.votes, 3)
+        self.assertEqual(obs.total_votes, 3)
+        self.assertEqual(obs.winning_candidate.rank, "genus")
+
+    def test_lineage_cache(self):
+        db = FakeTaxaDb()
+        a = make_assigner(db)
+        hits = [BlastHit(gi, 99.0, 10) for gi in ["1", "2", "3", "4", "5"]]
+        a.assign("q1", "A" * 10, hits)
+        a.assign("q2", "A" * 10, hits[:3])
+        self.assertEqual(db.lineage_requests, ["10", "20", "30"])
+        self.assertEqual(a.lineage_cache.hits, 4)
+        self.assertEqual(a.lineage_cache.misses, 3)
+
+
+class LineageCacheTests(unittest.TestCase):
+    def test_lru(self):
+        c = LineageCache(2)
+        c.put("a", 1)
+        c.put("b", 2)
+        self.assertEqual(c.get("a"), 1)
+        c.put("c", 3)
+        self.assertEqual(c.get("b"), None)
+        self.assertEqual(c.get("a"), 1)
+        self.assertEqual(c.get("c"), 3)
+        self.assertEqual(len(c), 2)
+        self.assertEqual((c.hits, c.misses), (3, 1))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,15 +1,63 @@
+import bz2
+import gzip
+import itertools
+import json
 import os.path
+import random
 import shutil
+import sqlite3
 import tempfile
+import threading
 import unittest
+from xml.sax.saxutils import escape
 
+from brocclib import command
 from brocclib.command import main
+from brocclib.parse import iter_blast, iter_fasta
+from brocclib.taxonomy_db import init_db, NcbiTaxonomyDb
+from brocclib.taxonomy_server import TaxonomyService, make_server
 
 def data_fp(filename):
     return os.path.join(
         os.path.dirname(os.path.realpath(__file__)), 'data', filename)
 
 
+def write_blast_xml(blast_fp, query_lengths, xml_fp):
+    """Write commented tabular BLAST output in the BLAST XML format.
+
+    Consecutive rows for the same subject are written as HSPs of one
+    hit.  Identities are recovered from the percent identity.
+    """
+    with open(blast_fp) as f:
+        queries = [
+            (query_id, list(hits)) for query_id, hits in
+            itertools.groupby(iter_blast(f), lambda x: x[0])]
+    with open(xml_fp, "w") as out:
+        out.write("<?xml version=\"1.0\"?>\n<BlastOutput>\n")
+        out.write("<BlastOutput_iterations>\n")
+        for n, (query_id, hits) in enumerate(queries):
+            out.write(
+                "<Iteration>\n<Iteration_iter-num>%d</Iteration_iter-num>\n"
+                "<Iteration_query-ID>Query_%d</Iteration_query-ID>\n"
+                "<Iteration_query-def>%s</Iteration_query-def>\n"
+                "<Iteration_query-len>%d</Iteration_query-len>\n"
+                "<Iteration_hits>\n" % (
+                    n + 1, n + 1, escape(query_id),
+                    query_lengths[query_id.split()[0]]))
+            for gi, gi_hits in itertools.groupby(
+                    (h for _, h in hits), lambda h: h.gi):
+                out.write(
+                    "<Hit>\n<Hit_id>gi|%s|</Hit_id>\n<Hit_hsps>\n" % gi)
+                for h in gi_hits:
+                    out.write(
+                        "<Hsp>\n<Hsp_identity>%d</Hsp_identity>\n"
+                        "<Hsp_align-len>%d</Hsp_align-len>\n</Hsp>\n" % (
+                            round(h.pct_id * h.length / 100), h.length))
+                out.write("</Hit_hsps>\n</Hit>\n")
+            out.write("</Iteration_hits>\n</Iteration>\n")
+        out.write("</BlastOutput_iterations>\n</BlastOutput>\n")
+
+
 def read_from(filepath):
     with open(filepath) as f:
         res = f.readlines()
@@ -92,6 +140,283 @@ class BroccAcceptance(unittest.TestCase):
             read_from(self._assignments_fp),
             read_from(data_fp("chris_combo95_assignments.txt")))
 
-        
+
+
+def make_local_db(db_fp, blast_fp):
+    """Create a local taxonomy database with made-up taxa for each GI."""
+    init_db(db_fp)
+    conn = sqlite3.connect(db_fp)
+    conn.executemany("INSERT INTO nodes VALUES (?,?,?)", [
+        (1, 1, "no rank"), (2, 1, "superkingdom"), (3, 2, "kingdom"),
+        (4, 3, "phylum"), (5, 3, "phylum"), (6, 4, "genus"),
+        (7, 6, "species"), (8, 6, "species"), (9, 5, "species"),
+        (10, 3, "species")])
+    conn.executemany("INSERT INTO names VALUES (?,?)", [
+        (1, "root"), (2, "Eukaryota"), (3, "Fungi"), (4, "Ascomycota"),
+        (5, "Basidiomycota"), (6, "Candida"), (7, "Candida albicans"),
+        (8, "Candida tropicalis"), (9, "Malassezia restricta"),
+        (10, "uncultured fungus")])
+    rng = random.Random(0)
+    with open(blast_fp) as f:
+        gi_nums = set(hit.gi for _, hit in iter_blast(f))
+    conn.executemany("INSERT INTO gi_taxid VALUES (?,?)", [
+        (gi, rng.choice([6, 7, 7, 8, 9, 10])) for gi in gi_nums])
+    conn.commit()
+    conn.close()
+
+
+class LocalDbTests(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp(prefix="brocc")
+        self.db_fp = os.path.join(self.temp_dir, "taxonomy.db")
+        make_local_db(self.db_fp, data_fp("serena_controls_blast.txt"))
+        self.fasta_fp = data_fp("serena_controls.fasta")
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def _run_brocc(self, output_dir, blast_fp, *args):
+        output_dir = os.path.join(self.temp_dir, output_dir)
+        if self.fasta_fp is not None:
+            args = ("-i", self.fasta_fp) + args
+        main([
+            "-b", blast_fp,
+            "-o", output_dir,
+            "-a", "ITS",
+            "--taxonomy_db_fp", self.db_fp,
+            ] + list(args))
+        return dict(
+            (fn, read_from(os.path.join(output_dir, fn))) for fn in
+            ["Full_Taxonomy.txt", "Standard_Taxonomy.txt", "brocc.log"])
+
+    def test_processes(self):
+        blast_fp = data_fp("serena_controls_blast.txt")
+        serial = self._run_brocc("serial", blast_fp)
+        self.assertEqual(len(serial["Standard_Taxonomy.txt"]), 41)
+        chunk_size = command.CHUNK_SIZE
+        command.CHUNK_SIZE = 4
+        try:
+            parallel = self._run_brocc("parallel", blast_fp, "-p", "3")
+        finally:
+            command.CHUNK_SIZE = chunk_size
+        self.assertEqual(serial, parallel)
+
+    def _first_word_fasta(self):
+        # Uncommented BLAST output gives only the first word of each
+        # query ID.
+        with open(self.fasta_fp) as f:
+            seqs = list(iter_fasta(f))
+        self.fasta_fp = os.path.join(self.temp_dir, "seqs.fasta")
+        with open(self.fasta_fp, "w") as f:
+            for name, seq in seqs:
+                f.write(">%s\n%s\n" % (name.split()[0], seq))
+
+    def test_unsorted_blast(self):
+        self._first_word_fasta()
+        with open(data_fp("serena_controls_blast.txt")) as f:
+            rows = [line for line in f if not line.startswith("#")]
+        # Queries out of order, with the hits for each query in order
+        queries = [
+            list(g) for _, g in
+            itertools.groupby(rows, lambda line: line.split("\t")[0])]
+        random.Random(1).shuffle(queries)
+        unsorted_fp = os.path.join(self.temp_dir, "unsorted_blast.txt")
+        with open(unsorted_fp, "w") as f:
+            for query_rows in queries:
+                f.writelines(query_rows)
+
+        with open(data_fp("serena_controls_blast.txt")) as f:
+            rows = [line for line in f if not line.startswith("#")]
+        sorted_fp = os.path.join(self.temp_dir, "sorted_blast.txt")
+        with open(sorted_fp, "w") as f:
+            f.writelines(rows)
+
+        expected = self._run_brocc("sorted", sorted_fp)
+        self.assertEqual(
+            self._run_brocc("unsorted", unsorted_fp, "-p", "2"), expected)
+
+        # Only the second pass over the queries is counted
+        self.assertEqual(self._run_brocc(
+            "profile", unsorted_fp, "--profile"), expected)
+        with open(os.path.join(
+                self.temp_dir, "profile", "brocc_stats.json")) as f:
+            stats = json.load(f)
+        self.assertEqual(stats["counts"]["queries"], 41)
+        self.assertEqual(stats["counts"]["hits"], 21278)
+        self.assertEqual(stats["query_latency"]["count"], 41)
+        self.assertTrue(stats["stages"]["write_output"] >= 0)
+        self.assertTrue("abandoned_pass" in stats["stages"])
+
+    def test_compressed_input(self):
+        with open(data_fp("serena_controls_blast.txt")) as f:
+            rows = [line for line in f if not line.startswith("#")]
+        sorted_fp = os.path.join(self.temp_dir, "sorted_blast.txt")
+        with open(sorted_fp, "w") as f:
+            f.writelines(rows)
+        expected = self._run_brocc("uncompressed", sorted_fp)
+
+        self.fasta_fp = os.path.join(self.temp_dir, "seqs.fasta.gz")
+        f = gzip.GzipFile(self.fasta_fp, "w")
+        f.write(open(data_fp("serena_controls.fasta")).read())
+        f.close()
+        # Unsorted, so the files are read a second time
+        random.Random(1).shuffle(rows)
+        blast_fp = os.path.join(self.temp_dir, "blast.txt.bz2")
+        f = bz2.BZ2File(blast_fp, "w")
+        f.writelines(rows)
+        f.close()
+
+        self.assertEqual(self._run_brocc("compressed", blast_fp), expected)
+
+    def _query_lengths(self):
+        with open(self.fasta_fp) as f:
+            return dict(
+                (name.split()[0], len(seq)) for name, seq in iter_fasta(f))
+
+    def test_query_length_fields(self):
+        expected = self._run_brocc(
+            "fasta", data_fp("serena_controls_blast.txt"))
+
+        # Columns in a different order, with query lengths
+        query_lengths = self._query_lengths()
+        blast_fp = os.path.join(self.temp_dir, "qlen_blast.txt")
+        with open(data_fp("serena_controls_blast.txt")) as f, \
+                open(blast_fp, "w") as out:
+            for line in f:
+                if line.startswith("# Fields:"):
+                    line = (
+                        "# Fields: subject id, query id, query length, "
+                        "% identity, alignment length\n")
+                elif not line.startswith("#"):
+                    vals = line.split("\t")
+                    line = "%s\t%s\t%d\t%s\t%s\n" % (
+                        vals[1], vals[0], query_lengths[vals[0]],
+                        vals[2], vals[3])
+                out.write(line)
+
+        self.fasta_fp = None
+        self.assertEqual(self._run_brocc("qlen", blast_fp), expected)
+
+    def test_query_length_outfmt(self):
+        query_lengths = self._query_lengths()
+        with open(data_fp("serena_controls_blast.txt")) as f:
+            rows = [
+                "%s\t%d\n" % (
+                    line.rstrip("\n"), query_lengths[line.split("\t")[0]])
+                for line in f if not line.startswith("#")]
+        random.Random(1).shuffle(rows)
+        blast_fp = os.path.join(self.temp_dir, "unsorted_blast.txt")
+        with open(blast_fp, "w") as f:
+            f.writelines(rows)
+        outfmt = "6 " + " ".join([
+            "qseqid", "sseqid", "pident", "length", "mismatch", "gapopen",
+            "qstart", "qend", "sstart", "send", "evalue", "bitscore", "qlen"])
+
+        self._first_word_fasta()
+        expected = self._run_brocc(
+            "fasta", blast_fp, "--blast_columns", outfmt)
+
+        self.fasta_fp = None
+        obs = self._run_brocc("qlen", blast_fp, "--blast_columns", outfmt)
+        self.assertEqual(len(obs["Standard_Taxonomy.txt"]), 41)
+        # Queries are reported in order of first appearance
+        for fn in expected:
+            self.assertEqual(sorted(obs[fn]), sorted(expected[fn]))
+
+
+    def test_no_query_lengths(self):
+        # Caught while reading the options, before any output is made
+        self.fasta_fp = None
+        self.assertRaises(
+            SystemExit, self._run_brocc, "no_qlen",
+            data_fp("serena_controls_blast.txt"))
+        self.assertFalse(
+            os.path.exists(os.path.join(self.temp_dir, "no_qlen")))
+
+    def test_blast_xml(self):
+        blast_fp = data_fp("serena_controls_blast.txt")
+        expected = self._run_brocc("tabular", blast_fp)
+
+        xml_fp = os.path.join(self.temp_dir, "blast.xml")
+        write_blast_xml(blast_fp, self._query_lengths(), xml_fp)
+        self.assertEqual(self._run_brocc("xml", xml_fp), expected)
+        # Query lengths are given in the XML output
+        self.fasta_fp = None
+        self.assertEqual(self._run_brocc("xml_only", xml_fp), expected)
+
+    def test_profile(self):
+        blast_fp = data_fp("serena_controls_blast.txt")
+        expected = self._run_brocc("plain", blast_fp)
+        self.assertEqual(
+            self._run_brocc("profile", blast_fp, "--profile"), expected)
+        with open(os.path.join(
+                self.temp_dir, "profile", "brocc_stats.json")) as f:
+            stats = json.load(f)
+        self.assertEqual(stats["counts"]["queries"], 41)
+        self.assertEqual(stats["counts"]["hits"], 21278)
+        self.assertEqual(stats["query_latency"]["count"], 41)
+        self.assertTrue(stats["stages"]["assign.vote"] > 0)
+        self.assertFalse(os.path.exists(os.path.join(
+            self.temp_dir, "plain", "brocc_stats.json")))
+
+    def test_generic_taxa(self):
+        blast_fp = data_fp("serena_controls_blast.txt")
+        expected = self._run_brocc("default", blast_fp)
+        generic_taxa_fp = os.path.join(self.temp_dir, "generic_taxa.txt")
+        with open(generic_taxa_fp, "w") as f:
+            f.write("uncultured fungus\n")
+        self.assertEqual(self._run_brocc(
+            "names", blast_fp, "--generic_taxa_fp", generic_taxa_fp),
+            expected)
+        with open(generic_taxa_fp, "w") as f:
+            f.write("regex:uncultured .*\nregex:Candida trop.*\n")
+        obs = self._run_brocc(
+            "patterns", blast_fp, "--generic_taxa_fp", generic_taxa_fp)
+        self.assertNotEqual(obs, expected)
+        self.assertFalse(any(
+            "Candida tropicalis" in line
+            for line in obs["Standard_Taxonomy.txt"]))
+
+    def test_taxonomy_server(self):
+        blast_fp = data_fp("serena_controls_blast.txt")
+        expected = self._run_brocc("local", blast_fp)
+
+        service = TaxonomyService(lambda: NcbiTaxonomyDb(self.db_fp))
+        address = os.path.join(self.temp_dir, "taxonomy.sock")
+        server = make_server(address, service)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            # The server has the database open
+            os.remove(self.db_fp)
+            self.assertEqual(self._run_brocc(
+                "server", blast_fp, "--taxonomy_server", address), expected)
+            self.assertEqual(self._run_brocc(
+                "parallel", blast_fp, "--taxonomy_server", address,
+                "-p", "2"), expected)
+        finally:
+            server.shutdown()
+            server.server_close()
+            thread.join()
+            service.close()
+
+    def test_gi_lineages(self):
+        blast_fp = data_fp("serena_controls_blast.txt")
+        expected = self._run_brocc("plain", blast_fp)
+        gi_lineages_fp = os.path.join(self.temp_dir, "gi_lineages")
+        self.assertEqual(self._run_brocc(
+            "first", blast_fp, "--gi_lineages_fp", gi_lineages_fp), expected)
+        self.assertTrue(os.path.exists(gi_lineages_fp))
+
+        # Later runs do not need the taxonomy database
+        os.remove(self.db_fp)
+        init_db(self.db_fp)
+        self.assertEqual(self._run_brocc(
+            "second", blast_fp, "--gi_lineages_fp", gi_lineages_fp), expected)
+        self.assertEqual(self._run_brocc(
+            "parallel", blast_fp, "--gi_lineages_fp", gi_lineages_fp,
+            "-p", "2"), expected)
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -2,11 +2,19 @@ import tempfile
 import unittest
 import sqlite3
 import os
+import gzip
+import tarfile
+from multiprocessing import Pool
+import shutil
 from StringIO import StringIO
 
 from brocclib.taxonomy_db import (
     init_db, parse_gi_taxid, insert_taxid, parse_names, insert_names,
-    parse_nodes, insert_nodes,
+    parse_nodes, insert_nodes, NcbiTaxonomyDb, insert_lineages,
+    BulkLoader, bulk_load, is_partial_load, taxonomy_rows, read_gi_numbers,
+    ancestor_closure, open_gzip, open_tar_member, iter_parsed,
+    DecompressedFile, split_accession, insert_accessions,
+    parse_accession2taxid,
     )
 
 class FunctionTests(unittest.TestCase):
@@ -58,6 +66,27 @@ class FunctionTests(unittest.TestCase):
             ["2", "131567", "superkingdom"],
             ["6", "335928", "genus"]])
 
+    def test_parse_accession2taxid(self):
+        obs = list(parse_accession2taxid(StringIO(accession2taxid)))
+        self.assertEqual(obs, [
+            ["HQ379286.1", "531911"], ["NR_000012.1", "4751"],
+            ["NZ_ABCD01000001.1", "2759"]])
+
+    def test_split_accession(self):
+        self.assertEqual(split_accession("HQ379286.1"), ("HQ", 6, 379286))
+        self.assertEqual(split_accession("NR_000012"), ("NR_", 6, 12))
+        self.assertEqual(
+            split_accession("NZ_ABCD01000001.1"), ("NZ_ABCD", 8, 1000001))
+        self.assertEqual(split_accession("OTU"), ("OTU", 0, 0))
+
+    def test_insert_accessions(self):
+        insert_accessions(self.db, StringIO(accession2taxid))
+        conn = sqlite3.connect(self.db)
+        self.assertEqual(list(conn.execute("SELECT * FROM accession_prefixes")),
+                         [(1, "HQ", 6), (2, "NR_", 6), (3, "NZ_ABCD", 8)])
+        self.assertEqual(list(conn.execute("SELECT * FROM accession_taxid")), [
+            (1, 379286, 531911), (2, 12, 4751), (3, 1000001, 2759)])
+
     def test_insert_nodes(self):
         f = StringIO(nodes)
         insert_nodes(self.db, f)
@@ -70,6 +99,291 @@ class FunctionTests(unittest.TestCase):
         self.assertEqual(obs, exp)
 
 
+class NcbiTaxonomyDbTests(unittest.TestCase):
+    def setUp(self):
+        _, self.db_fp = tempfile.mkstemp()
+        init_db(self.db_fp)
+        insert_taxid(self.db_fp, StringIO(lineage_gi_taxid))
+        insert_nodes(self.db_fp, StringIO(lineage_nodes))
+        insert_names(self.db_fp, StringIO(lineage_names))
+        self.db = NcbiTaxonomyDb(self.db_fp)
+
+    def tearDown(self):
+        os.remove(self.db_fp)
+
+    def test_get_taxon_id(self):
+        self.assertEqual(self.db.get_taxon_id("312434489"), 531911)
+        self.assertEqual(self.db.get_taxon_id("12"), None)
+        self.assertEqual(self.db.get_taxon_id(None), None)
+
+    def test_get_lineage(self):
+        # Same as the lineage retrieved from NCBI in test_get_xml.py
+        expected_lineage = {
+            'Lineage': (
+                'cellular organisms; Eukaryota; Opisthokonta; Fungi; Dikarya; '
+                'Ascomycota; saccharomyceta; Pezizomycotina; leotiomyceta; '
+                'sordariomyceta; Sordariomycetes; Xylariomycetidae; '
+                'Xylariales; Amphisphaeriaceae; Pestalotiopsis'),
+            'class': 'Sordariomycetes',
+            'family': 'Amphisphaeriaceae',
+            'genus': 'Pestalotiopsis',
+            'kingdom': 'Fungi',
+            'no rank': 'sordariomyceta',
+            'order': 'Xylariales',
+            'phylum': 'Ascomycota',
+            'species': 'Pestalotiopsis maculiformans',
+            'subclass': 'Xylariomycetidae',
+            'subkingdom': 'Dikarya',
+            'subphylum': 'Pezizomycotina',
+            'superkingdom': 'Eukaryota',
+            }
+        self.assertEqual(self.db.get_lineage(531911), expected_lineage)
+
+    def test_get_taxon_id_accession(self):
+        self.assertEqual(self.db.get_taxon_id("HQ379286.1"), None)
+        insert_accessions(self.db_fp, StringIO(accession2taxid))
+        db = NcbiTaxonomyDb(self.db_fp)
+        self.assertEqual(db.get_taxon_id("HQ379286.1"), 531911)
+        self.assertEqual(db.get_taxon_id("HQ379286.2"), 531911)
+        self.assertEqual(db.get_taxon_id("NR_000012.1"), 4751)
+        self.assertEqual(db.get_taxon_id("NR_12.1"), None)
+        self.assertEqual(db.get_taxon_id("XY379286.1"), None)
+        self.assertEqual(db.get_taxon_id("312434489"), 531911)
+
+    def test_get_lineage_missing(self):
+        self.assertEqual(self.db.get_lineage(12), None)
+
+    def test_precomputed_lineages(self):
+        insert_lineages(self.db_fp)
+        db = NcbiTaxonomyDb(self.db_fp)
+        self.assertTrue(db.has_lineages)
+        obs = db.get_lineage(531911)
+        self.assertEqual(obs, {
+            'Lineage': (
+                'cellular organisms; Eukaryota; Opisthokonta; Fungi; Dikarya; '
+                'Ascomycota; saccharomyceta; Pezizomycotina; leotiomyceta; '
+                'sordariomyceta; Sordariomycetes; Xylariomycetidae; '
+                'Xylariales; Amphisphaeriaceae; Pestalotiopsis'),
+            'class': 'Sordariomycetes',
+            'family': 'Amphisphaeriaceae',
+            'genus': 'Pestalotiopsis',
+            'kingdom': 'Fungi',
+            'no rank': 'sordariomyceta',
+            'order': 'Xylariales',
+            'phylum': 'Ascomycota',
+            'species': 'Pestalotiopsis maculiformans',
+            'superkingdom': 'Eukaryota',
+            })
+        self.assertEqual(db.get_lineage(12), None)
+
+    def test_precomputed_lineages_match(self):
+        insert_lineages(self.db_fp)
+        db = NcbiTaxonomyDb(self.db_fp)
+        taxon_ids = [r[0] for r in db.conn.execute("SELECT tax_id FROM nodes")]
+        for taxon_id in taxon_ids:
+            walked = self.db.get_lineage(taxon_id)
+            obs = db.get_lineage(taxon_id)
+            for rank, name in obs.items():
+                self.assertEqual(walked[rank], name)
+
+
+class FilterTests(unittest.TestCase):
+    def test_read_gi_numbers(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            blast_fp = os.path.join(tmp_dir, "blast.txt")
+            with open(blast_fp, "w") as f:
+                f.write(
+                    "# Query: q1\n"
+                    "q1\tgi|312434489|gb|HQ|\t99.0\t200\n"
+                    "q1\tgi|12|gb|AB|\t98.0\t200\n")
+            gi_list_fp = os.path.join(tmp_dir, "gi_list.txt")
+            with open(gi_list_fp, "w") as f:
+                f.write("5\n\n12\n")
+            self.assertEqual(
+                read_gi_numbers([blast_fp], [gi_list_fp]),
+                set(["312434489", "12", "5"]))
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_ancestor_closure(self):
+        nodes = [["1", "1", "no rank"], ["2", "1", "genus"],
+                 ["3", "2", "species"], ["4", "1", "genus"]]
+        self.assertEqual(ancestor_closure(nodes, ["3"]), set(["1", "2", "3"]))
+        self.assertEqual(ancestor_closure(nodes, []), set())
+
+    def test_taxonomy_rows(self):
+        taxid_f = StringIO(lineage_gi_taxid + "5\t2759\n")
+        tables = dict(taxonomy_rows(
+            taxid_f, StringIO(lineage_nodes + "6\t|\t2759\t|\tkingdom\t|\n"),
+            StringIO(lineage_names), set(["312434489"])))
+        self.assertEqual(tables["gi_taxid"], [["312434489", "531911"]])
+        all_nodes = list(parse_nodes(StringIO(lineage_nodes)))
+        self.assertEqual(tables["nodes"], all_nodes)
+        self.assertEqual(
+            list(tables["names"]),
+            list(parse_names(StringIO(lineage_names))))
+
+    def test_taxonomy_rows_accessions(self):
+        tables = taxonomy_rows(
+            StringIO(""), StringIO(lineage_nodes), StringIO(lineage_names),
+            set(["NR_000012.2"]), accession_fs=[StringIO(accession2taxid)])
+        self.assertEqual(
+            [t for t, _ in tables],
+            ["gi_taxid", "accession_taxid", "nodes", "names"])
+        tables = dict(tables)
+        self.assertEqual(tables["accession_taxid"], [["NR_000012.1", "4751"]])
+        self.assertEqual(
+            [r[0] for r in tables["nodes"]],
+            ["1", "131567", "2759", "33154", "4751"])
+
+    def test_taxonomy_rows_ancestors_only(self):
+        tables = dict(taxonomy_rows(
+            StringIO("5\t2759\n"), StringIO(lineage_nodes),
+            StringIO(lineage_names), set(["5"])))
+        self.assertEqual(tables["gi_taxid"], [["5", "2759"]])
+        self.assertEqual(
+            [r[0] for r in tables["nodes"]], ["1", "131567", "2759"])
+        self.assertEqual(
+            [r[1] for r in tables["names"]],
+            ["root", "cellular organisms", "Eukaryota"])
+
+
+class DumpFileTests(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_open_gzip(self):
+        fp = os.path.join(self.tmp_dir, "gi_taxid.dmp.gz")
+        f = gzip.GzipFile(fp, "wb")
+        f.write(gi_taxid)
+        f.close()
+        f = open_gzip(fp)
+        self.assertEqual(f.read(), gi_taxid)
+        f.close()
+
+    def test_open_tar_member(self):
+        nodes_fp = os.path.join(self.tmp_dir, "nodes.dmp")
+        with open(nodes_fp, "w") as f:
+            f.write(nodes)
+        fp = os.path.join(self.tmp_dir, "taxdump.tar.gz")
+        tar = tarfile.open(fp, "w:gz")
+        tar.add(nodes_fp, "nodes.dmp")
+        tar.close()
+        f = open_tar_member(fp, "nodes.dmp")
+        self.assertEqual(list(parse_nodes(f)), list(parse_nodes(StringIO(nodes))))
+        f.close()
+
+    def test_close_early(self):
+        fp = os.path.join(self.tmp_dir, "big.dmp.gz")
+        f = gzip.GzipFile(fp, "wb")
+        for n in xrange(200000):
+            f.write("%d\t%d\n" % (n, n % 7))
+        f.close()
+        f = open_gzip(fp)
+        self.assertEqual(f.read(10), "0\t0\n1\t1\n2\t")
+        f.close()
+
+    def test_never_read(self):
+        f = DecompressedFile(["false"])
+        f.close()
+        self.assertEqual(f.proc, None)
+
+    def test_failed_command(self):
+        f = DecompressedFile(["false"])
+        self.assertEqual(f.read(), "")
+        self.assertRaises(IOError, f.close)
+
+    def test_iter_parsed(self):
+        taxid_lines = "".join("%d\t%d\n" % (n, n % 7) for n in range(1000))
+        exp = list(parse_gi_taxid(StringIO(taxid_lines)))
+        self.assertEqual(
+            list(iter_parsed(StringIO(taxid_lines), parse_gi_taxid)), exp)
+        pool = Pool(2)
+        try:
+            obs = iter_parsed(
+                StringIO(taxid_lines), parse_gi_taxid, pool, block_size=100)
+            self.assertEqual(list(obs), exp)
+        finally:
+            pool.terminate()
+            pool.join()
+
+
+class Interrupted(Exception):
+    pass
+
+
+def interrupt_after(rows, n):
+    for i, row in enumerate(rows):
+        if i == n:
+            raise Interrupted()
+        yield row
+
+
+class BulkLoaderTests(unittest.TestCase):
+    def setUp(self):
+        self.db_dir = tempfile.mkdtemp()
+        self.db_fp = os.path.join(self.db_dir, "taxonomy.db")
+
+    def tearDown(self):
+        shutil.rmtree(self.db_dir)
+
+    def test_bulk_load(self):
+        progress = []
+        tables = taxonomy_rows(
+            StringIO(lineage_gi_taxid), StringIO(lineage_nodes),
+            StringIO(lineage_names))
+        loader = bulk_load(
+            self.db_fp, tables, chunk_size=5,
+            progress=lambda *args: progress.append(args))
+        self.assertTrue(loader.peak_disk_usage > 0)
+        self.assertEqual(progress[:4], [
+            ("gi_taxid", 1), ("nodes", 5), ("nodes", 10), ("nodes", 15)])
+        self.assertFalse(is_partial_load(self.db_fp))
+
+        conn = sqlite3.connect(self.db_fp)
+        indexes = [r[0] for r in conn.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'index'")]
+        self.assertEqual(
+            indexes, ["gi_taxid_nuc_id", "nodes_tax_id", "names_tax_id"])
+        self.assertEqual(
+            conn.execute("PRAGMA journal_mode").fetchone()[0], "delete")
+        conn.close()
+
+        db = NcbiTaxonomyDb(self.db_fp)
+        self.assertEqual(db.get_taxon_id("312434489"), 531911)
+        self.assertEqual(
+            db.get_lineage(531911)["species"], "Pestalotiopsis maculiformans")
+
+    def test_resume(self):
+        loader = BulkLoader(self.db_fp, chunk_size=5)
+        loader.load("gi_taxid", parse_gi_taxid(StringIO(lineage_gi_taxid)))
+        nodes = parse_nodes(StringIO(lineage_nodes))
+        self.assertRaises(
+            Interrupted, loader.load, "nodes", interrupt_after(nodes, 12))
+        loader.conn.close()
+        self.assertTrue(is_partial_load(self.db_fp))
+
+        loader = BulkLoader(self.db_fp, chunk_size=5)
+        self.assertEqual(loader.rows_loaded("gi_taxid"), (1, True))
+        self.assertEqual(loader.rows_loaded("nodes"), (10, False))
+        loader.conn.close()
+
+        tables = taxonomy_rows(
+            StringIO(""), StringIO(lineage_nodes), StringIO(lineage_names))
+        bulk_load(self.db_fp, tables, chunk_size=5)
+        conn = sqlite3.connect(self.db_fp)
+        obs = [r[0] for r in conn.execute(
+            "SELECT tax_id FROM nodes ORDER BY rowid")]
+        exp = [int(r[0]) for r in parse_nodes(StringIO(lineage_nodes))]
+        self.assertEqual(obs, exp)
+        self.assertEqual(
+            list(conn.execute("SELECT * FROM gi_taxid")), [(312434489, 531911)])
+
+
 gi_taxid = """\
 2	9913
 3	9913
@@ -91,6 +405,56 @@ nodes = """\
 2	|	131567	|	superkingdom	|		|	0	|	0	|	11	|	0	|	0	|	0	|	0	|	0	|		|
 6	|	335928	|	genus	|		|	0	|	1	|	11	|	1	|	0	|	1	|	0	|	0	|		|
 """
+accession2taxid = """\
+accession\taccession.version\ttaxid\tgi
+HQ379286\tHQ379286.1\t531911\t312434489
+NR_000012\tNR_000012.1\t4751\t12
+NZ_ABCD01000001\tNZ_ABCD01000001.1\t2759\t13
+"""
+
+lineage_gi_taxid = """\
+312434489	531911
+"""
+
+lineage_nodes = """\
+1	|	1	|	no rank	|
+131567	|	1	|	no rank	|
+2759	|	131567	|	superkingdom	|
+33154	|	2759	|	no rank	|
+4751	|	33154	|	kingdom	|
+451864	|	4751	|	subkingdom	|
+4890	|	451864	|	phylum	|
+716545	|	4890	|	no rank	|
+147538	|	716545	|	subphylum	|
+716546	|	147538	|	no rank	|
+715989	|	716546	|	no rank	|
+147550	|	715989	|	class	|
+222544	|	147550	|	subclass	|
+37989	|	222544	|	order	|
+37991	|	37989	|	family	|
+37840	|	37991	|	genus	|
+531911	|	37840	|	species	|
+"""
+
+lineage_names = """\
+1	|	root	|		|	scientific name	|
+131567	|	cellular organisms	|		|	scientific name	|
+2759	|	Eukaryota	|		|	scientific name	|
+33154	|	Opisthokonta	|		|	scientific name	|
+4751	|	Fungi	|		|	scientific name	|
+451864	|	Dikarya	|		|	scientific name	|
+4890	|	Ascomycota	|		|	scientific name	|
+716545	|	saccharomyceta	|		|	scientific name	|
+147538	|	Pezizomycotina	|		|	scientific name	|
+716546	|	leotiomyceta	|		|	scientific name	|
+715989	|	sordariomyceta	|		|	scientific name	|
+147550	|	Sordariomycetes	|		|	scientific name	|
+222544	|	Xylariomycetidae	|		|	scientific name	|
+37989	|	Xylariales	|		|	scientific name	|
+37991	|	Amphisphaeriaceae	|		|	scientific name	|
+37840	|	Pestalotiopsis	|		|	scientific name	|
+531911	|	Pestalotiopsis maculiformans	|		|	scientific name	|
+"""
 
 if __name__ == "__main__":
     unittest.main()
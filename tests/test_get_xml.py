@@ -1,31 +1,298 @@
+import BaseHTTPServer
+import json
+import multiprocessing
+import os
+import SocketServer
 import tempfile
+import threading
+import time
 import unittest
+import urllib2
+import urlparse
 
 from brocclib.get_xml import (
-    get_taxid, get_lineage, NcbiEutils,
+    get_taxid, get_lineage, NcbiEutils, get_taxids, get_lineages,
+    get_taxa_from_xml, EutilsClient, RateLimiter, EutilsCache,
+    migrate_json_cache,
     )
 
 
+class CannedEutilsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        path, _, query = self.path.partition("?")
+        params = urlparse.parse_qs(query)
+        with self.server.lock:
+            self.server.requests.append(self.path)
+            error_code = None
+            if self.server.errors:
+                error_code = self.server.errors.pop(0)
+        time.sleep(self.server.latency)
+        if error_code is not None:
+            self.send_error(error_code)
+            return
+        if path == "/entrez/eutils/elink.fcgi":
+            body = elink_xml(params["id"])
+        elif path == "/entrez/eutils/efetch.fcgi":
+            body = efetch_xml(params["id"][0].split(","))
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "text/xml")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn,
+                          BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class CannedEutilsServer(object):
+    """Local stand-in for NCBI E-utilities, serving canned responses.
+
+    Responses may be delayed, and error codes may be given for the
+    first few requests.
+    """
+    def __init__(self, latency=0, errors=None):
+        self.server = ThreadingHTTPServer(
+            ("127.0.0.1", 0), CannedEutilsHandler)
+        self.server.requests = []
+        self.server.lock = threading.Lock()
+        self.server.latency = latency
+        self.server.errors = list(errors or [])
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    @property
+    def base_url(self):
+        return "http://127.0.0.1:%s/entrez/eutils/" % self.server.server_port
+
+    @property
+    def requests(self):
+        return self.server.requests
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def local_client(server, **kwargs):
+    return EutilsClient(server.base_url, rate=1000, backoff=0.01, **kwargs)
+
+
+class EutilsClientTests(unittest.TestCase):
+    def test_retry(self):
+        server = CannedEutilsServer(errors=[429, 503])
+        client = local_client(server)
+        self.assertEqual(get_taxid("312434489", client), "531911")
+        self.assertEqual(len(server.requests), 3)
+        self.assertEqual(
+            (client.requests, client.retries, client.failures), (3, 2, 0))
+        server.close()
+
+    def test_too_many_errors(self):
+        server = CannedEutilsServer(errors=[500, 500, 500])
+        client = local_client(server, max_tries=3)
+        self.assertRaises(
+            urllib2.URLError, client.open, "elink.fcgi", "id=312434489")
+        self.assertEqual(len(server.requests), 3)
+        self.assertEqual(
+            (client.requests, client.retries, client.failures), (3, 2, 1))
+        server.close()
+
+    def test_bad_request(self):
+        server = CannedEutilsServer(errors=[400])
+        client = local_client(server)
+        self.assertEqual(get_lineage("asdf", client), None)
+        self.assertEqual(len(server.requests), 1)
+        self.assertEqual(
+            (client.requests, client.retries, client.failures), (1, 0, 1))
+        server.close()
+
+    def test_api_key(self):
+        client = EutilsClient("http://localhost/", api_key="abc")
+        self.assertEqual(
+            client.url("efetch.fcgi", "id=1"),
+            "http://localhost/efetch.fcgi?id=1&api_key=abc")
+        self.assertEqual(client.rate_limiter.rate, 10)
+
+
+class RateLimiterTests(unittest.TestCase):
+    def test_rate(self):
+        limiter = RateLimiter(20)
+        start = time.time()
+        for _ in range(5):
+            limiter.wait()
+        self.assertTrue(time.time() - start >= 0.19)
+
+    def test_threads(self):
+        limiter = RateLimiter(50)
+        start = time.time()
+        threads = [threading.Thread(target=limiter.wait) for _ in range(11)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertTrue(time.time() - start >= 0.19)
+
+    def test_processes(self):
+        limiter = RateLimiter(20, shared=True)
+
+        def wait_twice():
+            limiter.wait()
+            limiter.wait()
+
+        start = time.time()
+        procs = [
+            multiprocessing.Process(target=wait_twice) for _ in range(3)]
+        for p in procs:
+            p.start()
+        for p in procs:
+            p.join()
+        # Six requests in all, the first without waiting
+        self.assertTrue(time.time() - start >= 0.24)
+
+    def test_client_rate_limiter(self):
+        limiter = RateLimiter(20, shared=True)
+        client = EutilsClient("http://localhost/", rate_limiter=limiter)
+        self.assertIs(client.rate_limiter, limiter)
+
+
+class BatchTests(unittest.TestCase):
+    def setUp(self):
+        self.server = CannedEutilsServer()
+        self.client = local_client(self.server)
+
+    def tearDown(self):
+        self.server.close()
+
+    def test_get_taxids(self):
+        obs = get_taxids(["312434489", "5", "238624573"], self.client)
+        self.assertEqual(obs, {"312434489": "531911", "238624573": "5476"})
+
+    def test_get_taxids_accessions(self):
+        obs = get_taxids(["HQ379286.1", "5", "238624573"], self.client)
+        self.assertEqual(obs, {"HQ379286.1": "531911", "238624573": "5476"})
+
+    def test_get_lineages(self):
+        obs = get_lineages(["531911", "5476", "12"], self.client)
+        # Previous taxon IDs are included
+        self.assertEqual(sorted(obs), ["531911", "5476", "5477"])
+        self.assertEqual(obs["531911"], pestalotiopsis_lineage)
+        self.assertEqual(obs["5476"]["species"], "Candida albicans")
+        self.assertEqual(obs["5476"]["Lineage"], (
+            "cellular organisms; Eukaryota; Fungi; Ascomycota; "
+            "Saccharomycetes; Saccharomycetales; Candida"))
+
+    def test_prefetch(self):
+        db = NcbiEutils(client=self.client, batch_size=2)
+        db.prefetch(["312434489", "238624573", "312434489", "5", None])
+        # Two batches of GI numbers, one batch of taxon IDs
+        self.assertEqual(len(self.server.requests), 3)
+        self.assertEqual(db.taxon_ids, {
+            "312434489": "531911", "238624573": "5476", "5": None})
+        self.assertEqual(db.get_lineage("531911"), pestalotiopsis_lineage)
+        self.assertEqual(db.get_taxon_id("5"), None)
+        self.assertEqual(len(self.server.requests), 3)
+
+        # Nothing new to look up
+        db.prefetch(["312434489", "5"])
+        self.assertEqual(len(self.server.requests), 3)
+        self.assertEqual(self.client.requests, 3)
+        # Misses for three GI numbers and two taxon IDs, then hits for
+        # the two lookups above and three in the second prefetch.
+        self.assertEqual((db.cache_hits, db.cache_misses), (5, 5))
+        # Names are shared between lineages
+        self.assertIs(
+            db.lineages["531911"]["kingdom"], db.lineages["5476"]["kingdom"])
+
+    def test_prefetch_failed_batch(self):
+        client = EutilsClient(self.server.base_url + "missing/", rate=1000)
+        db = NcbiEutils(client=client)
+        db.prefetch(["312434489"])
+        self.assertEqual(db.taxon_ids, {})
+
+
+class ConcurrentTests(unittest.TestCase):
+    def test_prefetch(self):
+        server = CannedEutilsServer(latency=0.2, errors=[503])
+        client = local_client(server)
+        db = NcbiEutils(client=client, batch_size=1, num_workers=4)
+        start = time.time()
+        db.prefetch(["312434489", "238624573", "5", "6"])
+        # Serial requests would take at least 1.4 seconds
+        self.assertTrue(time.time() - start < 1.2)
+        self.assertEqual(db.taxon_ids, {
+            "312434489": "531911", "238624573": "5476", "5": None, "6": None})
+        self.assertEqual(db.lineages["531911"], pestalotiopsis_lineage)
+        self.assertEqual(len(server.requests), 7)
+        server.close()
+
+
 class NcbiEutilsTests(unittest.TestCase):
     def setUp(self):
         self.cache_file = tempfile.NamedTemporaryFile(suffix=".json")
         self.db = NcbiEutils(self.cache_file.name)
 
     def test_save_load_cache(self):
+        server = CannedEutilsServer()
+        db = NcbiEutils(self.cache_file.name, local_client(server))
+        db.load_cache()
+        self.assertEqual(db.get_taxon_id("312434489"), "531911")
+        self.assertEqual(db.get_taxon_id("5"), None)
+        self.assertEqual(db.get_lineage("531911"), pestalotiopsis_lineage)
+        self.assertEqual(len(server.requests), 3)
+        db.save_cache()
+
+        # Values are found in the cache file
+        db2 = NcbiEutils(self.cache_file.name, local_client(server))
+        db2.load_cache()
+        self.assertEqual(db2.get_taxon_id("312434489"), "531911")
+        self.assertEqual(db2.get_taxon_id("5"), None)
+        self.assertEqual(db2.get_lineage("531911"), pestalotiopsis_lineage)
+        db2.prefetch(["312434489", "5"])
+        self.assertEqual(len(server.requests), 3)
+        server.close()
+
+    def test_migrate_json_cache(self):
         lineages = {
             "taxon1": {'class': "a", "genus": "b"},
             "taxon2": {'class': "c", "genus": "d"},
             }
-        taxon_ids = {"taxon1": "b", "taxon2": "d"}
-        self.db.lineages = lineages
-        self.db.taxon_ids = taxon_ids
-        self.db._fresh = False
-        self.db.save_cache()
+        taxon_ids = {"gi1": "taxon1", "gi2": "taxon2", "gi3": None}
+        with open(self.cache_file.name, "w") as f:
+            json.dump({
+                "lineages": [(x, y.items()) for x, y in lineages.items()],
+                "taxon_ids": taxon_ids.items(),
+                }, f)
 
-        db2 = NcbiEutils(self.cache_file.name)
-        db2.load_cache()
-        self.assertEqual(db2.lineages, lineages)
-        self.assertEqual(db2.taxon_ids, taxon_ids)
+        self.db.load_cache()
+        self.assertFalse(migrate_json_cache(self.cache_file.name))
+        for gi, taxon_id in taxon_ids.items():
+            self.assertEqual(self.db.get_taxon_id(gi), taxon_id)
+        for taxon_id, lineage in lineages.items():
+            self.assertEqual(self.db.get_lineage(taxon_id), lineage)
+
+    def test_shared_cache(self):
+        workers = [
+            multiprocessing.Process(
+                target=_fill_cache, args=(self.cache_file.name, n))
+            for n in range(4)]
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+        cache = EutilsCache(self.cache_file.name)
+        for n in range(4):
+            for i in range(50):
+                key = "%s_%s" % (n, i)
+                self.assertEqual(cache.get("taxon_ids", key), str(i))
+        self.assertRaises(KeyError, cache.get, "taxon_ids", "5_0")
 
     def test_get_taxon_id(self):
         self.assertEqual(self.db.get_taxon_id("312434489"), "531911")
@@ -56,6 +323,22 @@ class NcbiEutilsTests(unittest.TestCase):
         self.assertEqual(self.db.lineages, {'531911': expected_lineage})
 
 
+class XmlTests(unittest.TestCase):
+    def test_get_taxa_from_xml(self):
+        obs = get_taxa_from_xml(efetch_xml(["531911", "5476"]))
+        self.assertEqual(obs["531911"], pestalotiopsis_lineage)
+        self.assertEqual(obs["5476"]["genus"], "Candida")
+        # Previous taxon IDs are included
+        self.assertEqual(obs["5477"], obs["5476"])
+
+
+def _fill_cache(cache_fp, n):
+    cache = EutilsCache(cache_fp)
+    for i in range(50):
+        cache.update("taxon_ids", {"%s_%s" % (n, i): str(i)})
+    cache.close()
+
+
 class FunctionTests(unittest.TestCase):
     def test_get_taxid(self):
         self.assertEqual(get_taxid("312434489"), "531911")
@@ -67,6 +350,110 @@ class FunctionTests(unittest.TestCase):
         # Should this return the HTTP 400 error?
         self.assertEqual(get_lineage("asdf"), None)
 
-        
+
+pestalotiopsis_lineage = {
+    'Lineage': (
+        'cellular organisms; Eukaryota; Opisthokonta; Fungi; Dikarya; '
+        'Ascomycota; saccharomyceta; Pezizomycotina; leotiomyceta; '
+        'sordariomyceta; Sordariomycetes; Xylariomycetidae; '
+        'Xylariales; Amphisphaeriaceae; Pestalotiopsis'),
+    'class': 'Sordariomycetes',
+    'family': 'Amphisphaeriaceae',
+    'genus': 'Pestalotiopsis',
+    'kingdom': 'Fungi',
+    'no rank': 'sordariomyceta',
+    'order': 'Xylariales',
+    'phylum': 'Ascomycota',
+    'species': 'Pestalotiopsis maculiformans',
+    'subclass': 'Xylariomycetidae',
+    'subkingdom': 'Dikarya',
+    'subphylum': 'Pezizomycotina',
+    'superkingdom': 'Eukaryota',
+    }
+
+canned_taxids = {
+    "312434489": "531911",
+    "238624573": "5476",
+    }
+
+canned_accessions = {
+    "HQ379286.1": "312434489",
+    }
+
+canned_taxa = {
+    "531911": ("Pestalotiopsis maculiformans", "species", [], [
+        ("131567", "cellular organisms", "no rank"),
+        ("2759", "Eukaryota", "superkingdom"),
+        ("33154", "Opisthokonta", "no rank"),
+        ("4751", "Fungi", "kingdom"),
+        ("451864", "Dikarya", "subkingdom"),
+        ("4890", "Ascomycota", "phylum"),
+        ("716545", "saccharomyceta", "no rank"),
+        ("147538", "Pezizomycotina", "subphylum"),
+        ("716546", "leotiomyceta", "no rank"),
+        ("715989", "sordariomyceta", "no rank"),
+        ("147550", "Sordariomycetes", "class"),
+        ("222544", "Xylariomycetidae", "subclass"),
+        ("37989", "Xylariales", "order"),
+        ("37991", "Amphisphaeriaceae", "family"),
+        ("37840", "Pestalotiopsis", "genus"),
+        ]),
+    "5476": ("Candida albicans", "species", ["5477"], [
+        ("131567", "cellular organisms", "no rank"),
+        ("2759", "Eukaryota", "superkingdom"),
+        ("4751", "Fungi", "kingdom"),
+        ("4890", "Ascomycota", "phylum"),
+        ("4891", "Saccharomycetes", "class"),
+        ("4892", "Saccharomycetales", "order"),
+        ("1535326", "Candida", "genus"),
+        ]),
+    }
+
+
+def elink_xml(gi_nums):
+    linksets = []
+    for gi_num in gi_nums:
+        # Accessions are reported by GI number, like NCBI does
+        gi_num = canned_accessions.get(gi_num, gi_num)
+        linkset_db = ""
+        if gi_num in canned_taxids:
+            linkset_db = (
+                "<LinkSetDb><DbTo>taxonomy</DbTo>"
+                "<LinkName>nuccore_taxonomy</LinkName>"
+                "<Link><Id>%s</Id></Link></LinkSetDb>" % canned_taxids[gi_num])
+        linksets.append(
+            "<LinkSet><DbFrom>nuccore</DbFrom><IdList><Id>%s</Id></IdList>"
+            "%s</LinkSet>" % (gi_num, linkset_db))
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
+        '<eLinkResult>\n%s\n</eLinkResult>\n' % "\n".join(linksets))
+
+
+def efetch_xml(taxids):
+    taxa = []
+    for taxid in taxids:
+        if taxid not in canned_taxa:
+            continue
+        name, rank, aka_taxids, lineage = canned_taxa[taxid]
+        lineage_ex = "".join(
+            "<Taxon><TaxId>%s</TaxId><ScientificName>%s</ScientificName>"
+            "<Rank>%s</Rank></Taxon>" % t for t in lineage)
+        aka = ""
+        if aka_taxids:
+            aka = "<AkaTaxIds>%s</AkaTaxIds>" % "".join(
+                "<TaxId>%s</TaxId>" % t for t in aka_taxids)
+        taxa.append(
+            "<Taxon>\n<TaxId>%s</TaxId>\n<ScientificName>%s</ScientificName>\n"
+            "<Rank>%s</Rank>\n<Lineage>%s</Lineage>\n"
+            "<LineageEx>%s</LineageEx>\n%s\n</Taxon>" % (
+                taxid, name, rank, "; ".join(n for _, n, _ in lineage),
+                lineage_ex, aka))
+    return (
+        '<?xml version="1.0" ?>\n'
+        '<!DOCTYPE TaxaSet PUBLIC "-//NLM//DTD Taxon, 14th January 2002//EN" '
+        '"http://www.ncbi.nlm.nih.gov/entrez/query/DTD/taxon.dtd">\n'
+        '<TaxaSet>\n%s\n</TaxaSet>\n' % "\n".join(taxa))
+
+
 if __name__ == '__main__':
     unittest.main()
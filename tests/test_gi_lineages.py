@@ -0,0 +1,67 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from brocclib.gi_lineages import load_gi_lineages, save_gi_lineages
+from brocclib.taxonomy import Lineage, NoLineage
+
+
+class GiLineageTests(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp(prefix="brocc")
+        self.fp = os.path.join(self.temp_dir, "gi_lineages")
+        self.candida = Lineage({
+            "species": "Candida albicans",
+            "genus": "Candida",
+            "order": "Saccharomycetales",
+            "superkingdom": "Eukaryota",
+            "Lineage": "cellular organisms; Eukaryota; Fungi; Candida",
+            })
+        self.generic = Lineage({
+            "species": "uncultured fungus",
+            "kingdom": "Fungi",
+            "Lineage": "cellular organisms; Eukaryota; Fungi",
+            })
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def assertSameLineage(self, obs, exp):
+        self.assertEqual(obs.taxa, exp.taxa)
+        self.assertEqual(obs.classified, exp.classified)
+        for rank in Lineage.ranks:
+            self.assertEqual(obs.get_taxon(rank), exp.get_taxon(rank))
+            self.assertEqual(
+                list(obs.get_all_taxa(rank)), list(exp.get_all_taxa(rank)))
+            self.assertEqual(
+                list(obs.get_standard_taxa(rank)),
+                list(exp.get_standard_taxa(rank)))
+
+    def test_from_record(self):
+        for lineage in [self.candida, self.generic]:
+            self.assertSameLineage(
+                Lineage.from_record(lineage.to_record()), lineage)
+
+    def test_save_load(self):
+        save_gi_lineages(self.fp, {
+            "1": self.candida, "2": self.generic, "3": self.candida,
+            "4": NoLineage(),
+            })
+        obs = load_gi_lineages(self.fp)
+        self.assertEqual(sorted(obs), ["1", "2", "3", "4"])
+        self.assertSameLineage(obs["1"], self.candida)
+        self.assertSameLineage(obs["2"], self.generic)
+        self.assertIsInstance(obs["4"], NoLineage)
+        # GI numbers with the same lineage share one object
+        self.assertIs(obs["1"], obs["3"])
+        self.assertEqual(os.listdir(self.temp_dir), ["gi_lineages"])
+
+    def test_not_a_gi_lineage_file(self):
+        with open(self.fp, "w") as f:
+            f.write("{\"taxon_ids\": {}}")
+        self.assertRaises(ValueError, load_gi_lineages, self.fp)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,8 +1,18 @@
+import bz2
+import gzip
+import os
+import shutil
+import tempfile
 from unittest import TestCase, main
 from cStringIO import StringIO
 
+from brocclib import parse
 from brocclib.parse import (
-    read_blast, iter_fasta, parse_gi_number,
+    read_blast, iter_fasta, parse_gi_number, iter_blast_queries,
+    iter_query_hits, BlastHit, BlastHits, UnsortedBlastError,
+    parse_accession, parse_subject_id, is_accession, iter_blast, open_input,
+    BlastColumns, merge_blast_queries, iter_blast_query_lengths,
+    iter_blast_xml, iter_blast_xml_queries, blast_format, has_query_lengths,
     )
 
 
@@ -16,6 +26,44 @@ class GiNumberTests(TestCase):
             self.assertEqual(parse_gi_number(s), None)
 
 
+class AccessionTests(TestCase):
+    def test_formatted(self):
+        obs = parse_accession('gi|259100874|gb|GQ513762.1|')
+        self.assertEqual(obs, 'GQ513762.1')
+        obs = parse_accession('ref|NR_118878.1|')
+        self.assertEqual(obs, 'NR_118878.1')
+
+    def test_plain(self):
+        self.assertEqual(parse_accession('GQ513762.1'), 'GQ513762.1')
+
+    def test_accession_empty(self):
+        for s in ['', 'gi|259100874|', 'ran|dom', 'gb||']:
+            self.assertEqual(parse_accession(s), None)
+
+    def test_not_accession(self):
+        # Only IDs in accession.version format are accessions
+        for s in ['GQ513762', '259100874', 'OTU_1', 'contig12.fa',
+                  'gb|GQ513762|', 'lcl|GQ513762.1|']:
+            self.assertEqual(parse_accession(s), None, s)
+        self.assertTrue(is_accession('NZ_ABCD01000001.1'))
+        self.assertFalse(is_accession('259100874'))
+
+    def test_subject_id(self):
+        obs = parse_subject_id('gi|259100874|gb|GQ513762.1|')
+        self.assertEqual(obs, '259100874')
+        self.assertEqual(parse_subject_id('GQ513762.1'), 'GQ513762.1')
+        self.assertEqual(
+            parse_subject_id('gi|abc|gb|GQ513762.1|'), 'GQ513762.1')
+        # Plain numbers are not taken as GI numbers
+        for s in ['259100874', 'OTU_1', 'gnl|BL_ORD_ID|12']:
+            self.assertEqual(parse_subject_id(s), None, s)
+
+    def test_iter_blast(self):
+        lines = ["q1\tGQ513762.1\t98.74\t159\n"]
+        (query_id, hit), = iter_blast(lines)
+        self.assertEqual(hit.gi, "GQ513762.1")
+
+
 class FastaTests(TestCase):
     def test_basic(self):
         lines = [
@@ -29,6 +77,38 @@ class FastaTests(TestCase):
         self.assertEqual(seqs.next(), ("lab2", "CCAAAA"))
         self.assertRaises(StopIteration, seqs.next)
 
+    def test_multiline(self):
+        lines = [">lab1", "TTTT", "CCC", "", ">lab2", "CCAAAA"]
+        self.assertEqual(
+            list(iter_fasta(lines)), [("lab1", "TTTTCCC"), ("lab2", "CCAAAA")])
+
+    def test_lengths_only(self):
+        lines = [">lab1", "TTTT", "CCC", ">lab2", "CCAAAA", ">lab3"]
+        obs = [(name, len(seq)) for name, seq in iter_fasta(lines, True)]
+        self.assertEqual(obs, [("lab1", 7), ("lab2", 6), ("lab3", 0)])
+
+
+class OpenInputTests(TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_open_input(self):
+        content = ">lab1\nTTTTCCC\n>lab2\nCCAAAA\n"
+        for fn, open_fcn in [
+                ("seqs.fasta", open), ("seqs.fasta.gz", gzip.GzipFile),
+                ("seqs.fasta.bz2", bz2.BZ2File)]:
+            fp = os.path.join(self.temp_dir, fn)
+            f = open_fcn(fp, "w")
+            f.write(content)
+            f.close()
+            with open_input(fp) as f:
+                self.assertEqual(list(f), content.splitlines(True))
+                f.seek(0)
+                self.assertEqual(f.read(), content)
+
 
 class BlastOutputTests(TestCase):
     def test_normal_output(self):
@@ -49,7 +129,268 @@ class BlastOutputTests(TestCase):
         obs = read_blast(StringIO(normal_output))
         self.assertEqual(obs['sdlkj'], [])
 
-    
+
+class BlastQueryTests(TestCase):
+    def test_commented_output(self):
+        obs = list(iter_blast_queries(StringIO(multiple_query_output)))
+        self.assertEqual([q for q, _ in obs], ['a1', 'b2', 'c3'])
+        self.assertEqual([h.gi for h in obs[0][1]], ['1', '2'])
+        self.assertEqual(len(obs[1][1]), 0)
+        self.assertEqual([h.gi for h in obs[2][1]], ['3'])
+
+    def test_uncommented_output(self):
+        lines = [
+            l for l in StringIO(multiple_query_output)
+            if not l.startswith("#")]
+        obs = list(iter_blast_queries(lines))
+        self.assertEqual([q for q, _ in obs], ['a1', 'c3'])
+        self.assertEqual([h.gi for h in obs[0][1]], ['1', '2'])
+
+    def test_subject_cache_size(self):
+        lines = [
+            "q%d\tgi|%d|gb|AB%06d.1|\t99.0\t100\n" % (n // 2, n % 5, n)
+            for n in range(20)]
+        cache_size = parse.SUBJECT_CACHE_SIZE
+        parse.SUBJECT_CACHE_SIZE = 3
+        try:
+            obs = list(iter_blast_queries(lines))
+        finally:
+            parse.SUBJECT_CACHE_SIZE = cache_size
+        self.assertEqual(len(obs), 10)
+        self.assertEqual(
+            [h.gi for _, hits in obs for h in hits],
+            [str(n % 5) for n in range(20)])
+
+
+class BlastColumnsTests(TestCase):
+    def test_default(self):
+        c = BlastColumns()
+        self.assertEqual(
+            (c.query, c.subject, c.pct_id, c.length, c.query_length),
+            (0, 1, 2, 3, None))
+        self.assertEqual(c.maxsplit, 4)
+
+    def test_fields_line(self):
+        c = BlastColumns.from_fields_line(
+            "# Fields: subject gi, query acc.ver, alignment length, "
+            "% identity, evalue, query length\n")
+        self.assertEqual(
+            (c.query, c.subject, c.pct_id, c.length, c.query_length),
+            (1, 0, 3, 2, 5))
+        self.assertEqual(c.maxsplit, 6)
+
+    def test_outfmt(self):
+        c = BlastColumns.from_outfmt("6 qlen qseqid sseqid pident length")
+        self.assertEqual(
+            (c.query, c.subject, c.pct_id, c.length, c.query_length),
+            (1, 2, 3, 4, 0))
+        self.assertEqual(BlastColumns.from_outfmt("6").maxsplit, 4)
+
+    def test_missing_column(self):
+        self.assertRaises(
+            ValueError, BlastColumns.from_outfmt, "6 qseqid sseqid pident")
+
+    def test_iter_blast_fields(self):
+        obs = list(iter_blast(StringIO(query_length_output)))
+        self.assertEqual(
+            [(q, h.gi, h.pct_id, h.length, h.query_length) for q, h in obs],
+            [("a1", "1", 99.0, 100, 120), ("a1", "2", 98.0, 90, 120),
+             ("c3", "3", 97.0, 80, 85)])
+
+    def test_iter_blast_columns(self):
+        lines = ["q1\t150\tgi|5|\t99.5\t140\n"]
+        columns = BlastColumns.from_outfmt("qseqid qlen sseqid pident length")
+        (q, h), = iter_blast(lines, columns)
+        self.assertEqual(
+            (q, h.gi, h.pct_id, h.length, h.query_length),
+            ("q1", "5", 99.5, 140, 150))
+
+    def test_iter_blast_queries_fields(self):
+        obs = list(iter_blast_queries(StringIO(query_length_output)))
+        self.assertEqual([q for q, _ in obs], ["a1", "b2", "c3"])
+        self.assertEqual(
+            [hits.query_length for _, hits in obs], [120, None, 85])
+        self.assertEqual(list(obs[0][1].lengths), [100, 90])
+
+
+class BlastQueryLengthTests(TestCase):
+    def setUp(self):
+        self.columns = BlastColumns.from_outfmt(
+            "6 qseqid sseqid pident length qlen")
+
+    def test_query_lengths(self):
+        lines = [
+            "a\tgi|1|\t99.0\t100\t120\n",
+            "a\tgi|2|\t98.0\t90\t120\n",
+            "b\tgi|3|\t97.0\t80\t85\n",
+            ]
+        obs = list(iter_blast_query_lengths(
+            iter_blast_queries(lines, self.columns)))
+        self.assertEqual([q for q, _, _ in obs], ["a", "b"])
+        self.assertEqual([len(s) for _, s, _ in obs], [120, 85])
+        self.assertEqual([h.gi for h in obs[0][2]], ["1", "2"])
+
+    def test_no_hits(self):
+        obs = list(iter_blast_query_lengths(
+            iter_blast_queries(StringIO(query_length_output))))
+        self.assertEqual([len(s) for _, s, _ in obs], [120, 0, 85])
+
+    def test_missing_query_length(self):
+        queries = iter_blast_query_lengths(
+            iter_blast_queries(StringIO(multiple_query_output)))
+        self.assertRaises(ValueError, list, queries)
+
+    def test_has_query_lengths(self):
+        self.assertTrue(has_query_lengths(StringIO(query_length_output)))
+        self.assertFalse(has_query_lengths(StringIO(multiple_query_output)))
+        lines = ["a\tgi|1|\t99.0\t100\t120\n"]
+        self.assertTrue(has_query_lengths(lines, self.columns))
+        self.assertFalse(has_query_lengths(lines))
+        # No hits, so no lengths are needed
+        self.assertTrue(has_query_lengths(["# 0 hits found\n"]))
+
+    def test_unsorted(self):
+        lines = [
+            "a\tgi|1|\t99.0\t100\t120\n",
+            "b\tgi|3|\t97.0\t80\t85\n",
+            "a\tgi|2|\t98.0\t90\t120\n",
+            ]
+        queries = iter_blast_query_lengths(
+            iter_blast_queries(lines, self.columns))
+        self.assertRaises(UnsortedBlastError, list, queries)
+
+        obs = list(iter_blast_query_lengths(merge_blast_queries(
+            iter_blast_queries(lines, self.columns))))
+        self.assertEqual([q for q, _, _ in obs], ["a", "b"])
+        self.assertEqual([len(s) for _, s, _ in obs], [120, 85])
+        self.assertEqual([h.gi for h in obs[0][2]], ["1", "2"])
+
+
+class BlastXmlTests(TestCase):
+    def test_iter_blast_xml(self):
+        obs = list(iter_blast_xml(StringIO(xml_output)))
+        self.assertEqual(
+            [(q, h.gi, h.pct_id, h.length, h.query_length) for q, h in obs],
+            [("a1 first query", "1", 99.0, 100, 120),
+             ("a1 first query", "1", 97.5, 40, 120),
+             ("a1 first query", "AB000002.1", 98.89, 90, 120),
+             ("c3", "3", 100.0, 80, 85)])
+
+    def test_iter_blast_xml_queries(self):
+        obs = list(iter_blast_xml_queries(StringIO(xml_output)))
+        self.assertEqual(
+            [q for q, _ in obs], ["a1 first query", "b2", "c3"])
+        self.assertEqual([len(hits) for _, hits in obs], [3, 0, 1])
+        self.assertEqual(
+            [hits.query_length for _, hits in obs], [120, 95, 85])
+
+    def test_ordinal_ids(self):
+        # The ordinal of a BL_ORD_ID hit is never used as a subject ID
+        xml = xml_output.replace(
+            "AB000002.1 Subject two", "gi|22|gb|AB000002.1| Subject two")
+        obs = [h.gi for _, h in iter_blast_xml(StringIO(xml))]
+        self.assertEqual(obs, ["1", "1", "22", "3"])
+        xml = xml_output.replace("AB000002.1 Subject two", "")
+        obs = [h.gi for _, h in iter_blast_xml(StringIO(xml))]
+        self.assertEqual(obs, ["1", "1", None, "3"])
+
+    def test_same_as_tabular(self):
+        tabular_obs = [
+            (h.gi, h.pct_id, h.length)
+            for _, h in iter_blast(StringIO(normal_output))]
+        xml_obs = [
+            (h.gi, h.pct_id, h.length)
+            for _, h in iter_blast_xml(StringIO(normal_xml_output))]
+        self.assertEqual(xml_obs, tabular_obs)
+
+    def test_blast_format(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            xml_fp = os.path.join(tmp_dir, "blast.xml.gz")
+            f = gzip.GzipFile(xml_fp, "w")
+            f.write(xml_output)
+            f.close()
+            self.assertEqual(blast_format(xml_fp), "xml")
+            tabular_fp = os.path.join(tmp_dir, "blast.txt")
+            with open(tabular_fp, "w") as f:
+                f.write(normal_output)
+            self.assertEqual(blast_format(tabular_fp), "tabular")
+        finally:
+            shutil.rmtree(tmp_dir)
+
+
+class BlastHitsTests(TestCase):
+    def setUp(self):
+        self.hits = BlastHits()
+        self.hits.append("1", 99.0, 150)
+        self.hits.append(None, 98.5, 140)
+        self.hits.append("3", 97.0, 130)
+
+    def test_arrays(self):
+        self.assertEqual(len(self.hits), 3)
+        self.assertEqual(self.hits.gis, ["1", None, "3"])
+        self.assertEqual(list(self.hits.pct_ids), [99.0, 98.5, 97.0])
+        self.assertEqual(list(self.hits.lengths), [150, 140, 130])
+
+    def test_hits(self):
+        h = self.hits[2]
+        self.assertEqual((h.gi, h.pct_id, h.length), ("3", 97.0, 130))
+        self.assertEqual([h.gi for h in self.hits], ["1", None, "3"])
+
+    def test_take(self):
+        obs = self.hits.take([2, 0])
+        self.assertEqual(obs.gis, ["3", "1"])
+        self.assertEqual(list(obs.pct_ids), [97.0, 99.0])
+        self.assertEqual(list(obs.lengths), [130, 150])
+
+    def test_from_hits(self):
+        obs = BlastHits.from_hits(self.hits)
+        self.assertEqual(obs.gis, self.hits.gis)
+        self.assertEqual(obs.pct_ids, self.hits.pct_ids)
+        self.assertEqual(obs.lengths, self.hits.lengths)
+
+
+class QueryHitsTests(TestCase):
+    def setUp(self):
+        self.seqs = [("a", "AAA"), ("b", "CCC"), ("c", "GGG")]
+        self.ha = [BlastHit("1", 99.0, 3)]
+        self.hc = [BlastHit("2", 99.0, 3)]
+
+    def test_sorted(self):
+        obs = list(iter_query_hits(
+            self.seqs, [("a", self.ha), ("b", []), ("c", self.hc)]))
+        self.assertEqual(obs, [
+            ("a", "AAA", self.ha), ("b", "CCC", []), ("c", "GGG", self.hc)])
+
+    def test_missing_queries(self):
+        obs = list(iter_query_hits(self.seqs, [("c", self.hc)]))
+        self.assertEqual(obs, [
+            ("a", "AAA", []), ("b", "CCC", []), ("c", "GGG", self.hc)])
+
+    def test_extra_query(self):
+        obs = list(iter_query_hits(
+            self.seqs, [("a", self.ha), ("c", self.hc), ("d", [])]))
+        self.assertEqual(obs, [
+            ("a", "AAA", self.ha), ("b", "CCC", []), ("c", "GGG", self.hc)])
+
+    def test_unsorted(self):
+        queries = iter_query_hits(
+            self.seqs, [("c", self.hc), ("a", self.ha)])
+        self.assertRaises(UnsortedBlastError, list, queries)
+
+    def test_unknown_query_first(self):
+        queries = iter_query_hits(
+            self.seqs, [("d", []), ("a", self.ha), ("c", self.hc)])
+        self.assertRaises(UnsortedBlastError, list, queries)
+
+    def test_unknown_query_skipped(self):
+        queries = iter_query_hits(
+            self.seqs, [("x", self.ha), ("b", self.ha), ("c", self.hc)],
+            set(["a", "b", "c"]))
+        self.assertEqual(list(queries), [
+            ("a", "AAA", []), ("b", "CCC", self.ha), ("c", "GGG", self.hc)])
+
+
 
 
 normal_output = """\
@@ -87,6 +428,232 @@ malformed_output = """\
 0	gi|259099396|gb|GQ521694.1|	98.67	150	1	1	416	564	1	150	2e-65	 259
 """
 
+query_length_output = """\
+# BLASTN 2.2.23+
+# Query: a1
+# Fields: subject id, query id, query length, % identity, alignment length
+# 2 hits found
+gi|1|	a1	120	99.00	100
+gi|2|	a1	120	98.00	90
+# BLASTN 2.2.23+
+# Query: b2
+# Fields: subject id, query id, query length, % identity, alignment length
+# 0 hits found
+# BLASTN 2.2.23+
+# Query: c3
+# Fields: subject id, query id, query length, % identity, alignment length
+# 1 hits found
+gi|3|	c3	85	97.00	80
+"""
+
+normal_xml_output = """\
+<?xml version="1.0"?>
+<BlastOutput>
+  <BlastOutput_iterations>
+    <Iteration>
+      <Iteration_iter-num>1</Iteration_iter-num>
+      <Iteration_query-ID>Query_1</Iteration_query-ID>
+      <Iteration_query-def>0 E7_168192</Iteration_query-def>
+      <Iteration_query-len>600</Iteration_query-len>
+      <Iteration_hits>
+        <Hit>
+          <Hit_num>1</Hit_num>
+          <Hit_id>gi|259100874|gb|GQ513762.1|</Hit_id>
+          <Hit_accession>GQ513762</Hit_accession>
+          <Hit_hsps>
+            <Hsp>
+              <Hsp_num>1</Hsp_num>
+              <Hsp_identity>157</Hsp_identity>
+              <Hsp_align-len>159</Hsp_align-len>
+            </Hsp>
+          </Hit_hsps>
+        </Hit>
+        <Hit>
+          <Hit_num>2</Hit_num>
+          <Hit_id>gi|259098555|gb|GQ520853.1|</Hit_id>
+          <Hit_accession>GQ520853</Hit_accession>
+          <Hit_hsps>
+            <Hsp>
+              <Hsp_num>1</Hsp_num>
+              <Hsp_identity>157</Hsp_identity>
+              <Hsp_align-len>159</Hsp_align-len>
+            </Hsp>
+          </Hit_hsps>
+        </Hit>
+        <Hit>
+          <Hit_num>3</Hit_num>
+          <Hit_id>gi|259098210|gb|GQ520508.1|</Hit_id>
+          <Hit_accession>GQ520508</Hit_accession>
+          <Hit_hsps>
+            <Hsp>
+              <Hsp_num>1</Hsp_num>
+              <Hsp_identity>156</Hsp_identity>
+              <Hsp_align-len>159</Hsp_align-len>
+            </Hsp>
+          </Hit_hsps>
+        </Hit>
+        <Hit>
+          <Hit_num>4</Hit_num>
+          <Hit_id>gi|259092808|gb|GQ524514.1|</Hit_id>
+          <Hit_accession>GQ524514</Hit_accession>
+          <Hit_hsps>
+            <Hsp>
+              <Hsp_num>1</Hsp_num>
+              <Hsp_identity>156</Hsp_identity>
+              <Hsp_align-len>159</Hsp_align-len>
+            </Hsp>
+          </Hit_hsps>
+        </Hit>
+        <Hit>
+          <Hit_num>5</Hit_num>
+          <Hit_id>gi|259107208|gb|GQ510686.1|</Hit_id>
+          <Hit_accession>GQ510686</Hit_accession>
+          <Hit_hsps>
+            <Hsp>
+              <Hsp_num>1</Hsp_num>
+              <Hsp_identity>150</Hsp_identity>
+              <Hsp_align-len>152</Hsp_align-len>
+            </Hsp>
+          </Hit_hsps>
+        </Hit>
+        <Hit>
+          <Hit_num>6</Hit_num>
+          <Hit_id>gi|259103360|gb|GQ516248.1|</Hit_id>
+          <Hit_accession>GQ516248</Hit_accession>
+          <Hit_hsps>
+            <Hsp>
+              <Hsp_num>1</Hsp_num>
+              <Hsp_identity>150</Hsp_identity>
+              <Hsp_align-len>152</Hsp_align-len>
+            </Hsp>
+          </Hit_hsps>
+        </Hit>
+        <Hit>
+          <Hit_num>7</Hit_num>
+          <Hit_id>gi|259101730|gb|GQ514618.1|</Hit_id>
+          <Hit_accession>GQ514618</Hit_accession>
+          <Hit_hsps>
+            <Hsp>
+              <Hsp_num>1</Hsp_num>
+              <Hsp_identity>150</Hsp_identity>
+              <Hsp_align-len>152</Hsp_align-len>
+            </Hsp>
+          </Hit_hsps>
+        </Hit>
+      </Iteration_hits>
+    </Iteration>
+  </BlastOutput_iterations>
+</BlastOutput>
+"""
+
+xml_output = """\
+<?xml version="1.0"?>
+<!DOCTYPE BlastOutput PUBLIC "-//NCBI//NCBI BlastOutput/EN" "http://www.ncbi.nlm.nih.gov/dtd/NCBI_BlastOutput.dtd">
+<BlastOutput>
+  <BlastOutput_program>blastn</BlastOutput_program>
+  <BlastOutput_version>BLASTN 2.2.29+</BlastOutput_version>
+  <BlastOutput_db>nt</BlastOutput_db>
+  <BlastOutput_query-ID>Query_1</BlastOutput_query-ID>
+  <BlastOutput_query-def>a1 first query</BlastOutput_query-def>
+  <BlastOutput_query-len>120</BlastOutput_query-len>
+  <BlastOutput_iterations>
+    <Iteration>
+      <Iteration_iter-num>1</Iteration_iter-num>
+      <Iteration_query-ID>Query_1</Iteration_query-ID>
+      <Iteration_query-def>a1 first query</Iteration_query-def>
+      <Iteration_query-len>120</Iteration_query-len>
+      <Iteration_hits>
+        <Hit>
+          <Hit_num>1</Hit_num>
+          <Hit_id>gi|1|gb|AB000001.1|</Hit_id>
+          <Hit_def>Subject one</Hit_def>
+          <Hit_accession>AB000001</Hit_accession>
+          <Hit_len>500</Hit_len>
+          <Hit_hsps>
+            <Hsp>
+              <Hsp_num>1</Hsp_num>
+              <Hsp_identity>99</Hsp_identity>
+              <Hsp_align-len>100</Hsp_align-len>
+            </Hsp>
+            <Hsp>
+              <Hsp_num>2</Hsp_num>
+              <Hsp_identity>39</Hsp_identity>
+              <Hsp_align-len>40</Hsp_align-len>
+            </Hsp>
+          </Hit_hsps>
+        </Hit>
+        <Hit>
+          <Hit_num>2</Hit_num>
+          <Hit_id>gnl|BL_ORD_ID|12</Hit_id>
+          <Hit_def>AB000002.1 Subject two</Hit_def>
+          <Hit_accession>12</Hit_accession>
+          <Hit_len>400</Hit_len>
+          <Hit_hsps>
+            <Hsp>
+              <Hsp_num>1</Hsp_num>
+              <Hsp_identity>89</Hsp_identity>
+              <Hsp_align-len>90</Hsp_align-len>
+            </Hsp>
+          </Hit_hsps>
+        </Hit>
+      </Iteration_hits>
+    </Iteration>
+    <Iteration>
+      <Iteration_iter-num>2</Iteration_iter-num>
+      <Iteration_query-ID>Query_2</Iteration_query-ID>
+      <Iteration_query-def>b2</Iteration_query-def>
+      <Iteration_query-len>95</Iteration_query-len>
+      <Iteration_hits>
+      </Iteration_hits>
+      <Iteration_message>No hits found</Iteration_message>
+    </Iteration>
+    <Iteration>
+      <Iteration_iter-num>3</Iteration_iter-num>
+      <Iteration_query-ID>c3</Iteration_query-ID>
+      <Iteration_query-def>No definition line</Iteration_query-def>
+      <Iteration_query-len>85</Iteration_query-len>
+      <Iteration_hits>
+        <Hit>
+          <Hit_num>1</Hit_num>
+          <Hit_id>gi|3|gb|AB000003.1|</Hit_id>
+          <Hit_def>Subject three</Hit_def>
+          <Hit_accession>AB000003</Hit_accession>
+          <Hit_len>300</Hit_len>
+          <Hit_hsps>
+            <Hsp>
+              <Hsp_num>1</Hsp_num>
+              <Hsp_identity>80</Hsp_identity>
+              <Hsp_align-len>80</Hsp_align-len>
+            </Hsp>
+          </Hit_hsps>
+        </Hit>
+      </Iteration_hits>
+    </Iteration>
+  </BlastOutput_iterations>
+</BlastOutput>
+"""
+
+multiple_query_output = """\
+# BLASTN 2.2.25+
+# Query: a1
+# Database: nt
+# Fields: query id, subject id, % identity, alignment length, mismatches, gap opens, q. start, q. end, s. start, s. end, evalue, bit score
+# 2 hits found
+a1	gi|1|gb|GQ513762.1|	98.74	159	1	1	407	564	1	159	2e-70	 275
+a1	gi|2|gb|GQ520853.1|	98.74	159	1	1	407	564	1	159	2e-70	 275
+# BLASTN 2.2.25+
+# Query: b2
+# Database: nt
+# 0 hits found
+# BLASTN 2.2.25+
+# Query: c3
+# Database: nt
+# Fields: query id, subject id, % identity, alignment length, mismatches, gap opens, q. start, q. end, s. start, s. end, evalue, bit score
+# 1 hits found
+c3	gi|3|gb|GQ520508.1|	98.11	159	2	1	407	564	1	159	1e-68	 269
+# BLAST processed 3 queries
+"""
+
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,116 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from brocclib.parse import BlastHit, BlastHits
+from brocclib.stats import (
+    LatencyHistogram, RunStats, TimedTaxonomy, ProfiledAssigner,
+    )
+from test_assign import FakeTaxaDb
+
+
+class LatencyHistogramTests(unittest.TestCase):
+    def test_bins(self):
+        h = LatencyHistogram([1, 10])
+        for ms in [0.5, 1, 3, 20, 30]:
+            h.add(ms)
+        self.assertEqual(h.counts, [2, 1, 2])
+        obs = h.report()
+        self.assertEqual(obs["count"], 5)
+        self.assertEqual(obs["bin_counts"], [2, 1, 2])
+        self.assertEqual(obs["max_ms"], 30)
+
+    def test_percentile(self):
+        h = LatencyHistogram()
+        self.assertEqual(h.percentile(50), None)
+        for ms in range(1, 101):
+            h.add(ms)
+        self.assertEqual(h.percentile(50), 50)
+        self.assertEqual(h.percentile(99), 99)
+        self.assertEqual(h.percentile(100), 100)
+
+
+class RunStatsTests(unittest.TestCase):
+    def test_iter_queries(self):
+        stats = RunStats()
+        hits = BlastHits.from_hits([BlastHit("1", 99.0, 100)])
+        queries = [
+            ("a", "ACGT", hits),
+            ("b", "ACGT", [BlastHit("1", 99.0, 100), BlastHit("2", 98.0, 90)]),
+            ("c", "ACGT", []),
+            ]
+        self.assertEqual(list(stats.iter_queries(queries)), queries)
+        obs = stats.report()
+        self.assertEqual(
+            obs["counts"], {"queries": 3, "hits": 3, "distinct_subjects": 2})
+        self.assertTrue("read_input" in obs["stages"])
+
+    def test_write_output(self):
+        stats = RunStats()
+        stats.add_time("read_input", 1.0)
+        stats.add_time("results", 3.0)
+        stats.add_time("classify", 3.5)
+        obs = stats.report()["stages"]
+        self.assertEqual(obs["write_output"], 0.5)
+        # Without a profiled assigner, assignment is the remaining time
+        self.assertEqual(obs["assign"], 2.0)
+        self.assertFalse("results" in obs)
+
+    def test_start_pass(self):
+        stats = RunStats()
+        stats.add_time("prefetch", 2.0)
+        queries = [("a", "ACGT", [BlastHit("1", 99.0, 100)])]
+        for _ in range(2):
+            stats.start_pass()
+            list(stats.iter_queries(queries))
+            stats.query_latency.add(1.0)
+            stats.add_time("results", 3.0)
+        stats.add_time("classify", 3.5)
+        obs = stats.report()
+        # Only the last pass is counted
+        self.assertEqual(
+            obs["counts"], {"queries": 1, "hits": 1, "distinct_subjects": 1})
+        self.assertEqual(obs["query_latency"]["count"], 1)
+        self.assertEqual(obs["stages"]["write_output"], 0.5)
+        self.assertEqual(obs["stages"]["prefetch"], 2.0)
+        self.assertTrue("abandoned_pass" in obs["stages"])
+
+
+class ProfiledAssignerTests(unittest.TestCase):
+    def setUp(self):
+        self.stats = RunStats()
+        self.taxa_db = TimedTaxonomy(FakeTaxaDb(), self.stats)
+        self.assigner = ProfiledAssigner(
+            .7, 95.2, 83.05, 80.0, [.6, .6, .6, .9, .9, .9, .9, .9], .7,
+            self.taxa_db, stats=self.stats)
+
+    def test_assign(self):
+        hits = [BlastHit("1", 99.0, 100), BlastHit("3", 96.0, 100)]
+        a = self.assigner.assign("q1", "A" * 100, hits)
+        self.assertEqual(a.winning_candidate.rank, "genus")
+        obs = self.stats.report(self.assigner, self.taxa_db)
+        self.assertEqual(obs["query_latency"]["count"], 1)
+        self.assertEqual(obs["counts"]["distinct_taxon_ids"], 2)
+        self.assertEqual(obs["counts"]["lineage_cache_misses"], 2)
+        for stage in [
+                "assign", "assign.quality_filter", "assign.vote",
+                "assign.vote.lineages", "assign.vote.lineages.taxonomy"]:
+            self.assertTrue(stage in obs["stages"], stage)
+
+    def test_write(self):
+        self.assigner.assign("q1", "A" * 100, [BlastHit("4", 99.0, 100)])
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            fp = os.path.join(tmp_dir, "stats.json")
+            self.stats.write(fp, self.assigner, self.taxa_db)
+            with open(fp) as f:
+                obs = json.load(f)
+        finally:
+            shutil.rmtree(tmp_dir)
+        self.assertEqual(obs["query_latency"]["count"], 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,6 +1,6 @@
 import unittest
 
-from brocclib.taxonomy import Lineage
+from brocclib.taxonomy import Lineage, Interner, GenericTaxa
 
 class TaxonTests(unittest.TestCase):
     def setUp(self):
@@ -63,6 +63,89 @@ class TaxonTests(unittest.TestCase):
         t = Lineage(self.d)
         self.assertEqual(t.classified, False)
 
+    def test_custom_generic_taxa(self):
+        generic_taxa = GenericTaxa(patterns=["Candida .*"])
+        t = Lineage(self.d, generic_taxa)
+        self.assertEqual(t.classified, False)
+        self.d["species"] = "uncultured organism"
+        t = Lineage(self.d, generic_taxa)
+        self.assertEqual(t.classified, True)
+
+    def test_has_paren_taxon(self):
+        self.d["Lineage"] = self.d["Lineage"].replace(
+            "saccharomyceta", "saccharomyceta (clade)")
+        for d in [self.d, dict(self.d, genus="Candida (genus)")]:
+            t = Lineage(d)
+            for rank in Lineage.ranks:
+                self.assertEqual(
+                    t.has_paren_taxon(rank),
+                    any("(" in x for x in t.get_all_taxa(rank)))
+        self.assertFalse(t.has_paren_taxon("phylum"))
+        self.assertTrue(t.has_paren_taxon("class"))
+
+    def test_shared_names(self):
+        # Names are shared, even if they come from different strings
+        d2 = dict((k, u"%s" % v) for k, v in self.d.items())
+        t1 = Lineage(self.d)
+        t2 = Lineage(d2)
+        self.assertIsNot(d2["genus"], self.d["genus"])
+        self.assertIs(t1.genus, t2.genus)
+        self.assertIs(t1.family, t2.family)
+        self.assertIs(t1.taxa, t2.taxa)
+        self.assertIs(t1.full_lineage, t2.full_lineage)
+
+
+class GenericTaxaTests(unittest.TestCase):
+    def test_parse(self):
+        g = GenericTaxa.parse([
+            "# Generic taxa\n", "uncultured fungus\n", "\n",
+            "regex:unclassified .*\n", "regex: .* sp\\.\n",
+            ])
+        self.assertEqual(g.names, frozenset(["uncultured fungus"]))
+        self.assertEqual(g.patterns, ["unclassified .*", ".* sp\\."])
+
+    def test_contains(self):
+        g = GenericTaxa(["uncultured fungus"], ["unclassified .*", ".* sp\\."])
+        self.assertTrue("uncultured fungus" in g)
+        self.assertTrue("unclassified Fungi" in g)
+        self.assertTrue("Candida sp." in g)
+        # Patterns must match the whole name
+        self.assertFalse("Candida sp. 1" in g)
+        self.assertFalse("uncultured fungus 2" in g)
+        self.assertFalse(None in g)
+
+    def test_default(self):
+        self.assertTrue("uncultured fungus" in Lineage.generic_taxa)
+        self.assertFalse("Candida albicans" in Lineage.generic_taxa)
+        self.assertTrue("unclassified Fungi" in Lineage.generic_flags)
+
+
+class InternerTests(unittest.TestCase):
+    def test_intern(self):
+        intern_value = Interner()
+        a = u"Candida"
+        b = u"".join(["Cand", "ida"])
+        self.assertIsNot(a, b)
+        self.assertIs(intern_value(a), a)
+        self.assertIs(intern_value(b), a)
+        self.assertIs(intern_value(("x", a)), intern_value(("x", b)))
+        self.assertEqual(intern_value(None), None)
+        self.assertEqual(len(intern_value), 3)
+
+    def test_sweep(self):
+        intern_value = Interner()
+        kept = intern_value(tuple(["Candida", "albicans"]))
+        for i in range(2000):
+            intern_value(tuple(["Candida", str(i)]))
+        # Values used elsewhere are kept
+        self.assertTrue(len(intern_value) < 1000)
+        self.assertIs(intern_value(tuple(["Candida", "albicans"])), kept)
+        intern_value.sweep()
+        self.assertEqual(len(intern_value), 1)
+        del kept
+        intern_value.sweep()
+        self.assertEqual(len(intern_value), 0)
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,125 @@
+import os
+import random
+import shutil
+import tempfile
+import unittest
+from StringIO import StringIO
+
+from brocclib.taxonomy_db import (
+    init_db, insert_taxid, insert_nodes, insert_names, NcbiTaxonomyDb,
+    taxonomy_rows,
+    )
+from brocclib import taxonomy_index
+from brocclib.taxonomy_index import (
+    compile_index, TaxonomyIndex, TaxonomyIndexError,
+    )
+from test_create_ncbi_taxonomy_db import (
+    lineage_gi_taxid, lineage_nodes, lineage_names, accession2taxid,
+    )
+
+
+class TaxonomyIndexTests(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.index_fp = os.path.join(self.tmp_dir, "taxonomy.idx")
+        tables = taxonomy_rows(
+            StringIO(lineage_gi_taxid + "5\t2759\n3\t4751\n"),
+            StringIO(lineage_nodes), StringIO(lineage_names),
+            accession_fs=[StringIO(accession2taxid)])
+        compile_index(self.index_fp, tables)
+        self.index = TaxonomyIndex(self.index_fp)
+
+    def tearDown(self):
+        self.index.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_get_taxon_id(self):
+        self.assertEqual(self.index.get_taxon_id("312434489"), 531911)
+        self.assertEqual(self.index.get_taxon_id("3"), 4751)
+        self.assertEqual(self.index.get_taxon_id("5"), 2759)
+        self.assertEqual(self.index.get_taxon_id("4"), None)
+        self.assertEqual(self.index.get_taxon_id("9999999999"), None)
+        self.assertEqual(self.index.get_taxon_id(None), None)
+
+    def test_get_taxon_id_accession(self):
+        self.assertEqual(self.index.get_taxon_id("HQ379286.1"), 531911)
+        self.assertEqual(self.index.get_taxon_id("NR_000012.1"), 4751)
+        self.assertEqual(self.index.get_taxon_id("NZ_ABCD01000001.2"), 2759)
+        self.assertEqual(self.index.get_taxon_id("NR_000013.1"), None)
+        self.assertEqual(self.index.get_taxon_id("NR_12.1"), None)
+
+    def test_sort_chunks(self):
+        accessions = ["HQ%06d.1" % n for n in range(0, 1000, 7)]
+        accessions += ["NR_%06d.1" % n for n in range(0, 1000, 11)]
+        random.Random(1).shuffle(accessions)
+        rows = [(a, i) for i, a in enumerate(accessions)]
+        # A later row for the same accession is ignored
+        rows.append(("HQ000007.2", 99))
+        chunk_size = taxonomy_index.SORT_CHUNK_SIZE
+        block_size = taxonomy_index.MERGE_BLOCK_SIZE
+        taxonomy_index.SORT_CHUNK_SIZE = 10
+        taxonomy_index.MERGE_BLOCK_SIZE = 3
+        try:
+            fp = os.path.join(self.tmp_dir, "chunks.idx")
+            compile_index(fp, [
+                ("accession_taxid", rows), ("nodes", []), ("names", [])])
+        finally:
+            taxonomy_index.SORT_CHUNK_SIZE = chunk_size
+            taxonomy_index.MERGE_BLOCK_SIZE = block_size
+        index = TaxonomyIndex(fp)
+        for accession, tax_id in rows[:-1]:
+            self.assertEqual(index.get_taxon_id(accession), tax_id)
+        self.assertEqual(index.get_taxon_id("HQ000008.1"), None)
+        index.close()
+
+    def test_key_too_large(self):
+        fp = os.path.join(self.tmp_dir, "large.idx")
+        for table, row in [
+                ("gi_taxid", ("4294967296", 9606)),
+                ("accession_taxid", ("AB4294967296.1", 9606))]:
+            tables = [(table, [row]), ("nodes", []), ("names", [])]
+            try:
+                compile_index(fp, tables)
+            except TaxonomyIndexError as e:
+                self.assertTrue(row[0] in str(e))
+                self.assertTrue("4294967295" in str(e))
+            else:
+                self.fail("No error for %s" % row[0])
+            self.assertFalse(os.path.exists(fp))
+        # The largest key is allowed
+        compile_index(fp, [
+            ("gi_taxid", [("4294967295", 9606)]), ("nodes", []),
+            ("names", [])])
+        index = TaxonomyIndex(fp)
+        self.assertEqual(index.get_taxon_id("4294967295"), 9606)
+        index.close()
+
+    def test_get_node(self):
+        self.assertEqual(self.index.get_parent(37840), 37991)
+        self.assertEqual(self.index.get_rank(37840), "genus")
+        self.assertEqual(self.index.get_name(37840), "Pestalotiopsis")
+        self.assertEqual(self.index.get_parent(1), 1)
+        self.assertEqual(self.index.get_parent(12), None)
+        self.assertEqual(self.index.get_parent(10 ** 7), None)
+
+    def test_get_lineage_matches_db(self):
+        db_fp = os.path.join(self.tmp_dir, "taxonomy.db")
+        init_db(db_fp)
+        insert_taxid(db_fp, StringIO(lineage_gi_taxid))
+        insert_nodes(db_fp, StringIO(lineage_nodes))
+        insert_names(db_fp, StringIO(lineage_names))
+        db = NcbiTaxonomyDb(db_fp)
+        taxon_ids = [r[0] for r in db.conn.execute("SELECT tax_id FROM nodes")]
+        for taxon_id in taxon_ids + [12]:
+            self.assertEqual(
+                self.index.get_lineage(taxon_id), db.get_lineage(taxon_id))
+
+    def test_not_an_index(self):
+        fp = os.path.join(self.tmp_dir, "not_an_index")
+        with open(fp, "w") as f:
+            f.write("x" * 200)
+        self.assertRaises(ValueError, TaxonomyIndex, fp)
+
+
+if __name__ == "__main__":
+    unittest.main()
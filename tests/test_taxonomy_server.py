@@ -0,0 +1,158 @@
+import json
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import unittest
+
+from brocclib.taxonomy_server import (
+    TaxonomyService, TaxonomyClient, TaxonomyServerError, make_server,
+    parse_address,
+    )
+
+
+class FakeTaxaDb(object):
+    taxon_ids = {"1": 10, "2": 10, "3": 20}
+    lineages = {
+        10: {"species": "Candida albicans", "Lineage": "Eukaryota; Candida"},
+        20: {"species": "Candida tropicalis", "Lineage": "Eukaryota; Candida"},
+        }
+
+    def __init__(self):
+        self.threads = set()
+        self.lineage_lookups = 0
+
+    def get_taxon_id(self, gi):
+        self.threads.add(threading.current_thread())
+        return self.taxon_ids.get(gi)
+
+    def get_lineage(self, taxon_id):
+        self.threads.add(threading.current_thread())
+        self.lineage_lookups += 1
+        return self.lineages.get(taxon_id)
+
+
+class ParseAddressTests(unittest.TestCase):
+    def test_parse_address(self):
+        self.assertEqual(parse_address("localhost:8123"), ("localhost", 8123))
+        self.assertEqual(parse_address(":8123"), ("localhost", 8123))
+        self.assertEqual(
+            parse_address("/tmp/taxonomy.sock"), "/tmp/taxonomy.sock")
+        self.assertEqual(parse_address("taxonomy.sock"), "taxonomy.sock")
+
+
+class TaxonomyServerTests(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp(prefix="brocc")
+        self.taxa_db = FakeTaxaDb()
+        self.service = TaxonomyService(lambda: self.taxa_db)
+        self.servers = []
+
+    def tearDown(self):
+        for server, thread in self.servers:
+            server.shutdown()
+            server.server_close()
+            thread.join()
+        self.service.close()
+        shutil.rmtree(self.temp_dir)
+
+    def _start(self, address):
+        server = make_server(address, self.service)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        self.servers.append((server, thread))
+        if isinstance(server.server_address, tuple):
+            return "localhost:%d" % server.server_address[1]
+        return address
+
+    def test_unix_socket(self):
+        address = self._start(os.path.join(self.temp_dir, "taxonomy.sock"))
+        client = TaxonomyClient(address)
+        self.assertEqual(client.get_taxon_id("1"), 10)
+        self.assertEqual(client.get_taxon_id("5"), None)
+        self.assertEqual(
+            client.get_lineage(10), FakeTaxaDb.lineages[10])
+        self.assertEqual(client.get_lineage(30), None)
+        self.assertEqual(client.requests, 4)
+        # Results are kept in memory
+        client.get_taxon_id("1")
+        self.assertEqual(client.requests, 4)
+        # Names are byte strings
+        self.assertEqual(type(client.get_lineage(10)["species"]), str)
+        client.close()
+
+    def test_tcp_prefetch(self):
+        address = self._start("localhost:0")
+        client = TaxonomyClient(address, batch_size=2)
+        client.prefetch(["1", "2", "3", "1", "5", None])
+        # Two batches of GI numbers, one batch of taxon IDs
+        self.assertEqual(client.requests, 3)
+        self.assertEqual(
+            client.taxon_ids, {"1": 10, "2": 10, "3": 20, "5": None})
+        self.assertEqual(
+            client.get_lineage(20)["species"], "Candida tropicalis")
+        self.assertEqual(client.requests, 3)
+        client.close()
+
+    def test_many_clients(self):
+        address = self._start(os.path.join(self.temp_dir, "taxonomy.sock"))
+        results = []
+
+        def lookup():
+            client = TaxonomyClient(address)
+            for _ in range(20):
+                results.append(client.get_taxon_id("3"))
+                client.taxon_ids.clear()
+            client.close()
+
+        threads = [threading.Thread(target=lookup) for _ in range(5)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(results, [20] * 100)
+        # Every lookup was made in the same thread
+        self.assertEqual(len(self.taxa_db.threads), 1)
+
+    def test_bad_request(self):
+        address = self._start("localhost:0")
+        sock = socket.create_connection(parse_address(address))
+        f = sock.makefile("rb")
+        for request in [
+                "not json", json.dumps({"method": "get_taxon_ids"}),
+                json.dumps({"method": "drop_tables", "ids": []})]:
+            sock.sendall(request + "\n")
+            self.assertTrue("error" in json.loads(f.readline()))
+        # The connection is still usable after an error
+        sock.sendall(json.dumps({"method": "get_taxon_ids", "ids": ["2"]}))
+        sock.sendall("\n")
+        self.assertEqual(json.loads(f.readline()), {"result": [10]})
+        f.close()
+        sock.close()
+
+    def test_lookup_error(self):
+        address = self._start("localhost:0")
+        client = TaxonomyClient(address)
+        # Lists are not valid taxon IDs
+        self.assertRaises(
+            TaxonomyServerError, client._call, "get_lineages", [[10]])
+        self.assertEqual(client.get_lineage(10), FakeTaxaDb.lineages[10])
+        client.close()
+
+    def test_missing_lineage_cached(self):
+        for _ in range(3):
+            self.assertEqual(
+                self.service.lookup("get_lineages", [30, 10]),
+                [None, FakeTaxaDb.lineages[10]])
+        # Taxa without a lineage are looked up once, like the others
+        self.assertEqual(self.taxa_db.lineage_lookups, 2)
+
+    def test_open_error(self):
+        def open_taxa_db():
+            raise IOError("No such file")
+        self.assertRaises(IOError, TaxonomyService, open_taxa_db)
+
+
+if __name__ == "__main__":
+    unittest.main()